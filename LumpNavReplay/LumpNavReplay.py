@@ -4,10 +4,21 @@ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
 import numpy, math
+from vtk.util import numpy_support
 from slicer.util import getNode, getNodes
 from slicer import modules, app
 import time
-import Viewpoint
+from concurrent.futures import ThreadPoolExecutor
+from LumpNavReplayLib.SequenceMetafile import SequenceMetafile, readMetafileTransforms
+from LumpNavReplayLib.ChunkedRecording import ChunkedRecording, isChunkedRecordingFile
+from LumpNavReplayLib.TransformCache import TransformCache
+from LumpNavReplayLib.AutocenterCoordinator import AutocenterCoordinator
+from LumpNavReplayLib.PlaybackScheduler import PlaybackScheduler
+from LumpNavReplayLib.ResliceScrubPreview import ImagePyramid, ResliceScrubPreview, SequenceNodeFrames
+from LumpNavReplayLib.Instrumentation import Instrumentation
+from LumpNavReplayLib.TimestampIndex import TimestampIndex
+from LumpNavReplayLib.ViewRegistry import getViewRegistry
+from LumpNavReplayLib.WorldMatrixCache import WorldMatrixCache, getMatrixToParent, getTransformMatrices
 
 class LumpNavReplay(ScriptedLoadableModule):
   """Uses ScriptedLoadableModule base class, available at:
@@ -102,6 +113,17 @@ class LumpNavReplayWidget(ScriptedLoadableModuleWidget):
     self.autoCenterCheckbox.setToolTip("Automatically center the view.")
     self.autoCenterCheckbox.setChecked(True)
     parametersFormLayout.addRow("Auto-center: ", self.autoCenterCheckbox)
+
+    self.synchronizeDatasetsCheckbox = qt.QCheckBox()
+    self.synchronizeDatasetsCheckbox.setToolTip("Keep the recording and tracking data sets at the same acquisition time during playback.")
+    self.synchronizeDatasetsCheckbox.setChecked(False)
+    parametersFormLayout.addRow("Synchronize data sets: ", self.synchronizeDatasetsCheckbox)
+    self.synchronizeDatasetsCheckbox.connect('toggled(bool)', self.onSynchronizeDatasetsToggled)
+
+    self.loadImagesOnDemandCheckbox = qt.QCheckBox()
+    self.loadImagesOnDemandCheckbox.setToolTip("Read only the recording header when loading. Ultrasound frames are read from disk when they are displayed.")
+    self.loadImagesOnDemandCheckbox.setChecked(False)
+    parametersFormLayout.addRow("Load images on demand: ", self.loadImagesOnDemandCheckbox)
     
     self.loadAllDataButton = qt.QPushButton("Load All Data")
     self.loadAllDataButton.setToolTip("Load the pertinent data for evaluating tumor tracking.")
@@ -114,6 +136,13 @@ class LumpNavReplayWidget(ScriptedLoadableModuleWidget):
     parametersFormLayout.addRow(self.switchDataButton)
     self.switchDataButton.connect('clicked()', self.onSwitchDataButtonPressed)
 
+    self.playButton = qt.QPushButton("Play in real time")
+    self.playButton.setToolTip("Play the active data set at the recorded speed. Frames are skipped if rendering cannot keep up.")
+    self.playButton.setCheckable(True)
+    self.playButton.setEnabled(False)
+    parametersFormLayout.addRow(self.playButton)
+    self.playButton.connect('toggled(bool)', self.onPlayButtonToggled)
+
     # Add vertical spacer
     self.layout.addStretch(1)
 
@@ -166,15 +195,38 @@ class LumpNavReplayWidget(ScriptedLoadableModuleWidget):
     fileDialog.acceptMode = fileDialog.AcceptOpen
 
   def onLoadAllDataButtonPressed(self):
-    self.logic.loadAllData(self.transducerToProbeFileLineEdit.text, \
-                           self.sceneFileLineEdit.text, \
-                           self.recordingFileLineEdit.text, \
-                           self.trackingFileLineEdit.text, \
-                           self.autoCenterCheckbox.checked)
+    progressDialog = slicer.util.createProgressDialog(parent=self.parent, windowTitle="Loading LumpNav data", maximum=100)
+    def updateProgress(message, percent):
+      progressDialog.labelText = message
+      progressDialog.value = percent
+      slicer.app.processEvents()
+    try:
+      self.logic.loadAllData(self.transducerToProbeFileLineEdit.text, \
+                             self.sceneFileLineEdit.text, \
+                             self.recordingFileLineEdit.text, \
+                             self.trackingFileLineEdit.text, \
+                             self.autoCenterCheckbox.checked, \
+                             self.loadImagesOnDemandCheckbox.checked, \
+                             updateProgress)
+    finally:
+      progressDialog.close()
     self.currentDataset = self.currentDatasetRecordingString
     self.switchDataButton.setEnabled(True)
+    self.playButton.setEnabled(True)
+    self.logic.setDatasetsSynchronized(self.synchronizeDatasetsCheckbox.checked)
+
+  def onSynchronizeDatasetsToggled(self, synchronized):
+    if self.switchDataButton.enabled:
+      self.logic.setDatasetsSynchronized(synchronized)
+
+  def onPlayButtonToggled(self, play):
+    if play:
+      self.logic.startPlayback(finishedCallback=lambda: self.playButton.setChecked(False))
+    else:
+      self.logic.stopPlayback()
 
   def onSwitchDataButtonPressed(self):
+    self.playButton.setChecked(False)
     if (self.currentDataset == self.currentDatasetRecordingString):
       self.logic.changeToTrackingData()
       self.currentDataset = self.currentDatasetTrackingString
@@ -198,20 +250,159 @@ class LumpNavReplayWidget(ScriptedLoadableModuleWidget):
 
 class LumpNavReplayLogic(ScriptedLoadableModuleLogic):
 
-  viewPointLogic = None
+  autocenterCoordinator = None
+  # Camera updates are skipped while the tumor stays within this distance of the safe region (normalized view coordinates)
+  autocenterTolerance = 0.05
+  autocenterMaximumUpdatesPerSecond = 10.0
+
+  # Number of decoded ultrasound frames kept in memory when images are loaded on demand
+  maximumNumberOfCachedFrames = 32
+  recordingData_metafile = None
+  # Chunked recordings (see ChunkedRecording) are always loaded with images on demand. While they are played
+  # the chunks of this many following frames are decompressed in the background.
+  chunkedRecordingPrefetchFrames = 8
+  transformHierarchyIsSetUp = False
+  activeBrowserNode = None
+  datasetsSynchronized = False
+  synchronizingDatasets = False
+
+  # Only these transforms are used from the tracking data set
+  trackingTransformNames = ["TrackerToReference", "NeedleToTracker", "CauteryToTracker"]
+
+  # Transforms read from metafile headers are cached on disk, next to the input files
+  # or in transformCacheDirectory if it is set
+  useTransformCache = True
+  transformCacheDirectory = None
+  transformCacheMaximumSizeBytes = 1024 * 1024 * 1024
+
+  # Wall time and memory of the loading stages and render time of each frame during playback are recorded
+  # if instrumentation is enabled (see setInstrumentationEnabled), and written to instrumentationLogFileName if it is set
+  instrumentation = None
+  instrumentationLogFileName = None
+  # Resetting the peak memory of the process at each stage affects other tools that read it, so it is opt-in
+  instrumentationMeasureStagePeakMemory = False
+
+  # If enabled, the world matrices of the displayed models and image are precomputed for every item of the active
+  # data set and set directly on each frame change, instead of being computed from the transform hierarchy
+  useWorldMatrixCache = False
+  activeWorldMatrixCache = None
+
+  # If enabled, slice views show a downsampled ultrasound image (by 2^resliceScrubPreviewLevel) while the recording
+  # is scrubbed or played fast, and the full resolution image once the frame did not change for the stable interval
+  useResliceScrubPreview = False
+  resliceScrubPreviewLevel = 2
+  resliceScrubPreviewStableSeconds = 0.25
+  resliceScrubPreview = None
+  recordingData_imagePyramid = None
+
+  # Real time playback of the active data set, see startPlayback
+  playbackScheduler = None
+
+  def __init__(self):
+    ScriptedLoadableModuleLogic.__init__(self)
+    # Observations and caches are per logic instance, e.g. the logic of a test must not remove the observers of the module logic
+    self.synchronizationObservations = []
+    self.renderTimeObservations = []
+    self.recordingBrowserObservations = []
+    # World matrix cache of each data set, keyed by browser node ID
+    self.worldMatrixCaches = {}
     
-  def loadAllData(self, transducerToProbeFile, sceneFile, recordingFile, trackingFile, autocenter):
+  def loadAllData(self, transducerToProbeFile, sceneFile, recordingFile, trackingFile, autocenter, loadImagesOnDemand=False, progressCallback=None):
+    """Loads all inputs of a case. Files that are parsed by this module (the tracking data set, and the recording
+    if images are loaded on demand) are read on worker threads while the transform, scene and recording are loaded
+    into the scene on the main thread. All nodes are added to the scene on the main thread.
+    A chunked recording (recordingFile with the ChunkedRecording extension) is always loaded with images on demand.
+    progressCallback(message, percent) is called between steps and while waiting for the worker threads.
+    """
+    if not progressCallback:
+      progressCallback = lambda message, percent: None
+    self.stopPlayback()
+    self.stopWorldMatrixCache()
+    self.setDatasetsSynchronized(False)
+    self.worldMatrixCaches = {}
+    self.stopResliceScrubPreview()
+    self.recordingData_imagePyramid = None
+    self.removeRecordingBrowserObservations()
+    if isinstance(self.recordingData_metafile, ChunkedRecording):
+      self.recordingData_metafile.close()
+    self.recordingData_metafile = None
     slicer.mrmlScene.Clear(False)
-    slicer.util.loadTransform(transducerToProbeFile)
-    self.loadScene(sceneFile)
-    self.loadRecordingSequences(recordingFile)
-    self.loadTrackingSequences(trackingFile)
-    self.changeToRecordingData()
-
-    if autocenter:
-      if not self.viewPointLogic:
-        self.viewpointLogic = Viewpoint.ViewpointLogic()
-      self.startAutocenter()
+    self.transformHierarchyIsSetUp = False
+    self.activeBrowserNode = None
+    self.stopRenderTimeMeasurement()
+    instrumentation = self.getInstrumentation()
+    instrumentation.clear()
+    loadImagesOnDemand = loadImagesOnDemand or isChunkedRecordingFile(recordingFile)
+    with instrumentation.measureStage("loadAllData"):
+      executor = ThreadPoolExecutor(max_workers=2)
+      trackingFuture = None
+      recordingFuture = None
+      try:
+        trackingFuture = executor.submit(self.readMetafileTransforms, trackingFile, self.trackingTransformNames)
+        recordingFuture = executor.submit(self.readRecordingMetafile, recordingFile) if loadImagesOnDemand else None
+        progressCallback("Loading transducer to probe transform...", 0)
+        with instrumentation.measureStage("loadTransform"):
+          slicer.util.loadTransform(transducerToProbeFile)
+        progressCallback("Loading scene...", 10)
+        with instrumentation.measureStage("loadScene"):
+          self.loadScene(sceneFile)
+        progressCallback("Loading recording...", 30)
+        with instrumentation.measureStage("loadRecordingSequences"):
+          recordingData = self.waitForFuture(recordingFuture, "Reading recording...", 30, progressCallback) if recordingFuture else None
+          self.loadRecordingSequences(recordingFile, loadImagesOnDemand, recordingData)
+        with instrumentation.measureStage("loadTrackingSequences"):
+          trackingTransforms = self.waitForFuture(trackingFuture, "Reading tracking...", 60, progressCallback)
+          progressCallback("Loading tracking...", 70)
+          self.loadTrackingSequences(trackingFile, trackingTransforms=trackingTransforms)
+      finally:
+        # If loading failed, the workers must not keep reading (and writing the transform cache) while the
+        # next case is loaded. A worker that has already started cannot be interrupted, so wait for it.
+        for future in [trackingFuture, recordingFuture]:
+          if future:
+            future.cancel()
+        executor.shutdown(wait=True)
+      progressCallback("Setting up views...", 90)
+      with instrumentation.measureStage("buildTimestampIndices"):
+        self.buildTimestampIndices()
+      with instrumentation.measureStage("changeToRecordingData"):
+        self.changeToRecordingData()
+      if self.useResliceScrubPreview:
+        with instrumentation.measureStage("startResliceScrubPreview"):
+          self.startResliceScrubPreview()
+
+      if autocenter:
+        with instrumentation.measureStage("startAutocenter"):
+          self.startAutocenter()
+    if instrumentation.enabled:
+      self.startRenderTimeMeasurement()
+      if self.instrumentationLogFileName:
+        self.writeInstrumentationLog(self.instrumentationLogFileName)
+    progressCallback("Done", 100)
+
+  def waitForFuture(self, future, message, percent, progressCallback):
+    """Returns the result of a worker thread, keeping the application responsive while waiting
+    """
+    while not future.done():
+      progressCallback(message, percent)
+      time.sleep(0.02)
+    return future.result()
+
+  def readRecordingMetafile(self, recordingFile):
+    """Reads everything needed to load the recording with images on demand. Does not touch the scene,
+    so it can run on a worker thread. If the image data is compressed, only the header is read and the
+    transforms are None, as the recording has to be loaded with all images.
+    """
+    if isChunkedRecordingFile(recordingFile):
+      recording = ChunkedRecording(recordingFile, self.maximumNumberOfCachedFrames)
+      if recording.hasImageData:
+        recording.getFrame(0)
+      return recording, recording.getTransforms()
+    metafile = SequenceMetafile(recordingFile, self.maximumNumberOfCachedFrames, readFrameFields=False)
+    if metafile.hasCompressedData:
+      return metafile, None
+    if metafile.hasImageData:
+      metafile.getFrame(0)
+    return metafile, self.readMetafileTransforms(recordingFile)
     
   def loadScene(self, fileName):
     slicer.util.loadScene(fileName)
@@ -225,11 +416,23 @@ class LumpNavReplayLogic(ScriptedLoadableModuleLogic):
     self.cauteryModelNode_CauteryModel = slicer.mrmlScene.GetFirstNodeByName("CauteryModel")
     self.needleModelNode_NeedleModel = slicer.mrmlScene.GetFirstNodeByName("NeedleModel")
 
-  def loadRecordingSequences(self, recordingFile):
+  def loadRecordingSequences(self, recordingFile, loadImagesOnDemand=False, recordingData=None):
     logging.debug("loading \'recording\' sequences")
     recordingFileBaseName = os.path.splitext(os.path.basename(recordingFile))[0]
-    slicer.app.coreIOManager().loadNodes('Sequence Metafile',{'fileName':recordingFile})
-    self.recordingData_browserNode = slicer.mrmlScene.GetFirstNodeByName(recordingFileBaseName)
+    loadImagesOnDemand = loadImagesOnDemand or isChunkedRecordingFile(recordingFile)
+    if loadImagesOnDemand and not recordingData:
+      recordingData = self.readRecordingMetafile(recordingFile)
+    if loadImagesOnDemand and recordingData[1] is None:
+      logging.info("Image data of {0} is compressed, loading all images".format(recordingFile))
+      loadImagesOnDemand = False
+    if loadImagesOnDemand:
+      self.recordingData_metafile, recordingTransforms = recordingData
+      self.recordingData_browserNode = self.createSequencesFromTransforms(recordingTransforms, recordingFileBaseName)
+      self.createImageNodeFromMetafile(self.recordingData_metafile, self.recordingData_browserNode, recordingFileBaseName + "-Image")
+    else:
+      self.recordingData_metafile = None
+      slicer.app.coreIOManager().loadNodes('Sequence Metafile',{'fileName':recordingFile})
+      self.recordingData_browserNode = slicer.mrmlScene.GetFirstNodeByName(recordingFileBaseName)
     self.recordingData_trackerToReferenceNode = self.initializeLinearTransformNode(recordingFileBaseName + "-TrackerToReference")
     self.recordingData_needleToTrackerNode = self.initializeLinearTransformNode(recordingFileBaseName + "-NeedleToTracker")
     self.recordingData_cauteryToTrackerNode = self.initializeLinearTransformNode(recordingFileBaseName + "-CauteryToTracker")
@@ -239,13 +442,23 @@ class LumpNavReplayLogic(ScriptedLoadableModuleLogic):
     self.trackerToReferenceNode = self.recordingData_trackerToReferenceNode
     self.cauteryToTrackerNode = self.recordingData_cauteryToTrackerNode
     self.needleToTrackerNode = self.recordingData_needleToTrackerNode
-    self.setupResliceDriver()
+    with self.getInstrumentation().measureStage("setupResliceDriver"):
+      self.setupResliceDriver()
 
-  def loadTrackingSequences(self, trackingFile):
+  def loadTrackingSequences(self, trackingFile, transformsOnly=True, trackingTransforms=None):
+    """Loads the tracking data set. By default only the transforms in trackingTransformNames are read
+    from the metafile header and any image data in the file is skipped.
+    trackingTransforms can be provided if the header has already been read.
+    """
     logging.debug("loading \'tracking\' sequences")
     trackingFileBaseName = os.path.splitext(os.path.basename(trackingFile))[0]
-    slicer.app.coreIOManager().loadNodes('Sequence Metafile',{'fileName':trackingFile})
-    self.trackingData_browserNode = slicer.mrmlScene.GetFirstNodeByName(trackingFileBaseName)
+    if transformsOnly:
+      if not trackingTransforms:
+        trackingTransforms = self.readMetafileTransforms(trackingFile, self.trackingTransformNames)
+      self.trackingData_browserNode = self.createSequencesFromTransforms(trackingTransforms, trackingFileBaseName)
+    else:
+      slicer.app.coreIOManager().loadNodes('Sequence Metafile',{'fileName':trackingFile})
+      self.trackingData_browserNode = slicer.mrmlScene.GetFirstNodeByName(trackingFileBaseName)
     self.trackingData_trackerToReferenceNode = self.initializeLinearTransformNode(trackingFileBaseName + "-TrackerToReference")
     self.trackingData_needleToTrackerNode = self.initializeLinearTransformNode(trackingFileBaseName + "-NeedleToTracker")
     self.trackingData_cauteryToTrackerNode = self.initializeLinearTransformNode(trackingFileBaseName + "-CauteryToTracker")
@@ -254,22 +467,49 @@ class LumpNavReplayLogic(ScriptedLoadableModuleLogic):
     self.needleToTrackerNode = self.trackingData_needleToTrackerNode
 
   def changeToRecordingData(self):
-    self.trackerToReferenceNode = self.recordingData_trackerToReferenceNode
-    self.cauteryToTrackerNode = self.recordingData_cauteryToTrackerNode
-    self.needleToTrackerNode = self.recordingData_needleToTrackerNode
-    self.updateModelVisibility(inTrackingMode=False)
-    self.setupTransformHierarchy()
-    slicer.modules.sequencebrowser.setToolBarActiveBrowserNode(self.recordingData_browserNode)
-    self.assignSlicerVariables()
+    self.changeToDataset(self.recordingData_trackerToReferenceNode, self.recordingData_cauteryToTrackerNode,
+      self.recordingData_needleToTrackerNode, self.recordingData_browserNode, inTrackingMode=False)
 
   def changeToTrackingData(self):
-    self.trackerToReferenceNode = self.trackingData_trackerToReferenceNode
-    self.cauteryToTrackerNode = self.trackingData_cauteryToTrackerNode
-    self.needleToTrackerNode = self.trackingData_needleToTrackerNode
-    self.updateModelVisibility(inTrackingMode=True)
-    self.setupTransformHierarchy()
-    slicer.modules.sequencebrowser.setToolBarActiveBrowserNode(self.trackingData_browserNode)
-    self.assignSlicerVariables()
+    self.changeToDataset(self.trackingData_trackerToReferenceNode, self.trackingData_cauteryToTrackerNode,
+      self.trackingData_needleToTrackerNode, self.trackingData_browserNode, inTrackingMode=True)
+
+  def changeToDataset(self, trackerToReferenceNode, cauteryToTrackerNode, needleToTrackerNode, browserNode, inTrackingMode):
+    """Makes the transforms of a data set drive the models. Once the hierarchy is set up only the transforms that
+    depend on the tracker are re-pointed, with rendering paused so that the views are updated once.
+    """
+    self.trackerToReferenceNode = trackerToReferenceNode
+    self.cauteryToTrackerNode = cauteryToTrackerNode
+    self.needleToTrackerNode = needleToTrackerNode
+    previousBrowserNode = self.activeBrowserNode
+    self.activeBrowserNode = browserNode
+    # Same as in AutocenterCoordinator, rendering can only be paused if the application supports it
+    pauseRender = hasattr(slicer.app, 'pauseRender')
+    if pauseRender:
+      slicer.app.pauseRender()
+    try:
+      # The transform hierarchy is changed, the world matrix cache of the new data set is started afterwards
+      self.stopWorldMatrixCache()
+      # Continue at the same acquisition time in the new data set
+      if previousBrowserNode and previousBrowserNode != browserNode:
+        previousTimeSeconds = self.getSelectedTime(previousBrowserNode)
+        if previousTimeSeconds is not None:
+          self.selectTime(browserNode, previousTimeSeconds)
+      self.updateModelVisibility(inTrackingMode)
+      if self.transformHierarchyIsSetUp:
+        self.connectTrackerDependentTransforms()
+        self.updateSlicerVariables()
+      else:
+        with self.getInstrumentation().measureStage("setupTransformHierarchy"):
+          self.setupTransformHierarchy()
+        self.assignSlicerVariables()
+      if self.useWorldMatrixCache:
+        with self.getInstrumentation().measureStage("startWorldMatrixCache"):
+          self.startWorldMatrixCache()
+      slicer.modules.sequencebrowser.setToolBarActiveBrowserNode(browserNode)
+    finally:
+      if pauseRender:
+        slicer.app.resumeRender()
 
   def updateModelVisibility(self, inTrackingMode=True):
     inRecordingMode = not inTrackingMode
@@ -279,23 +519,41 @@ class LumpNavReplayLogic(ScriptedLoadableModuleLogic):
   def setupTransformHierarchy(self):
     logging.debug("setting up transform hierarchy")
 
-    self.trackerToReferenceNode.SetAndObserveTransformNodeID(self.referenceToRasNode.GetID())
-    self.cauteryToTrackerNode.SetAndObserveTransformNodeID(self.trackerToReferenceNode.GetID())
-    self.cauteryTipToCauteryNode.SetAndObserveTransformNodeID(self.cauteryToTrackerNode.GetID())
+    # Tracker transforms of both data sets, these links do not change when switching data sets
+    for trackerToReferenceNode, cauteryToTrackerNode, needleToTrackerNode in [
+      (self.recordingData_trackerToReferenceNode, self.recordingData_cauteryToTrackerNode, self.recordingData_needleToTrackerNode),
+      (self.trackingData_trackerToReferenceNode, self.trackingData_cauteryToTrackerNode, self.trackingData_needleToTrackerNode)]:
+      trackerToReferenceNode.SetAndObserveTransformNodeID(self.referenceToRasNode.GetID())
+      cauteryToTrackerNode.SetAndObserveTransformNodeID(trackerToReferenceNode.GetID())
+      needleToTrackerNode.SetAndObserveTransformNodeID(trackerToReferenceNode.GetID())
+
     self.cauteryModelToCauteryTipNode.SetAndObserveTransformNodeID(self.cauteryTipToCauteryNode.GetID())
     self.cauteryModelNode_CauteryModel.SetAndObserveTransformNodeID(self.cauteryModelToCauteryTipNode.GetID())
     
-    self.needleToTrackerNode.SetAndObserveTransformNodeID(self.trackerToReferenceNode.GetID())
-    self.needleTipToNeedleNode.SetAndObserveTransformNodeID(self.needleToTrackerNode.GetID())
     self.needleModelToNeedleTip.SetAndObserveTransformNodeID(self.needleTipToNeedleNode.GetID())
     self.needleModelNode_NeedleModel.SetAndObserveTransformNodeID(self.needleModelToNeedleTip.GetID())
-    self.tumorModelNode_Needle.SetAndObserveTransformNodeID(self.needleToTrackerNode.GetID())
 
-    self.probeToTrackerNode.SetAndObserveTransformNodeID(self.trackerToReferenceNode.GetID())
     self.transducerToProbeNode.SetAndObserveTransformNodeID(self.probeToTrackerNode.GetID())
     self.imageToTransducerNode.SetAndObserveTransformNodeID(self.transducerToProbeNode.GetID())
     if self.imageNode:
       self.imageNode.SetAndObserveTransformNodeID(self.imageToTransducerNode.GetID())
+
+    self.connectTrackerDependentTransforms()
+    self.transformHierarchyIsSetUp = True
+
+  def connectTrackerDependentTransforms(self):
+    """Connects the nodes whose parent depends on the active data set to its tracker transforms.
+    Each re-pointed node invokes its own events, the views are updated once as changeToDataset pauses rendering.
+    """
+    parentNodeIDs = [
+      (self.cauteryTipToCauteryNode, self.cauteryToTrackerNode.GetID()),
+      (self.needleTipToNeedleNode, self.needleToTrackerNode.GetID()),
+      (self.tumorModelNode_Needle, self.needleToTrackerNode.GetID()),
+      (self.probeToTrackerNode, self.trackerToReferenceNode.GetID()),
+      ]
+    for node, parentNodeID in parentNodeIDs:
+      if node.GetTransformNodeID() != parentNodeID:
+        node.SetAndObserveTransformNodeID(parentNodeID)
   
   def assignSlicerVariables(self):
     class empty:
@@ -317,63 +575,368 @@ class LumpNavReplayLogic(ScriptedLoadableModuleLogic):
     slicer.lumpnavreplay.imageToTransducerNode = self.imageToTransducerNode
     if self.imageNode:
       slicer.lumpnavreplay.imageNode = self.imageNode
+
+  def updateSlicerVariables(self):
+    """Updates the data set dependent nodes in slicer.lumpnavreplay, creates it if needed
+    """
+    if not hasattr(slicer, "lumpnavreplay"):
+      self.assignSlicerVariables()
+      return
+    slicer.lumpnavreplay.trackerToReferenceNode = self.trackerToReferenceNode
+    slicer.lumpnavreplay.cauteryToTrackerNode = self.cauteryToTrackerNode
+    slicer.lumpnavreplay.needleToTrackerNode = self.needleToTrackerNode
   
   # Setting autocenter parameters to match LumpNav
   def startAutocenter(self):
-    leftView = slicer.mrmlScene.GetNodeByID('vtkMRMLViewNode1')
-    rightView = slicer.mrmlScene.GetNodeByID('vtkMRMLViewNode2')
-    bottomView = slicer.mrmlScene.GetNodeByID('vtkMRMLViewNode3')
     heightViewCoordLimits = 0.6
     widthViewCoordLimits = 0.9
 
-    leftViewNodeViewpoint = self.viewpointLogic.getViewpointForViewNode(leftView)
-    leftViewNodeViewpoint.setViewNode(leftView)
-    leftViewNodeViewpoint.autoCenterSetSafeXMinimum(-widthViewCoordLimits)
-    leftViewNodeViewpoint.autoCenterSetSafeXMaximum(widthViewCoordLimits)
-    leftViewNodeViewpoint.autoCenterSetSafeYMinimum(-heightViewCoordLimits)
-    leftViewNodeViewpoint.autoCenterSetSafeYMaximum(heightViewCoordLimits)
-    leftViewNodeViewpoint.autoCenterSetModelNode(self.tumorModelNode_Needle)
-    leftViewNodeViewpoint.autoCenterStart()
-
-    rightViewNodeViewpoint = self.viewpointLogic.getViewpointForViewNode(rightView)
-    rightViewNodeViewpoint.setViewNode(rightView)
-    rightViewNodeViewpoint.autoCenterSetSafeXMinimum(-widthViewCoordLimits)
-    rightViewNodeViewpoint.autoCenterSetSafeXMaximum(widthViewCoordLimits)
-    rightViewNodeViewpoint.autoCenterSetSafeYMinimum(-heightViewCoordLimits)
-    rightViewNodeViewpoint.autoCenterSetSafeYMaximum(heightViewCoordLimits)
-    rightViewNodeViewpoint.autoCenterSetModelNode(self.tumorModelNode_Needle)
-    rightViewNodeViewpoint.autoCenterStart()
-
-    # Earlier surgeries did not use Triple 3D view
-    if bottomView :
-      bottomViewNodeViewpoint = self.viewpointLogic.getViewpointForViewNode(bottomView)
-      bottomViewNodeViewpoint.setViewNode(bottomView)
-      bottomViewNodeViewpoint.autoCenterSetSafeXMinimum(-widthViewCoordLimits)
-      bottomViewNodeViewpoint.autoCenterSetSafeXMaximum(widthViewCoordLimits)
-      bottomViewNodeViewpoint.autoCenterSetSafeYMinimum(-heightViewCoordLimits)
-      bottomViewNodeViewpoint.autoCenterSetSafeYMaximum(heightViewCoordLimits)
-      bottomViewNodeViewpoint.autoCenterSetModelNode(self.tumorModelNode_Needle)
-      bottomViewNodeViewpoint.autoCenterStart()
+    # One coordinator centers the tumor in all 3D views (earlier surgeries did not use Triple 3D view)
+    self.stopAutocenter()
+    self.autocenterCoordinator = AutocenterCoordinator(self.tumorModelNode_Needle,
+      -widthViewCoordLimits, widthViewCoordLimits, -heightViewCoordLimits, heightViewCoordLimits,
+      self.autocenterTolerance, self.autocenterMaximumUpdatesPerSecond)
+    self.autocenterCoordinator.start()
 
   def stopAutocenter(self):
-    leftView = slicer.mrmlScene.GetNodeByID('vtkMRMLViewNode1')
-    leftViewNodeViewpoint = self.viewpointLogic.getViewpointForViewNode(leftView)
-    leftViewNodeViewpoint.autoCenterStop()
+    if self.autocenterCoordinator:
+      self.autocenterCoordinator.stop()
+      self.autocenterCoordinator = None
+
+  def startPlayback(self, renderEveryFrame=False, speed=1.0, finishedCallback=None):
+    """Plays the active data set from the selected item to the end, following the recorded timestamps.
+    Items are dropped when rendering is slower than the recording, unless renderEveryFrame is set.
+    The number of rendered and dropped frames is available from playbackScheduler.getStatistics().
+    """
+    self.stopPlayback()
+    self.playbackScheduler = PlaybackScheduler(self.activeBrowserNode, renderEveryFrame, speed, finishedCallback=finishedCallback)
+    self.playbackScheduler.start()
+    return self.playbackScheduler
 
-    rightView = slicer.mrmlScene.GetNodeByID('vtkMRMLViewNode2')
-    rightViewNodeViewpoint = self.viewpointLogic.getViewpointForViewNode(rightView)
-    rightViewNodeViewpoint.autoCenterStop()
+  def stopPlayback(self):
+    if self.playbackScheduler and self.playbackScheduler.playing:
+      self.playbackScheduler.stop()
+      logging.info("Playback statistics: {0}".format(self.playbackScheduler.getStatistics()))
+
+  def getDisplayedNodes(self):
+    return [self.cauteryModelNode_CauteryModel, self.needleModelNode_NeedleModel, self.tumorModelNode_Needle, self.imageNode]
+
+  def setWorldMatrixCacheEnabled(self, enabled):
+    self.useWorldMatrixCache = enabled
+    if not self.activeBrowserNode:
+      return
+    if enabled:
+      self.startWorldMatrixCache()
+    else:
+      self.stopWorldMatrixCache()
+
+  def startWorldMatrixCache(self):
+    """Moves the displayed nodes under transforms that are set to precomputed world matrices on every frame change
+    of the active data set. Matrices read from the sequences are kept for each data set, so switching back and forth
+    between the data sets does not read them again. While the data sets are synchronized the transforms of the other
+    data set follow the items of the active one.
+    """
+    self.stopWorldMatrixCache()
+    browserNodeID = self.activeBrowserNode.GetID()
+    if browserNodeID not in self.worldMatrixCaches:
+      self.worldMatrixCaches[browserNodeID] = WorldMatrixCache(self.activeBrowserNode)
+    self.activeWorldMatrixCache = self.worldMatrixCaches[browserNodeID]
+    synchronizedItemNumbers = {}
+    if self.datasetsSynchronized:
+      otherBrowserNode = self.getOtherBrowserNode(self.activeBrowserNode)
+      synchronizedItemNumbers[otherBrowserNode.GetID()] = self.getClosestItemNumbers(self.activeBrowserNode, otherBrowserNode)
+    self.activeWorldMatrixCache.start(self.getDisplayedNodes(), synchronizedItemNumbers)
 
-    bottomView = slicer.mrmlScene.GetNodeByID('vtkMRMLViewNode3')
-    if bottomView:
-      bottomViewNodeViewpoint = self.viewpointLogic.getViewpointForViewNode(bottomView)
-      bottomViewNodeViewpoint.autoCenterStop()
+  def stopWorldMatrixCache(self):
+    if self.activeWorldMatrixCache:
+      self.activeWorldMatrixCache.stop()
+      self.activeWorldMatrixCache = None
 
   def setupResliceDriver(self):
     sliceNode = slicer.mrmlScene.GetFirstNodeByClass("vtkMRMLSliceNode")
+    if not sliceNode:
+      # No slice views, e.g. when running without a main window
+      return
     imageNode = self.imageNode
     slicer.modules.volumereslicedriver.logic().SetDriverForSlice(imageNode.GetID(),sliceNode)
 
+  def setResliceScrubPreviewEnabled(self, enabled):
+    self.useResliceScrubPreview = enabled
+    if enabled and self.activeBrowserNode:
+      self.startResliceScrubPreview()
+    else:
+      self.stopResliceScrubPreview()
+
+  def getRecordingImagePyramid(self):
+    """Returns the image pyramid of the recording, creates it on first use. Frames of the pyramid are
+    computed when they are shown.
+    """
+    if self.recordingData_imagePyramid is None or self.recordingData_imagePyramid.level != self.resliceScrubPreviewLevel:
+      if self.recordingData_metafile:
+        # Images are loaded on demand, downsample directly from the memory-mapped or chunked file
+        sourceFrames = self.recordingData_metafile.getPixelData()
+      else:
+        sourceFrames = SequenceNodeFrames(self.recordingData_browserNode.GetSequenceNode(self.imageNode))
+      self.recordingData_imagePyramid = ImagePyramid(sourceFrames, self.resliceScrubPreviewLevel)
+    return self.recordingData_imagePyramid
+
+  def startResliceScrubPreview(self):
+    self.stopResliceScrubPreview()
+    if not self.imageNode:
+      return
+    self.resliceScrubPreview = ResliceScrubPreview(self.recordingData_browserNode, self.imageNode, self.getRecordingImagePyramid(),
+      self.resliceScrubPreviewLevel, self.resliceScrubPreviewStableSeconds,
+      self.updateImageFromMetafile if self.recordingData_metafile else None)
+    self.resliceScrubPreview.start()
+
+  def stopResliceScrubPreview(self):
+    if self.resliceScrubPreview:
+      self.resliceScrubPreview.stop()
+      self.resliceScrubPreview = None
+
+  def getInstrumentation(self):
+    if self.instrumentation is None:
+      self.instrumentation = Instrumentation(measureStagePeakMemory=self.instrumentationMeasureStagePeakMemory)
+    return self.instrumentation
+
+  def setInstrumentationEnabled(self, enabled):
+    """Enables recording of stage timing and memory, and of the render time of each frame
+    """
+    self.getInstrumentation().enabled = enabled
+    if enabled and self.activeBrowserNode:
+      self.startRenderTimeMeasurement()
+    else:
+      self.stopRenderTimeMeasurement()
+
+  def writeInstrumentationLog(self, fileName):
+    """Writes the recorded stages and frame render times to a JSON file, or a CSV file if fileName ends with .csv
+    """
+    self.getInstrumentation().writeLog(fileName)
+
+  def startRenderTimeMeasurement(self):
+    """Records the render time of each 3D view with the item number of the active data set
+    """
+    self.stopRenderTimeMeasurement()
+    self.renderStartTimes = {}
+    viewRegistry = getViewRegistry()
+    for viewNode in viewRegistry.getViewNodes():
+      renderWindow = viewRegistry.getThreeDView(viewNode).renderWindow()
+      startObserverTag = renderWindow.AddObserver(vtk.vtkCommand.StartEvent,
+        lambda caller, event, viewNodeID=viewNode.GetID(): self.onRenderStarted(viewNodeID))
+      endObserverTag = renderWindow.AddObserver(vtk.vtkCommand.EndEvent,
+        lambda caller, event, viewNodeID=viewNode.GetID(): self.onRenderEnded(viewNodeID))
+      self.renderTimeObservations.append((renderWindow, startObserverTag))
+      self.renderTimeObservations.append((renderWindow, endObserverTag))
+
+  def stopRenderTimeMeasurement(self):
+    for renderWindow, observerTag in self.renderTimeObservations:
+      renderWindow.RemoveObserver(observerTag)
+    self.renderTimeObservations = []
+
+  def onRenderStarted(self, viewNodeID):
+    self.renderStartTimes[viewNodeID] = time.perf_counter()
+
+  def onRenderEnded(self, viewNodeID):
+    startTime = self.renderStartTimes.pop(viewNodeID, None)
+    if startTime is None or not self.activeBrowserNode:
+      return
+    self.getInstrumentation().recordFrame(viewNodeID, self.activeBrowserNode.GetSelectedItemNumber(), time.perf_counter() - startTime)
+
+  def getActiveBrowserNode(self):
+    return self.activeBrowserNode
+
+  def buildTimestampIndices(self):
+    """Indexes the acquisition times of both data sets so that the same time can be found in the other one
+    """
+    self.recordingData_timestampIndex = TimestampIndex.fromSequenceNode(self.recordingData_browserNode.GetMasterSequenceNode())
+    self.trackingData_timestampIndex = TimestampIndex.fromSequenceNode(self.trackingData_browserNode.GetMasterSequenceNode())
+
+  def getTimestampIndex(self, browserNode):
+    if browserNode == self.trackingData_browserNode:
+      return self.trackingData_timestampIndex
+    return self.recordingData_timestampIndex
+
+  def getSelectedTime(self, browserNode):
+    itemNumber = browserNode.GetSelectedItemNumber()
+    if itemNumber < 0:
+      return None
+    return float(browserNode.GetMasterSequenceNode().GetNthIndexValue(itemNumber))
+
+  def selectTime(self, browserNode, timeSeconds):
+    """Selects the item of the browser that is closest to the given acquisition time
+    """
+    itemNumber = self.getTimestampIndex(browserNode).getItemNumber(timeSeconds)
+    if itemNumber >= 0 and itemNumber != browserNode.GetSelectedItemNumber():
+      browserNode.SetSelectedItemNumber(itemNumber)
+
+  def getOtherBrowserNode(self, browserNode):
+    return self.trackingData_browserNode if browserNode == self.recordingData_browserNode else self.recordingData_browserNode
+
+  def getClosestItemNumbers(self, browserNode, otherBrowserNode):
+    """Returns the item of otherBrowserNode with the closest acquisition time for every item of browserNode,
+    which is the item that synchronization selects
+    """
+    masterSequenceNode = browserNode.GetMasterSequenceNode()
+    timestamps = [float(masterSequenceNode.GetNthIndexValue(itemNumber)) for itemNumber in range(masterSequenceNode.GetNumberOfDataNodes())]
+    return self.getTimestampIndex(otherBrowserNode).getItemNumbers(timestamps)
+
+  def setDatasetsSynchronized(self, synchronized):
+    """When synchronized, every time the active data set moves to a new item the other data set
+    is moved to the item with the closest acquisition time
+    """
+    for browserNode, observerTag in self.synchronizationObservations:
+      browserNode.RemoveObserver(observerTag)
+    self.synchronizationObservations = []
+    synchronizationChanged = synchronized != self.datasetsSynchronized
+    self.datasetsSynchronized = synchronized
+    if synchronizationChanged and self.activeWorldMatrixCache:
+      # Transforms of the other data set become dynamic or static in the cache
+      self.startWorldMatrixCache()
+    if not synchronized:
+      return
+    for browserNode in [self.recordingData_browserNode, self.trackingData_browserNode]:
+      observerTag = browserNode.AddObserver(vtk.vtkCommand.ModifiedEvent, self.onBrowserModifiedSynchronizeDatasets)
+      self.synchronizationObservations.append((browserNode, observerTag))
+    self.onBrowserModifiedSynchronizeDatasets(self.activeBrowserNode, vtk.vtkCommand.ModifiedEvent)
+
+  def onBrowserModifiedSynchronizeDatasets(self, browserNode, event):
+    if self.synchronizingDatasets or browserNode != self.activeBrowserNode:
+      return
+    timeSeconds = self.getSelectedTime(browserNode)
+    if timeSeconds is None:
+      return
+    otherBrowserNode = self.getOtherBrowserNode(browserNode)
+    self.synchronizingDatasets = True
+    try:
+      self.selectTime(otherBrowserNode, timeSeconds)
+    finally:
+      self.synchronizingDatasets = False
+
+  def getDatasetTransformNodes(self, browserNode):
+    """Returns the TrackerToReference, CauteryToTracker and NeedleToTracker proxy nodes of the data set of a browser node
+    """
+    if browserNode == self.trackingData_browserNode:
+      return self.trackingData_trackerToReferenceNode, self.trackingData_cauteryToTrackerNode, self.trackingData_needleToTrackerNode
+    return self.recordingData_trackerToReferenceNode, self.recordingData_cauteryToTrackerNode, self.recordingData_needleToTrackerNode
+
+  def getItemTimes(self, browserNode):
+    masterSequenceNode = browserNode.GetMasterSequenceNode()
+    return numpy.array([float(masterSequenceNode.GetNthIndexValue(itemNumber)) for itemNumber in range(masterSequenceNode.GetNumberOfDataNodes())])
+
+  def computeCauteryTipToTumorDistanceSeries(self, browserNode=None):
+    """Computes the signed distance from the cautery tip to the tumor model surface (negative inside the tumor)
+    for all items of the browser node (active data set by default), without stepping through the items.
+    The transform chains of all items are composed as (N,4,4) matrix products:
+    CauteryTipToCautery, CauteryToTracker, TrackerToReference for the tip and NeedleToTracker, TrackerToReference for the tumor.
+    Returns the time (s) and the distance (mm) of each item as arrays.
+    """
+    if not browserNode:
+      browserNode = self.getActiveBrowserNode()
+    trackerToReferenceNode, cauteryToTrackerNode, needleToTrackerNode = self.getDatasetTransformNodes(browserNode)
+    trackerToReference = getTransformMatrices(browserNode, trackerToReferenceNode)
+    cauteryTipToReference = numpy.matmul(numpy.matmul(trackerToReference, getTransformMatrices(browserNode, cauteryToTrackerNode)),
+      getMatrixToParent(self.cauteryTipToCauteryNode))
+    tumorToReference = numpy.matmul(trackerToReference, getTransformMatrices(browserNode, needleToTrackerNode))
+    # Cautery tip position (origin of CauteryTipToCautery) in tumor model coordinates
+    cauteryTipInTumor = numpy.linalg.solve(tumorToReference, cauteryTipToReference[:, :, 3:4])[:, :3, 0]
+
+    tumorDistance = vtk.vtkImplicitPolyDataDistance()
+    tumorDistance.SetInput(self.tumorModelNode_Needle.GetPolyData())
+    distances = vtk.vtkDoubleArray()
+    distances.SetNumberOfComponents(1)
+    tumorDistance.FunctionValue(numpy_support.numpy_to_vtk(numpy.ascontiguousarray(cauteryTipInTumor), deep=True), distances)
+    return self.getItemTimes(browserNode), numpy_support.vtk_to_numpy(distances).copy()
+
+  def computeCauteryTipToTumorDistances(self, browserNode=None):
+    """Computes the signed distance from the cautery tip to the tumor model surface for all items of the
+    browser node (see computeCauteryTipToTumorDistanceSeries).
+    Returns a list of [index, time (s), distance (mm)] rows.
+    """
+    timesSeconds, distancesMm = self.computeCauteryTipToTumorDistanceSeries(browserNode)
+    return [[itemIndex, timeSeconds, distanceMm] for itemIndex, (timeSeconds, distanceMm) in enumerate(zip(timesSeconds.tolist(), distancesMm.tolist()))]
+
+  def readMetafileTransforms(self, fileName, transformNames=None):
+    if not self.useTransformCache:
+      return readMetafileTransforms(fileName, transformNames)
+    transformCache = TransformCache(self.transformCacheDirectory, self.transformCacheMaximumSizeBytes)
+    return transformCache.readMetafileTransforms(fileName, transformNames)
+
+  def createSequencesFromTransforms(self, metafileTransforms, baseName):
+    """Creates a browser node with one transform sequence per transform read from a metafile header.
+    Proxy nodes are named the same way as by the Sequence Metafile reader (e.g. baseName-ProbeToTracker).
+    """
+    browserNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceBrowserNode", baseName)
+    sequenceNodes = {}
+    for transformName in metafileTransforms.transformNames:
+      sequenceNode = self.createTransformSequence(baseName + "-" + transformName + "-Sequence", metafileTransforms.indexValues,
+        metafileTransforms.matrices[transformName], metafileTransforms.valid[transformName])
+      if not browserNode.GetMasterSequenceNode():
+        browserNode.SetAndObserveMasterSequenceNodeID(sequenceNode.GetID())
+      else:
+        browserNode.AddSynchronizedSequenceNodeID(sequenceNode.GetID())
+      sequenceNodes[transformName] = sequenceNode
+    slicer.modules.sequencebrowser.logic().UpdateProxyNodesFromSequences(browserNode)
+    for transformName, sequenceNode in sequenceNodes.items():
+      browserNode.GetProxyNode(sequenceNode).SetName(baseName + "-" + transformName)
+    return browserNode
+
+  def createTransformSequence(self, name, indexValues, matrices, valid):
+    """Creates a sequence of linear transforms from an (N,4,4) array of matrices.
+    Frames that are not valid show the last valid matrix, as the browser would when they were missing.
+    """
+    lastValidFrameIndices = numpy.maximum.accumulate(numpy.where(valid, numpy.arange(len(valid)), 0))
+    matrices = matrices[lastValidFrameIndices]
+    sequenceNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceNode", name)
+    sequenceNode.SetIndexName("time")
+    sequenceNode.SetIndexUnit("s")
+    sequenceNode.SetIndexType(sequenceNode.NumericIndex)
+    transformNode = slicer.vtkMRMLLinearTransformNode()
+    matrix = vtk.vtkMatrix4x4()
+    for indexValue, frameMatrix in zip(indexValues, matrices):
+      matrix.DeepCopy(frameMatrix.ravel().tolist())
+      transformNode.SetMatrixTransformToParent(matrix)
+      sequenceNode.SetDataNodeAtValue(transformNode, indexValue)
+    return sequenceNode
+
+  def createImageNodeFromMetafile(self, metafile, browserNode, name):
+    """Creates a volume that shows the frame selected in browserNode, read from the memory-mapped metafile
+    or chunked recording
+    """
+    # The frames of the previous image node must not be updated anymore
+    self.removeRecordingBrowserObservations()
+    if not metafile.hasImageData:
+      return None
+    volumeClassName = "vtkMRMLVectorVolumeNode" if len(metafile.frameShape) > 3 else "vtkMRMLScalarVolumeNode"
+    imageNode = slicer.mrmlScene.AddNewNodeByClass(volumeClassName, name)
+    imageNode.SetSpacing(metafile.spacing)
+    imageNode.SetOrigin(metafile.origin)
+    imageNode.SetIJKToRASDirections(metafile.ijkToRasDirections)
+    slicer.util.updateVolumeFromArray(imageNode, metafile.getFrame(0))
+    imageNode.CreateDefaultDisplayNodes()
+    self.displayedFrameIndex = 0
+    observerTag = browserNode.AddObserver(vtk.vtkCommand.ModifiedEvent, self.onRecordingBrowserModified)
+    self.recordingBrowserObservations.append((browserNode, observerTag))
+    return imageNode
+
+  def removeRecordingBrowserObservations(self):
+    for browserNode, observerTag in self.recordingBrowserObservations:
+      browserNode.RemoveObserver(observerTag)
+    self.recordingBrowserObservations = []
+
+  def onRecordingBrowserModified(self, browserNode, event):
+    if self.resliceScrubPreview and self.resliceScrubPreview.update():
+      # Scrubbing, the full resolution image is updated when the selected frame is stable
+      return
+    self.updateImageFromMetafile(browserNode.GetSelectedItemNumber())
+
+  def updateImageFromMetafile(self, frameIndex):
+    if frameIndex == self.displayedFrameIndex or frameIndex < 0 or not self.recordingData_metafile:
+      return
+    self.displayedFrameIndex = frameIndex
+    slicer.util.updateVolumeFromArray(self.imageNode, self.recordingData_metafile.getFrame(frameIndex))
+    if isinstance(self.recordingData_metafile, ChunkedRecording):
+      self.recordingData_metafile.prefetchFrames(frameIndex + 1, self.chunkedRecordingPrefetchFrames)
+
   def initializeLinearTransformNode(self,name):
     logging.debug('initializeLinearTransformNode')
     transformNode = slicer.mrmlScene.GetFirstNodeByName(name)
@@ -400,6 +963,335 @@ class LumpNavReplayTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_LumpNavReplay1()
+    self.setUp()
+    self.test_LumpNavReplayCompressedRecording()
+    self.setUp()
+    self.test_LumpNavReplayImageGeometry()
+    self.setUp()
+    self.test_LumpNavReplayTransformCache()
+    self.setUp()
+    self.test_LumpNavReplayToolTumorDistances()
+    self.setUp()
+    self.test_LumpNavReplayWorldMatrixCache()
+    self.setUp()
+    self.test_LumpNavReplayResliceScrubPreview()
+    self.setUp()
+    self.test_LumpNavReplayPlayback()
+    self.setUp()
+    self.test_LumpNavReplayChunkedRecording()
+    self.setUp()
+    self.test_LumpNavReplayBenchmarkComparison()
 
   def test_LumpNavReplay1(self):
-    self.delayDisplay('No tests implemented yet!')
+    """Loads a synthetic case and switches between the data sets
+    """
+    from LumpNavReplayLib.SyntheticDataset import generateCase
+    self.delayDisplay("Generating synthetic case")
+    case = generateCase(os.path.join(slicer.app.temporaryPath, "LumpNavReplayTest"), "TestCase", numberOfRecordingFrames=30, imageSize=(64, 48))
+
+    logic = LumpNavReplayLogic()
+    logic.loadAllData(case["TransducerToProbeFile"], case["SceneFile"], case["RecordingFile"], case["TrackingFile"], False)
+    self.assertIsNotNone(logic.tumorModelNode_Needle)
+    self.assertEqual(logic.recordingData_browserNode.GetNumberOfItems(), 30)
+    self.assertEqual(logic.trackingData_browserNode.GetNumberOfItems(), 60)
+    self.assertEqual(logic.getActiveBrowserNode(), logic.recordingData_browserNode)
+
+    logic.recordingData_browserNode.SetSelectedItemNumber(10)
+    recordingTimeSeconds = logic.getSelectedTime(logic.recordingData_browserNode)
+    logic.changeToTrackingData()
+    self.assertEqual(logic.getActiveBrowserNode(), logic.trackingData_browserNode)
+    self.assertAlmostEqual(logic.getSelectedTime(logic.trackingData_browserNode), recordingTimeSeconds, places=3)
+    self.assertEqual(logic.tumorModelNode_Needle.GetTransformNodeID(), logic.trackingData_needleToTrackerNode.GetID())
+
+    logic.setDatasetsSynchronized(True)
+    closestItemNumbers = logic.getClosestItemNumbers(logic.trackingData_browserNode, logic.recordingData_browserNode)
+    self.assertEqual(len(closestItemNumbers), 60)
+    for itemNumber in [0, 1, 25, 59]:
+      logic.trackingData_browserNode.SetSelectedItemNumber(itemNumber)
+      self.assertEqual(logic.recordingData_browserNode.GetSelectedItemNumber(), closestItemNumbers[itemNumber])
+    logic.setDatasetsSynchronized(False)
+    self.delayDisplay('Test passed!')
+
+  def test_LumpNavReplayCompressedRecording(self):
+    """Loads a recording with compressed image data with images on demand, which falls back to loading all images
+    """
+    from LumpNavReplayLib.SyntheticDataset import generateCase
+    self.delayDisplay("Generating synthetic case")
+    case = generateCase(os.path.join(slicer.app.temporaryPath, "LumpNavReplayTest"), "CompressedCase", numberOfRecordingFrames=30,
+      imageSize=(64, 48), compressRecording=True)
+
+    logic = LumpNavReplayLogic()
+    logic.loadAllData(case["TransducerToProbeFile"], case["SceneFile"], case["RecordingFile"], case["TrackingFile"], False, loadImagesOnDemand=True)
+    self.assertIsNone(logic.recordingData_metafile)
+    self.assertEqual(logic.recordingData_browserNode.GetNumberOfItems(), 30)
+    self.assertIsNotNone(logic.recordingData_browserNode.GetSequenceNode(logic.imageNode))
+    self.delayDisplay('Test passed!')
+
+  def test_LumpNavReplayImageGeometry(self):
+    """Checks that a recording with a non-identity image geometry gets the same image geometry when loaded
+    with images on demand, from the metafile and from a chunked recording, as when loaded with all images
+    """
+    from LumpNavReplayLib.ChunkedRecording import convertMetafile
+    from LumpNavReplayLib.SyntheticDataset import generateCase
+    self.delayDisplay("Generating synthetic case")
+    imageDirections = [[0.0, -1.0, 0.0], [1.0, 0.0, 0.0], [0.0, 0.0, 1.0]]
+    case = generateCase(os.path.join(slicer.app.temporaryPath, "LumpNavReplayTest"), "GeometryCase", numberOfRecordingFrames=10,
+      imageSize=(64, 48), imageOffset=(12.5, -20.0, 31.0), imageDirections=imageDirections)
+    chunkedRecordingFile = convertMetafile(case["RecordingFile"])
+
+    logic = LumpNavReplayLogic()
+    logic.loadAllData(case["TransducerToProbeFile"], case["SceneFile"], case["RecordingFile"], case["TrackingFile"], False)
+    self.assertIsNone(logic.recordingData_metafile)
+    expectedIjkToRas = vtk.vtkMatrix4x4()
+    logic.imageNode.GetIJKToRASMatrix(expectedIjkToRas)
+    self.assertFalse(numpy.allclose(slicer.util.arrayFromVTKMatrix(expectedIjkToRas), numpy.eye(4)))
+
+    for recordingFile in [case["RecordingFile"], chunkedRecordingFile]:
+      logic.loadAllData(case["TransducerToProbeFile"], case["SceneFile"], recordingFile, case["TrackingFile"], False, loadImagesOnDemand=True)
+      self.assertIsNotNone(logic.recordingData_metafile)
+      self.assertEqual(len(logic.recordingBrowserObservations), 1)
+      ijkToRas = vtk.vtkMatrix4x4()
+      logic.imageNode.GetIJKToRASMatrix(ijkToRas)
+      self.assertTrue(numpy.allclose(slicer.util.arrayFromVTKMatrix(ijkToRas), slicer.util.arrayFromVTKMatrix(expectedIjkToRas), atol=1e-4))
+    logic.recordingData_metafile.close()
+    self.delayDisplay('Test passed!')
+
+  def test_LumpNavReplayTransformCache(self):
+    """Checks that transforms served from the cache are the same, in the same order, as transforms read from the file
+    """
+    from LumpNavReplayLib.SyntheticDataset import generateCase
+    from LumpNavReplayLib.SequenceMetafile import readMetafileTransforms
+    self.delayDisplay("Generating synthetic case")
+    case = generateCase(os.path.join(slicer.app.temporaryPath, "LumpNavReplayTest"), "TestCase", numberOfRecordingFrames=30, imageSize=(64, 48))
+    cacheDirectory = os.path.join(slicer.app.temporaryPath, "LumpNavReplayTest", "TransformCache")
+    for entryName in (os.listdir(cacheDirectory) if os.path.isdir(cacheDirectory) else []):
+      os.remove(os.path.join(cacheDirectory, entryName))
+    transformCache = TransformCache(cacheDirectory)
+    trackingFile = case["TrackingFile"]
+
+    # A transform that is not in the file is left out, also when served from the cache
+    transformNames = ["CauteryToTracker", "MissingToTracker", "TrackerToReference"]
+    coldTransforms = transformCache.readMetafileTransforms(trackingFile, transformNames)
+    warmTransforms = transformCache.load(trackingFile, transformNames)
+    self.assertIsNotNone(warmTransforms)
+    self.assertEqual(warmTransforms.transformNames, coldTransforms.transformNames)
+    self.assertEqual(warmTransforms.transformNames, readMetafileTransforms(trackingFile, transformNames).transformNames)
+    for transformName in coldTransforms.transformNames:
+      self.assertTrue(numpy.array_equal(warmTransforms.matrices[transformName], coldTransforms.matrices[transformName]))
+    self.assertIsNotNone(transformCache.load(trackingFile, ["CauteryToTracker"]))
+    # The entry was written for a subset, it cannot serve other transforms
+    self.assertIsNone(transformCache.load(trackingFile, ["NeedleToTracker"]))
+    self.assertIsNone(transformCache.load(trackingFile))
+
+    allTransforms = transformCache.readMetafileTransforms(trackingFile)
+    self.assertEqual(transformCache.load(trackingFile).transformNames, allTransforms.transformNames)
+    self.assertEqual([entryName for entryName in os.listdir(cacheDirectory) if not entryName.endswith(".transforms.npz")], [])
+    self.delayDisplay('Test passed!')
+
+  def test_LumpNavReplayToolTumorDistances(self):
+    """Compares the cautery tip to tumor distances computed for all items at once with distances computed
+    from the transform hierarchy after selecting each item
+    """
+    from LumpNavReplayLib.SyntheticDataset import generateCase
+    self.delayDisplay("Generating synthetic case")
+    case = generateCase(os.path.join(slicer.app.temporaryPath, "LumpNavReplayTest"), "TestCase", numberOfRecordingFrames=30, imageSize=(64, 48))
+
+    logic = LumpNavReplayLogic()
+    logic.loadAllData(case["TransducerToProbeFile"], case["SceneFile"], case["RecordingFile"], case["TrackingFile"], False)
+    for browserNode in [logic.recordingData_browserNode, logic.trackingData_browserNode]:
+      if browserNode == logic.trackingData_browserNode:
+        logic.changeToTrackingData()
+      timesSeconds, distancesMm = logic.computeCauteryTipToTumorDistanceSeries(browserNode)
+      self.assertEqual(len(distancesMm), browserNode.GetNumberOfItems())
+
+      tumorDistance = vtk.vtkImplicitPolyDataDistance()
+      tumorDistance.SetInput(logic.tumorModelNode_Needle.GetPolyData())
+      cauteryTipToTumorTransform = vtk.vtkGeneralTransform()
+      for itemNumber in range(0, browserNode.GetNumberOfItems(), 7):
+        browserNode.SetSelectedItemNumber(itemNumber)
+        slicer.vtkMRMLTransformNode.GetTransformBetweenNodes(logic.cauteryTipToCauteryNode,
+          logic.tumorModelNode_Needle.GetParentTransformNode(), cauteryTipToTumorTransform)
+        expectedDistanceMm = tumorDistance.EvaluateFunction(cauteryTipToTumorTransform.TransformPoint([0, 0, 0]))
+        self.assertAlmostEqual(distancesMm[itemNumber], expectedDistanceMm, places=3)
+        self.assertAlmostEqual(timesSeconds[itemNumber], logic.getSelectedTime(browserNode))
+    self.delayDisplay('Test passed!')
+
+  def test_LumpNavReplayWorldMatrixCache(self):
+    """Checks that the displayed nodes are at the same place with and without the world matrix cache,
+    also after a calibration transform is changed
+    """
+    from LumpNavReplayLib.SyntheticDataset import generateCase
+    self.delayDisplay("Generating synthetic case")
+    case = generateCase(os.path.join(slicer.app.temporaryPath, "LumpNavReplayTest"), "TestCase", numberOfRecordingFrames=30, imageSize=(64, 48))
+
+    logic = LumpNavReplayLogic()
+    logic.loadAllData(case["TransducerToProbeFile"], case["SceneFile"], case["RecordingFile"], case["TrackingFile"], False)
+    browserNode = logic.getActiveBrowserNode()
+    itemNumbers = [0, 7, 15, 29]
+
+    def getWorldMatrices():
+      worldMatrices = []
+      matrix = vtk.vtkMatrix4x4()
+      for itemNumber in itemNumbers:
+        browserNode.SetSelectedItemNumber(itemNumber)
+        for displayedNode in logic.getDisplayedNodes():
+          displayedNode.GetParentTransformNode().GetMatrixTransformToWorld(matrix)
+          worldMatrices.append(slicer.util.arrayFromVTKMatrix(matrix))
+      return numpy.array(worldMatrices)
+
+    expectedWorldMatrices = getWorldMatrices()
+    logic.setWorldMatrixCacheEnabled(True)
+    worldMatrixCache = logic.activeWorldMatrixCache
+    self.assertEqual(len(worldMatrixCache.displayedNodes), len(logic.getDisplayedNodes()))
+    self.assertTrue(numpy.allclose(getWorldMatrices(), expectedWorldMatrices))
+    self.assertEqual(worldMatrixCache.numberOfComposes, 1)
+
+    cauteryTipToCautery = slicer.util.arrayFromTransformMatrix(logic.cauteryTipToCauteryNode)
+    cauteryTipToCautery[:3, 3] += [1.0, 2.0, 3.0]
+    slicer.util.updateTransformMatrixFromArray(logic.cauteryTipToCauteryNode, cauteryTipToCautery)
+    cachedWorldMatrices = getWorldMatrices()
+    self.assertEqual(worldMatrixCache.numberOfComposes, 2)
+    logic.setWorldMatrixCacheEnabled(False)
+    self.assertEqual(logic.tumorModelNode_Needle.GetTransformNodeID(), logic.recordingData_needleToTrackerNode.GetID())
+    self.assertTrue(numpy.allclose(cachedWorldMatrices, getWorldMatrices()))
+
+    # Synchronized: the recording transforms in the image chain follow the tracking data set and are not static
+    logic.changeToTrackingData()
+    logic.setDatasetsSynchronized(True)
+    browserNode = logic.getActiveBrowserNode()
+    itemNumbers = [0, 1, 2, 3, 30, 59]
+    expectedWorldMatrices = getWorldMatrices()
+    logic.setWorldMatrixCacheEnabled(True)
+    worldMatrixCache = logic.activeWorldMatrixCache
+    self.assertTrue(numpy.allclose(getWorldMatrices(), expectedWorldMatrices))
+    self.assertEqual(worldMatrixCache.numberOfComposes, 1)
+    logic.setWorldMatrixCacheEnabled(False)
+    logic.setDatasetsSynchronized(False)
+    self.delayDisplay('Test passed!')
+
+  def test_LumpNavReplayResliceScrubPreview(self):
+    """Scrubs through the recording with images loaded on demand and checks that the preview is shown
+    while scrubbing and the full resolution image when the frame is stable
+    """
+    from LumpNavReplayLib.SyntheticDataset import generateCase
+    self.delayDisplay("Generating synthetic case")
+    case = generateCase(os.path.join(slicer.app.temporaryPath, "LumpNavReplayTest"), "TestCase", numberOfRecordingFrames=30, imageSize=(64, 48))
+
+    logic = LumpNavReplayLogic()
+    # Long stable interval, so that the frame changes below are always within it
+    logic.resliceScrubPreviewStableSeconds = 10.0
+    logic.loadAllData(case["TransducerToProbeFile"], case["SceneFile"], case["RecordingFile"], case["TrackingFile"], False, loadImagesOnDemand=True)
+    logic.setResliceScrubPreviewEnabled(True)
+    resliceScrubPreview = logic.resliceScrubPreview
+    browserNode = logic.recordingData_browserNode
+    browserNode.SetSelectedItemNumber(1)
+    self.assertFalse(resliceScrubPreview.previewShown)
+    for itemNumber in [2, 3, 4]:
+      browserNode.SetSelectedItemNumber(itemNumber)
+    self.assertTrue(resliceScrubPreview.previewShown)
+    self.assertEqual(resliceScrubPreview.numberOfPreviewFrames, 3)
+    self.assertEqual(logic.displayedFrameIndex, 1)
+    self.assertTrue(numpy.array_equal(slicer.util.arrayFromVolume(resliceScrubPreview.previewNode),
+      resliceScrubPreview.pyramid.getFrame(4, logic.resliceScrubPreviewLevel)))
+    # Only the chunk of the shown frames is downsampled
+    self.assertEqual(resliceScrubPreview.pyramid.numberOfComputedChunks, 1)
+
+    resliceScrubPreview.onFrameStable()
+    self.assertFalse(resliceScrubPreview.previewShown)
+    self.assertTrue(numpy.array_equal(slicer.util.arrayFromVolume(logic.imageNode), logic.recordingData_metafile.getFrame(4)))
+    logic.setResliceScrubPreviewEnabled(False)
+    self.assertIsNone(slicer.mrmlScene.GetFirstNodeByName(logic.imageNode.GetName() + "-Preview"))
+    self.delayDisplay('Test passed!')
+
+  def test_LumpNavReplayChunkedRecording(self):
+    """Converts the recording to a chunked recording, checks that it contains the same frames and transforms
+    as the metafile and that it is loaded and played with images decompressed in the background
+    """
+    from LumpNavReplayLib.ChunkedRecording import convertMetafile
+    from LumpNavReplayLib.SyntheticDataset import generateCase
+    self.delayDisplay("Generating synthetic case")
+    case = generateCase(os.path.join(slicer.app.temporaryPath, "LumpNavReplayTest"), "TestCase", numberOfRecordingFrames=30, imageSize=(64, 48))
+    chunkedRecordingFile = convertMetafile(case["RecordingFile"], compression="lzma", framesPerChunk=4)
+
+    recording = ChunkedRecording(chunkedRecordingFile)
+    metafile = SequenceMetafile(case["RecordingFile"])
+    self.assertEqual(recording.numberOfFrames, metafile.numberOfFrames)
+    for frameIndex in [0, 5, 29, 4, 3]:
+      self.assertTrue(numpy.array_equal(recording.getFrame(frameIndex), metafile.getFrame(frameIndex)))
+    # Frames 3, 4 and 5 are in chunks 0 and 1, which are still cached
+    self.assertEqual(recording.numberOfDecompressedChunks, 3)
+    transforms = recording.getTransforms()
+    metafileTransforms = metafile.getTransforms()
+    self.assertEqual(transforms.indexValues, metafileTransforms.indexValues)
+    for transformName in metafileTransforms.transformNames:
+      self.assertTrue(numpy.array_equal(transforms.matrices[transformName], metafileTransforms.matrices[transformName]))
+      self.assertTrue(numpy.array_equal(transforms.valid[transformName], metafileTransforms.valid[transformName]))
+    recording.close()
+
+    logic = LumpNavReplayLogic()
+    logic.loadAllData(case["TransducerToProbeFile"], case["SceneFile"], chunkedRecordingFile, case["TrackingFile"], False)
+    self.assertIsInstance(logic.recordingData_metafile, ChunkedRecording)
+    browserNode = logic.recordingData_browserNode
+    self.assertEqual(browserNode.GetNumberOfItems(), metafile.numberOfFrames)
+    for itemNumber in range(1, 12):
+      browserNode.SetSelectedItemNumber(itemNumber)
+      self.assertTrue(numpy.array_equal(slicer.util.arrayFromVolume(logic.imageNode), metafile.getFrame(itemNumber)))
+    self.assertGreater(logic.recordingData_metafile.numberOfPrefetchedChunks, 0)
+    self.delayDisplay('Test passed!')
+
+  def test_LumpNavReplayPlayback(self):
+    """Plays the recording with every frame rendered, then fast enough that frames have to be dropped
+    """
+    from LumpNavReplayLib.SyntheticDataset import generateCase
+    self.delayDisplay("Generating synthetic case")
+    case = generateCase(os.path.join(slicer.app.temporaryPath, "LumpNavReplayTest"), "TestCase", numberOfRecordingFrames=30, imageSize=(64, 48))
+
+    logic = LumpNavReplayLogic()
+    logic.loadAllData(case["TransducerToProbeFile"], case["SceneFile"], case["RecordingFile"], case["TrackingFile"], False)
+    browserNode = logic.getActiveBrowserNode()
+    numberOfItems = browserNode.GetNumberOfItems()
+
+    def play(renderEveryFrame, speed):
+      browserNode.SetSelectedItemNumber(0)
+      playbackScheduler = logic.startPlayback(renderEveryFrame, speed)
+      startTime = time.time()
+      while playbackScheduler.playing and time.time() - startTime < 60.0:
+        slicer.app.processEvents()
+      self.assertFalse(playbackScheduler.playing)
+      self.assertEqual(browserNode.GetSelectedItemNumber(), numberOfItems - 1)
+      self.assertEqual(playbackScheduler.numberOfRenderedFrames + playbackScheduler.numberOfDroppedFrames, numberOfItems)
+      return playbackScheduler
+
+    playbackScheduler = play(renderEveryFrame=True, speed=1.0)
+    self.assertEqual(playbackScheduler.numberOfDroppedFrames, 0)
+    # Whole recording (2 seconds) in a few milliseconds
+    playbackScheduler = play(renderEveryFrame=False, speed=1000.0)
+    self.assertGreater(playbackScheduler.numberOfDroppedFrames, 0)
+    self.delayDisplay('Test passed!')
+
+  def test_LumpNavReplayBenchmarkComparison(self):
+    """Every benchmark of the baseline that is two times slower is reported, also the times of single operations
+    """
+    from LumpNavReplayLib import Benchmark
+    baseline = Benchmark.readBaseline(Benchmark.DEFAULT_BASELINE_FILE)
+    self.assertIsNotNone(baseline, "No benchmark baseline at " + Benchmark.DEFAULT_BASELINE_FILE)
+    self.assertEqual(Benchmark.compareWithBaseline(baseline, baseline), [])
+    slowerResults = dict((sizeName, dict((benchmarkName, 2.0 * seconds) for benchmarkName, seconds in sizeResults.items()))
+      for sizeName, sizeResults in baseline.items())
+    regressions = Benchmark.compareWithBaseline(slowerResults, baseline)
+    self.assertEqual(len(regressions), sum(len(sizeResults) for sizeResults in baseline.values()))
+    self.delayDisplay('Test passed!')
+
+  def test_LumpNavReplayBenchmark(self):
+    """Runs the benchmarks on the small synthetic case and compares them to the stored baseline.
+    Timings depend on the load of the computer, so this test is not part of runTest, run it explicitly.
+    """
+    from LumpNavReplayLib import Benchmark
+    baseline = Benchmark.readBaseline(Benchmark.DEFAULT_BASELINE_FILE)
+    self.assertIsNotNone(baseline, "No benchmark baseline at " + Benchmark.DEFAULT_BASELINE_FILE)
+    self.delayDisplay("Running benchmarks")
+    results = Benchmark.runBenchmarks(os.path.join(slicer.app.temporaryPath, "LumpNavReplayBenchmark"), ["small"], repetitions=3)
+    logging.info("\n" + Benchmark.formatResults(results))
+    regressions = Benchmark.compareWithBaseline(results, baseline)
+    self.assertEqual(regressions, [])
+    self.delayDisplay('Test passed!')
@@ -0,0 +1,129 @@
+"""Keeps a model inside a safe region of all 3D views while the tracked tools move.
+
+The coordinator replaces one independent auto-centering per view. It observes the transforms of the
+model and, at most maximumUpdatesPerSecond times per second, projects the corners of the RAS bounding
+box of the model into each view. Cameras are moved only in the views where the projection has left the
+safe region by more than the tolerance, and all camera changes of an update are made while rendering
+is paused, so the views are rendered once per update and not once per camera.
+"""
+
+import time
+
+import numpy
+import qt
+import slicer
+
+from LumpNavReplayLib.ViewRegistry import getViewRegistry
+
+
+class AutocenterCoordinator(object):
+
+  def __init__(self, modelNode, safeXMinimum=-0.9, safeXMaximum=0.9, safeYMinimum=-0.6, safeYMaximum=0.6,
+               tolerance=0.05, maximumUpdatesPerSecond=10.0):
+    self.modelNode = modelNode
+    self.safeXMinimum = safeXMinimum
+    self.safeXMaximum = safeXMaximum
+    self.safeYMinimum = safeYMinimum
+    self.safeYMaximum = safeYMaximum
+    self.tolerance = tolerance
+    self.maximumUpdatesPerSecond = maximumUpdatesPerSecond
+    self.lastUpdateTime = None
+    self.modelObservation = None
+    # Counters for checking how much work the coordinator saves
+    self.numberOfRequests = 0
+    self.numberOfUpdates = 0
+    self.numberOfCameraUpdates = 0
+    self.deferredUpdateTimer = qt.QTimer()
+    self.deferredUpdateTimer.setSingleShot(True)
+    self.deferredUpdateTimer.connect('timeout()', self.update)
+
+  def start(self):
+    self.stop()
+    if not self.modelNode:
+      return
+    # Invoked when any transform above the model changes, i.e. on every tracker update
+    self.modelObservation = self.modelNode.AddObserver(slicer.vtkMRMLTransformableNode.TransformModifiedEvent, self.onModelMoved)
+    self.update()
+
+  def stop(self):
+    self.deferredUpdateTimer.stop()
+    if self.modelObservation is not None:
+      self.modelNode.RemoveObserver(self.modelObservation)
+      self.modelObservation = None
+
+  def onModelMoved(self, caller=None, event=None):
+    self.requestUpdate()
+
+  def requestUpdate(self):
+    """Updates the cameras now, or later if the last update was too recent. Requests that arrive
+    while an update is deferred are merged into that update.
+    """
+    self.numberOfRequests += 1
+    if self.deferredUpdateTimer.isActive():
+      return
+    minimumIntervalSeconds = 1.0 / self.maximumUpdatesPerSecond if self.maximumUpdatesPerSecond > 0 else 0.0
+    if self.lastUpdateTime is not None:
+      secondsSinceLastUpdate = time.time() - self.lastUpdateTime
+      if secondsSinceLastUpdate < minimumIntervalSeconds:
+        self.deferredUpdateTimer.start(int(1000 * (minimumIntervalSeconds - secondsSinceLastUpdate)))
+        return
+    self.update()
+
+  def update(self):
+    self.lastUpdateTime = time.time()
+    self.numberOfUpdates += 1
+    modelBounds = [0.0] * 6
+    self.modelNode.GetRASBounds(modelBounds)
+    if modelBounds[0] > modelBounds[1]:
+      # Empty model
+      return
+    cornersRas = numpy.array([[x, y, z] for x in modelBounds[0:2] for y in modelBounds[2:4] for z in modelBounds[4:6]])
+    modelCenterRas = cornersRas.mean(axis=0)
+    viewRegistry = getViewRegistry()
+    viewNodesToCenter = []
+    for viewNode in viewRegistry.getViewNodes():
+      renderer = viewRegistry.getRenderer(viewNode)
+      if renderer and not self.isInSafeRegion(renderer, cornersRas):
+        viewNodesToCenter.append(viewNode)
+    if not viewNodesToCenter:
+      return
+    pauseRender = hasattr(slicer.app, 'pauseRender')
+    if pauseRender:
+      slicer.app.pauseRender()
+    try:
+      for viewNode in viewNodesToCenter:
+        self.centerCamera(viewRegistry.getCameraNode(viewNode), viewRegistry.getRenderer(viewNode), modelCenterRas)
+    finally:
+      if pauseRender:
+        slicer.app.resumeRender()
+
+  def isInSafeRegion(self, renderer, pointsRas):
+    """Returns True if the projection of all points is inside the safe region (extended by the tolerance)
+    """
+    camera = renderer.GetActiveCamera()
+    worldToViewVtkMatrix = camera.GetCompositeProjectionTransformMatrix(renderer.GetTiledAspectRatio(), 0, 1)
+    worldToView = slicer.util.arrayFromVTKMatrix(worldToViewVtkMatrix)
+    pointsView = pointsRas.dot(worldToView[:3, :3].T) + worldToView[:3, 3]
+    w = pointsRas.dot(worldToView[3, :3]) + worldToView[3, 3]
+    if numpy.any(w <= 0.0):
+      # Some points are behind the camera
+      return False
+    pointsView /= w[:, numpy.newaxis]
+    return (pointsView[:, 0].min() >= self.safeXMinimum - self.tolerance
+      and pointsView[:, 0].max() <= self.safeXMaximum + self.tolerance
+      and pointsView[:, 1].min() >= self.safeYMinimum - self.tolerance
+      and pointsView[:, 1].max() <= self.safeYMaximum + self.tolerance)
+
+  def centerCamera(self, cameraNode, renderer, centerRas):
+    """Translates the camera so that its focal point is at centerRas, keeping the viewing direction and distance
+    """
+    if not cameraNode:
+      return
+    focalPoint = numpy.array(cameraNode.GetFocalPoint())
+    translation = numpy.asarray(centerRas) - focalPoint
+    wasModifying = cameraNode.StartModify()
+    cameraNode.SetFocalPoint(*(focalPoint + translation))
+    cameraNode.SetPosition(*(numpy.array(cameraNode.GetPosition()) + translation))
+    cameraNode.EndModify(wasModifying)
+    renderer.ResetCameraClippingRange()
+    self.numberOfCameraUpdates += 1
@@ -0,0 +1,268 @@
+"""Batch replay of recorded LumpNav cases, one headless Slicer process per case.
+
+Usage (from any Python, e.g. Slicer's PythonSlicer):
+
+  python BatchReplay.py --slicer /path/to/Slicer --manifest cases.csv --output results --analysis viewextents --jobs 4
+
+The manifest is a CSV file with the columns Case, TransducerToProbeFile, SceneFile, RecordingFile and TrackingFile.
+Relative paths are resolved against the folder of the manifest.
+
+Each case is loaded by LumpNavReplayLogic.loadAllData in its own "Slicer --no-main-window" worker process.
+Rows of all cases are merged into <output>/results.csv (with a leading Case column) and one line per case
+is written to <output>/summary.csv with the status, timing and error message of the case.
+Case names must be unique, characters that are not allowed in file names are replaced in the names of the
+per-case output files.
+"""
+
+import argparse
+import csv
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+MANIFEST_COLUMNS = ["Case", "TransducerToProbeFile", "SceneFile", "RecordingFile", "TrackingFile"]
+SUMMARY_COLUMNS = ["Case", "Status", "WallTimeSeconds", "LoadTimeSeconds", "AnalysisTimeSeconds", "NumberOfRows", "Error"]
+
+VIEW_EXTENTS_ANALYSIS = "viewextents"
+TOOL_TUMOR_DISTANCE_ANALYSIS = "tooltumordistance"
+ANALYSES = [VIEW_EXTENTS_ANALYSIS, TOOL_TUMOR_DISTANCE_ANALYSIS]
+
+STATUS_SUCCEEDED = "succeeded"
+STATUS_FAILED = "failed"
+STATUS_TIMEOUT = "timeout"
+
+UNSAFE_FILE_NAME_CHARACTERS = re.compile(r"[^A-Za-z0-9_.-]")
+
+
+def getSafeFileName(caseName):
+  """Returns the case name with all characters but letters, digits, '_', '.' and '-' replaced by '_'
+  """
+  safeFileName = UNSAFE_FILE_NAME_CHARACTERS.sub("_", caseName)
+  if safeFileName.strip(".") == "":
+    safeFileName = safeFileName.replace(".", "_")
+  return safeFileName
+
+
+def readManifest(manifestFileName):
+  """Returns the list of cases in the manifest, each case is a dictionary keyed by MANIFEST_COLUMNS.
+  Raises ValueError if two cases have the same name or would have the same output files.
+  """
+  manifestDirectory = os.path.dirname(os.path.abspath(manifestFileName))
+  cases = []
+  # Output file names are compared case-insensitively, as they may be on a case-insensitive file system
+  caseNamesByFileName = {}
+  with open(manifestFileName) as manifestFile:
+    for row in csv.DictReader(manifestFile):
+      missingColumns = [column for column in MANIFEST_COLUMNS if not row.get(column)]
+      if missingColumns:
+        raise ValueError("Case {0} in {1} is missing {2}".format(row.get("Case"), manifestFileName, ", ".join(missingColumns)))
+      fileName = getSafeFileName(row["Case"]).lower()
+      if fileName in caseNamesByFileName:
+        raise ValueError("Cases {0} and {1} in {2} have the same name or output file name".format(
+          caseNamesByFileName[fileName], row["Case"], manifestFileName))
+      caseNamesByFileName[fileName] = row["Case"]
+      case = {"Case": row["Case"]}
+      for column in MANIFEST_COLUMNS[1:]:
+        case[column] = os.path.join(manifestDirectory, row[column])
+      cases.append(case)
+  return cases
+
+
+def getCaseFileNames(outputDirectory, caseName):
+  caseDirectory = os.path.join(outputDirectory, "cases")
+  safeFileName = getSafeFileName(caseName)
+  return os.path.join(caseDirectory, safeFileName + ".csv"), os.path.join(caseDirectory, safeFileName + ".json")
+
+
+def runCase(slicerExecutable, case, analysis, outputDirectory, timeoutSeconds=None, workerArguments=None):
+  """Runs one case in a new headless Slicer process and returns its summary row
+  """
+  resultFileName, statusFileName = getCaseFileNames(outputDirectory, case["Case"])
+  for fileName in [resultFileName, statusFileName]:
+    if os.path.exists(fileName):
+      os.remove(fileName)
+  command = [slicerExecutable, "--no-main-window", "--no-splash", "--python-script", os.path.abspath(__file__),
+    "--worker", "--analysis", analysis, "--result", resultFileName, "--status", statusFileName]
+  for column in MANIFEST_COLUMNS[1:]:
+    command += ["--" + column, case[column]]
+  if workerArguments:
+    command += workerArguments
+
+  summary = {"Case": case["Case"], "Status": STATUS_FAILED, "LoadTimeSeconds": "", "AnalysisTimeSeconds": "", "NumberOfRows": 0, "Error": ""}
+  startTime = time.time()
+  try:
+    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=timeoutSeconds)
+    output = process.stdout.decode("utf-8", "replace")
+    if os.path.exists(statusFileName):
+      with open(statusFileName) as statusFile:
+        summary.update(json.load(statusFile))
+    else:
+      # Worker died before it could report, keep the end of its output for diagnosis
+      summary["Error"] = "Worker exited with code {0}: {1}".format(process.returncode, output[-2000:])
+  except subprocess.TimeoutExpired:
+    summary["Status"] = STATUS_TIMEOUT
+    summary["Error"] = "Case did not finish in {0} seconds".format(timeoutSeconds)
+  summary["WallTimeSeconds"] = time.time() - startTime
+  return summary
+
+
+def mergeResults(outputDirectory, summaries):
+  """Concatenates the rows of all succeeded cases into results.csv and writes summary.csv
+  """
+  header = None
+  with open(os.path.join(outputDirectory, "results.csv"), "w") as resultsFile:
+    resultsWriter = csv.writer(resultsFile, lineterminator="\n")
+    for summary in summaries:
+      if summary["Status"] != STATUS_SUCCEEDED:
+        continue
+      resultFileName, _ = getCaseFileNames(outputDirectory, summary["Case"])
+      with open(resultFileName) as caseResultFile:
+        caseReader = csv.reader(caseResultFile)
+        caseHeader = next(caseReader)
+        if header is None:
+          header = caseHeader
+          resultsWriter.writerow(["Case"] + header)
+        for row in caseReader:
+          resultsWriter.writerow([summary["Case"]] + row)
+
+  with open(os.path.join(outputDirectory, "summary.csv"), "w") as summaryFile:
+    summaryWriter = csv.DictWriter(summaryFile, SUMMARY_COLUMNS, extrasaction="ignore", lineterminator="\n")
+    summaryWriter.writeheader()
+    for summary in summaries:
+      summaryWriter.writerow(summary)
+
+
+def runBatch(slicerExecutable, manifestFileName, outputDirectory, analysis, numberOfJobs=1, timeoutSeconds=None, workerArguments=None):
+  """Runs all cases of the manifest in up to numberOfJobs parallel Slicer processes.
+  Returns the list of case summaries in manifest order.
+  """
+  cases = readManifest(manifestFileName)
+  caseDirectory = os.path.join(outputDirectory, "cases")
+  if not os.path.isdir(caseDirectory):
+    os.makedirs(caseDirectory)
+
+  summaries = {}
+  with ThreadPoolExecutor(max_workers=numberOfJobs) as executor:
+    futures = {}
+    for case in cases:
+      future = executor.submit(runCase, slicerExecutable, case, analysis, outputDirectory, timeoutSeconds, workerArguments)
+      futures[future] = case["Case"]
+    for future in as_completed(futures):
+      summary = future.result()
+      summaries[futures[future]] = summary
+      print("{0}: {1} in {2:.1f}s {3}".format(summary["Case"], summary["Status"], summary["WallTimeSeconds"], summary["Error"][:200]))
+      sys.stdout.flush()
+
+  orderedSummaries = [summaries[case["Case"]] for case in cases]
+  mergeResults(outputDirectory, orderedSummaries)
+  return orderedSummaries
+
+
+#
+# Worker, runs inside Slicer
+#
+
+def runAnalysis(logic, analysis, resultFileName, arguments):
+  """Runs the analysis on the loaded case and writes rows to resultFileName. Returns the number of rows.
+  """
+  browserNode = logic.getActiveBrowserNode()
+  if analysis == VIEW_EXTENTS_ANALYSIS:
+    import slicer
+    import ViewCenterTesting
+    leftViewNode = slicer.mrmlScene.GetNodeByID(arguments.leftView)
+    rightViewNode = slicer.mrmlScene.GetNodeByID(arguments.rightView)
+    if not leftViewNode or not rightViewNode:
+      raise ValueError("View nodes {0} and {1} are required for the {2} analysis".format(arguments.leftView, arguments.rightView, analysis))
+    viewCenterTestingLogic = ViewCenterTesting.ViewCenterTestingLogic()
+    viewCenterTestingLogic.computeExtentsOffline(browserNode, 0, browserNode.GetNumberOfItems() - 1, logic.tumorModelNode_Needle,
+      leftViewNode, rightViewNode, outputFileName=resultFileName, aspectRatio=arguments.aspectRatio)
+    return browserNode.GetNumberOfItems()
+  elif analysis == TOOL_TUMOR_DISTANCE_ANALYSIS:
+    rows = logic.computeCauteryTipToTumorDistances(browserNode)
+    with open(resultFileName, "w") as resultFile:
+      resultWriter = csv.writer(resultFile, lineterminator="\n")
+      resultWriter.writerow(["Index", "Time (s)", "Cautery Tip To Tumor Distance (mm)"])
+      resultWriter.writerows(rows)
+    return len(rows)
+  raise ValueError("Unknown analysis: {0}".format(analysis))
+
+
+def runWorker(arguments):
+  status = {"Status": STATUS_FAILED}
+  try:
+    import LumpNavReplay
+    logic = LumpNavReplay.LumpNavReplayLogic()
+    startTime = time.time()
+    # The analyses do not use the ultrasound images, so they are only read if they are displayed
+    logic.loadAllData(arguments.TransducerToProbeFile, arguments.SceneFile, arguments.RecordingFile, arguments.TrackingFile, arguments.autocenter,
+      loadImagesOnDemand=True)
+    if arguments.dataset == "tracking":
+      logic.changeToTrackingData()
+    loadedTime = time.time()
+    status["NumberOfRows"] = runAnalysis(logic, arguments.analysis, arguments.result, arguments)
+    status["LoadTimeSeconds"] = loadedTime - startTime
+    status["AnalysisTimeSeconds"] = time.time() - loadedTime
+    status["Status"] = STATUS_SUCCEEDED
+  except Exception as e:
+    traceback.print_exc()
+    status["Error"] = "{0}: {1}".format(type(e).__name__, e)
+  with open(arguments.status, "w") as statusFile:
+    json.dump(status, statusFile)
+  return 0 if status["Status"] == STATUS_SUCCEEDED else 1
+
+
+def createArgumentParser():
+  parser = argparse.ArgumentParser(description="Replay LumpNav cases listed in a manifest in parallel headless Slicer processes.")
+  parser.add_argument("--analysis", choices=ANALYSES, default=VIEW_EXTENTS_ANALYSIS, help="Analysis to run on each case")
+  parser.add_argument("--dataset", choices=["recording", "tracking"], default="recording", help="Data set to analyze")
+  parser.add_argument("--autocenter", action="store_true", help="Start autocenter of the 3D views before the analysis")
+  parser.add_argument("--left-view", dest="leftView", default="vtkMRMLViewNode1", help="ID of the left view node (viewextents)")
+  parser.add_argument("--right-view", dest="rightView", default="vtkMRMLViewNode2", help="ID of the right view node (viewextents)")
+  parser.add_argument("--aspect-ratio", dest="aspectRatio", type=float, default=None, help="Aspect ratio of the views (viewextents)")
+  # Driver arguments
+  parser.add_argument("--slicer", help="Path to the Slicer executable")
+  parser.add_argument("--manifest", help="CSV file listing the cases")
+  parser.add_argument("--output", help="Output folder")
+  parser.add_argument("--jobs", type=int, default=max(1, (os.cpu_count() or 2) // 2), help="Number of parallel Slicer processes")
+  parser.add_argument("--timeout", type=float, default=None, help="Maximum time in seconds for one case")
+  # Worker arguments, set by the driver
+  parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+  parser.add_argument("--result", help=argparse.SUPPRESS)
+  parser.add_argument("--status", help=argparse.SUPPRESS)
+  for column in MANIFEST_COLUMNS[1:]:
+    parser.add_argument("--" + column, help=argparse.SUPPRESS)
+  return parser
+
+
+def getWorkerArguments(arguments):
+  """Options of the driver that are passed on to each worker
+  """
+  workerArguments = ["--dataset", arguments.dataset, "--left-view", arguments.leftView, "--right-view", arguments.rightView]
+  if arguments.autocenter:
+    workerArguments.append("--autocenter")
+  if arguments.aspectRatio:
+    workerArguments += ["--aspect-ratio", str(arguments.aspectRatio)]
+  return workerArguments
+
+
+def main(argv):
+  parser = createArgumentParser()
+  arguments = parser.parse_args(argv)
+  if arguments.worker:
+    return runWorker(arguments)
+  if not arguments.slicer or not arguments.manifest or not arguments.output:
+    parser.error("--slicer, --manifest and --output are required")
+  summaries = runBatch(arguments.slicer, arguments.manifest, arguments.output, arguments.analysis,
+    arguments.jobs, arguments.timeout, getWorkerArguments(arguments))
+  numberOfFailedCases = len([summary for summary in summaries if summary["Status"] != STATUS_SUCCEEDED])
+  print("{0} of {1} cases succeeded".format(len(summaries) - numberOfFailedCases, len(summaries)))
+  return 1 if numberOfFailedCases else 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
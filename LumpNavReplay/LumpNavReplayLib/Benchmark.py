@@ -0,0 +1,259 @@
+"""Load and replay benchmarks of LumpNavReplayLogic on synthetic cases of different sizes.
+
+Run inside Slicer, e.g.:
+
+  Slicer --no-main-window --no-splash --python-script Benchmark.py --data /tmp/LumpNavBenchmark --sizes small medium
+
+or, for the offline benchmarks only, from any Python with numpy:
+
+  python -m LumpNavReplayLib.Benchmark --data /tmp/LumpNavBenchmark --sizes small medium --offline
+
+For each dataset size the following times are measured (best of the repetitions). Offline benchmarks:
+
+- readTransforms: reading the timestamps and transforms from the recording header
+- readTransformsCached: the same, served from the transform cache
+- readFrame: reading one randomly chosen ultrasound frame on demand
+- findItemNumber: finding the item closest to one randomly chosen time
+
+Benchmarks that need Slicer:
+
+- loadAllData: load the case with all ultrasound images
+- loadAllDataOnDemand: load the case with images read on demand
+- switchDataset: one switch between the recording and the tracking data set
+- seek: selecting one randomly chosen time in the recording
+- computeExtents: computing the tumor extents in two views for one frame, without rendering
+
+Times are reported relative to the time of a fixed calibration workload (numpy and plain Python) measured in
+the same run, so that a baseline recorded on one computer can be used on a similar one. The results are compared
+to the baseline file and the benchmark fails if any time is more than the tolerance slower than its baseline.
+The stored baseline (Testing/Python/BenchmarkBaseline.json) contains the offline benchmarks, benchmarks that are
+not in the baseline are only reported. Record a new baseline with --update-baseline, inside Slicer to include
+all benchmarks.
+"""
+
+import argparse
+import collections
+import json
+import os
+import random
+import sys
+import time
+
+import numpy
+
+from LumpNavReplayLib.SequenceMetafile import SequenceMetafile, readMetafileTransforms
+from LumpNavReplayLib.SyntheticDataset import generateCase
+from LumpNavReplayLib.TimestampIndex import TimestampIndex
+from LumpNavReplayLib.TransformCache import TransformCache
+
+DATASET_SIZES = collections.OrderedDict([
+  ("small", {"numberOfRecordingFrames": 50, "imageSize": (64, 48)}),
+  ("medium", {"numberOfRecordingFrames": 500, "imageSize": (256, 192)}),
+  ("large", {"numberOfRecordingFrames": 2000, "imageSize": (640, 480)}),
+  ])
+OFFLINE_BENCHMARKS = ["readTransforms", "readTransformsCached", "readFrame", "findItemNumber"]
+SLICER_BENCHMARKS = ["loadAllData", "loadAllDataOnDemand", "switchDataset", "seek", "computeExtents"]
+BENCHMARKS = OFFLINE_BENCHMARKS + SLICER_BENCHMARKS
+DEFAULT_BASELINE_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Testing", "Python", "BenchmarkBaseline.json")
+NUMBER_OF_SWITCHES = 10
+NUMBER_OF_SEEKS = 100
+NUMBER_OF_FRAME_READS = 100
+NUMBER_OF_CALIBRATION_REPETITIONS = 5
+# Relative slowdown that is reported as a regression. The times of single operations (e.g. readFrame) are measured
+# over a loop of many operations, so they are compared relative to their baseline like the others.
+DEFAULT_TOLERANCE = 0.3
+
+
+def getCase(dataDirectory, sizeName):
+  """Returns the synthetic case of a size, generates it if it does not exist yet
+  """
+  caseDirectory = os.path.join(dataDirectory, sizeName)
+  caseName = "Benchmark-" + sizeName
+  manifestFileName = os.path.join(caseDirectory, "case.json")
+  if os.path.exists(manifestFileName):
+    with open(manifestFileName) as manifestFile:
+      case = json.load(manifestFile)
+    if all(os.path.exists(case[column]) for column in case if column != "Case"):
+      return case
+  case = generateCase(caseDirectory, caseName, **DATASET_SIZES[sizeName])
+  with open(manifestFileName, "w") as manifestFile:
+    json.dump(case, manifestFile)
+  return case
+
+
+def loadCase(logic, case, loadImagesOnDemand):
+  logic.loadAllData(case["TransducerToProbeFile"], case["SceneFile"], case["RecordingFile"], case["TrackingFile"], False, loadImagesOnDemand)
+
+
+def measureSeconds(function, repetitions):
+  """Returns the shortest wall time of the repetitions, which is the least disturbed by other processes
+  """
+  times = []
+  for repetition in range(repetitions):
+    startTime = time.perf_counter()
+    function()
+    times.append(time.perf_counter() - startTime)
+  return min(times)
+
+
+def runCalibrationWorkload():
+  """Fixed workload that all times are divided by: sorting and formatting and parsing numbers, which is
+  close to what the benchmarked code does
+  """
+  values = numpy.random.RandomState(0).rand(200000)
+  numpy.sort(values)
+  text = " ".join("{0:.6f}".format(value) for value in values[:20000])
+  numpy.array(text.split(), dtype=numpy.float64)
+
+
+def runOfflineBenchmarks(case, repetitions):
+  results = collections.OrderedDict()
+  recordingFile = case["RecordingFile"]
+  results["readTransforms"] = measureSeconds(lambda: readMetafileTransforms(recordingFile), repetitions)
+
+  transformCache = TransformCache(os.path.join(os.path.dirname(recordingFile), "TransformCache"))
+  transformCache.readMetafileTransforms(recordingFile)
+  results["readTransformsCached"] = measureSeconds(lambda: transformCache.readMetafileTransforms(recordingFile), repetitions)
+
+  metafile = SequenceMetafile(recordingFile, readFrameFields=False)
+  randomGenerator = random.Random(0)
+  frameIndices = [randomGenerator.randrange(metafile.numberOfFrames) for readIndex in range(NUMBER_OF_FRAME_READS)]
+
+  def readFrames():
+    for frameIndex in frameIndices:
+      metafile.clearFrameCache()
+      metafile.getFrame(frameIndex)
+  results["readFrame"] = measureSeconds(readFrames, repetitions) / NUMBER_OF_FRAME_READS
+
+  timestampIndex = TimestampIndex([float(indexValue) for indexValue in readMetafileTransforms(recordingFile).indexValues])
+  seekTimes = [randomGenerator.uniform(timestampIndex.timestamps[0], timestampIndex.timestamps[-1]) for seekIndex in range(NUMBER_OF_SEEKS)]
+
+  def findItemNumbers():
+    for seekTime in seekTimes:
+      timestampIndex.getItemNumber(seekTime)
+  results["findItemNumber"] = measureSeconds(findItemNumbers, repetitions) / NUMBER_OF_SEEKS
+  return results
+
+
+def runSlicerBenchmarks(logic, case, repetitions):
+  results = collections.OrderedDict()
+  results["loadAllData"] = measureSeconds(lambda: loadCase(logic, case, False), repetitions)
+  results["loadAllDataOnDemand"] = measureSeconds(lambda: loadCase(logic, case, True), repetitions)
+
+  def switchDatasets():
+    for switchIndex in range(NUMBER_OF_SWITCHES // 2):
+      logic.changeToTrackingData()
+      logic.changeToRecordingData()
+  results["switchDataset"] = measureSeconds(switchDatasets, repetitions) / NUMBER_OF_SWITCHES
+
+  browserNode = logic.getActiveBrowserNode()
+  timestampIndex = logic.getTimestampIndex(browserNode)
+  randomGenerator = random.Random(0)
+  seekTimes = [randomGenerator.uniform(timestampIndex.timestamps[0], timestampIndex.timestamps[-1]) for seekIndex in range(NUMBER_OF_SEEKS)]
+
+  def seek():
+    for seekTime in seekTimes:
+      logic.selectTime(browserNode, seekTime)
+  results["seek"] = measureSeconds(seek, repetitions) / NUMBER_OF_SEEKS
+
+  import slicer
+  import ViewCenterTesting
+  viewCenterTestingLogic = ViewCenterTesting.ViewCenterTestingLogic()
+  leftViewNode = slicer.mrmlScene.GetNodeByID("vtkMRMLViewNode1")
+  rightViewNode = slicer.mrmlScene.GetNodeByID("vtkMRMLViewNode2")
+  numberOfFrames = browserNode.GetNumberOfItems()
+  results["computeExtents"] = measureSeconds(lambda: viewCenterTestingLogic.computeExtentsOffline(browserNode, 0, numberOfFrames - 1,
+    logic.tumorModelNode_Needle, leftViewNode, rightViewNode, aspectRatio=1.0), repetitions) / numberOfFrames
+  return results
+
+
+def runBenchmarks(dataDirectory, sizeNames=None, repetitions=3, logic=None, offline=False):
+  """Runs the benchmarks for each dataset size and returns {size: {benchmark: time relative to the calibration workload}}.
+  If offline is True only the benchmarks that do not need Slicer are run.
+  """
+  if logic is None and not offline:
+    import LumpNavReplay
+    logic = LumpNavReplay.LumpNavReplayLogic()
+  calibrationSeconds = measureSeconds(runCalibrationWorkload, NUMBER_OF_CALIBRATION_REPETITIONS)
+  results = collections.OrderedDict()
+  for sizeName in (sizeNames or DATASET_SIZES.keys()):
+    case = getCase(dataDirectory, sizeName)
+    sizeResults = runOfflineBenchmarks(case, repetitions)
+    if not offline:
+      sizeResults.update(runSlicerBenchmarks(logic, case, repetitions))
+    results[sizeName] = collections.OrderedDict((benchmarkName, seconds / calibrationSeconds) for benchmarkName, seconds in sizeResults.items())
+  return results
+
+
+def readBaseline(fileName):
+  if not os.path.exists(fileName):
+    return None
+  with open(fileName) as baselineFile:
+    return json.load(baselineFile)
+
+
+def writeBaseline(fileName, results, previousBaseline=None):
+  """Stores the results as baseline, keeping the baseline of sizes and benchmarks that were not run
+  """
+  baseline = previousBaseline or {}
+  for sizeName, sizeResults in results.items():
+    baseline.setdefault(sizeName, {}).update(sizeResults)
+  with open(fileName, "w") as baselineFile:
+    json.dump(baseline, baselineFile, indent=2)
+
+
+def compareWithBaseline(results, baseline, tolerance=DEFAULT_TOLERANCE):
+  """Returns a message for each benchmark that is more than tolerance (relative) slower than its baseline.
+  Times are relative to the calibration workload.
+  """
+  regressions = []
+  for sizeName, sizeResults in results.items():
+    for benchmarkName, seconds in sizeResults.items():
+      baselineSeconds = baseline.get(sizeName, {}).get(benchmarkName)
+      if baselineSeconds is None:
+        continue
+      if seconds > baselineSeconds * (1.0 + tolerance):
+        regressions.append("{0} {1}: {2:.4g}, baseline {3:.4g} ({4:+.0f}%)".format(
+          sizeName, benchmarkName, seconds, baselineSeconds, 100.0 * (seconds / baselineSeconds - 1.0)))
+  return regressions
+
+
+def formatResults(results):
+  """Formats the results as a table with a column for each benchmark that was run
+  """
+  benchmarkNames = [benchmarkName for benchmarkName in BENCHMARKS if any(benchmarkName in sizeResults for sizeResults in results.values())]
+  lines = ["{0:<10}".format("Size") + "".join("{0:>22}".format(benchmarkName) for benchmarkName in benchmarkNames)]
+  for sizeName, sizeResults in results.items():
+    lines.append("{0:<10}".format(sizeName) + "".join("{0:>22.6f}".format(sizeResults[benchmarkName]) for benchmarkName in benchmarkNames))
+  return "\n".join(lines)
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description="Benchmark loading and replaying synthetic LumpNav cases. Run inside Slicer, or with --offline.")
+  parser.add_argument("--data", required=True, help="Folder for the generated cases, reused between runs")
+  parser.add_argument("--sizes", nargs="+", choices=list(DATASET_SIZES.keys()), default=list(DATASET_SIZES.keys()), help="Dataset sizes")
+  parser.add_argument("--repetitions", type=int, default=3, help="Number of repetitions of each measurement")
+  parser.add_argument("--baseline", default=DEFAULT_BASELINE_FILE, help="Baseline file")
+  parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Allowed relative slowdown compared to the baseline")
+  parser.add_argument("--update-baseline", dest="updateBaseline", action="store_true", help="Store the results as the new baseline")
+  parser.add_argument("--offline", action="store_true", help="Run only the benchmarks that do not need Slicer")
+  arguments = parser.parse_args(argv)
+
+  results = runBenchmarks(arguments.data, arguments.sizes, arguments.repetitions, offline=arguments.offline)
+  print(formatResults(results))
+  baseline = readBaseline(arguments.baseline)
+  if arguments.updateBaseline:
+    writeBaseline(arguments.baseline, results, baseline)
+    print("Baseline written to {0}".format(arguments.baseline))
+    return 0
+  if baseline is None:
+    print("No baseline found at {0}, run with --update-baseline to create it".format(arguments.baseline))
+    return 0
+  regressions = compareWithBaseline(results, baseline, arguments.tolerance)
+  for regression in regressions:
+    print("Regression: " + regression)
+  return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,316 @@
+"""Chunked, compressed storage of recordings with random access to every frame.
+
+Uncompressed metafiles of long recordings are large, and a metafile with CompressedData = True can only be
+read as a whole. A chunked recording stores the frames in chunks of framesPerChunk frames that are compressed
+independently (zlib or lzma), so selecting any frame decompresses only its chunk. File layout:
+
+- magic (8 bytes) and the size of the JSON header (uint64, little endian)
+- JSON header: number of frames, frame shape, element type, spacing, origin and axis directions (RAS),
+  compression, frames per chunk, timestamps of the frames, transform names and the size of the transforms block
+- chunk index: numberOfChunks + 1 file offsets (uint64), chunk i is stored from offset i to offset i + 1
+- transforms block: compressed matrices ((numberOfTransforms, N, 4, 4) float64) and valid flags ((numberOfTransforms, N) uint8)
+- compressed chunks
+
+During playback the chunks of the next frames are decompressed on a thread pool (zlib and lzma release the GIL),
+so they are usually ready when they are shown. Recordings are converted with:
+
+  python -m LumpNavReplayLib.ChunkedRecording Case-Recording.mha --compression lzma --frames-per-chunk 4
+
+Only numpy is needed, so recordings can be converted outside of Slicer.
+"""
+
+import argparse
+import collections
+import json
+import lzma
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+from LumpNavReplayLib.SequenceMetafile import MetafileTransforms, SequenceMetafile, readMetafileTransforms
+
+CHUNKED_RECORDING_EXTENSION = ".lnrec"
+MAGIC = b"LNRCHNK1"
+HEADER_SIZE_FORMAT = "<Q"
+OFFSET_DTYPE = numpy.dtype("<u8")
+
+COMPRESSORS = {
+  "zlib": (lambda data, level: zlib.compress(data, 6 if level is None else level), zlib.decompress),
+  "lzma": (lambda data, level: lzma.compress(data, preset=6 if level is None else level), lzma.decompress),
+  }
+DEFAULT_COMPRESSION = "zlib"
+# Number of chunks compressed by the thread pool at a time while converting, limits the memory use
+CHUNKS_PER_BATCH = 64
+
+
+def isChunkedRecordingFile(fileName):
+  return fileName.lower().endswith(CHUNKED_RECORDING_EXTENSION)
+
+
+def getChunkedRecordingFileName(metafileName):
+  return os.path.splitext(metafileName)[0] + CHUNKED_RECORDING_EXTENSION
+
+
+def convertMetafile(inputFileName, outputFileName=None, compression=DEFAULT_COMPRESSION, framesPerChunk=1, level=None, numberOfThreads=None):
+  """Converts a sequence metafile to a chunked recording and returns the output file name.
+  Frames are read from the memory-mapped metafile a batch of chunks at a time and compressed on a thread pool.
+  """
+  if compression not in COMPRESSORS:
+    raise ValueError("Unknown compression: " + compression)
+  if outputFileName is None:
+    outputFileName = getChunkedRecordingFileName(inputFileName)
+  compress = COMPRESSORS[compression][0]
+  metafile = SequenceMetafile(inputFileName, readFrameFields=False)
+  transforms = readMetafileTransforms(inputFileName)
+  numberOfFrames = transforms.numberOfFrames
+  hasImageData = metafile.hasImageData
+  elementType = metafile.elementType.newbyteorder("<")
+  numberOfChunks = (numberOfFrames + framesPerChunk - 1) // framesPerChunk if hasImageData else 0
+
+  transformNames = transforms.transformNames
+  matrices = numpy.zeros((len(transformNames), numberOfFrames, 4, 4), dtype="<f8")
+  valid = numpy.zeros((len(transformNames), numberOfFrames), dtype=numpy.uint8)
+  for transformIndex, transformName in enumerate(transformNames):
+    matrices[transformIndex] = transforms.matrices[transformName]
+    valid[transformIndex] = transforms.valid[transformName]
+  transformsBlock = compress(matrices.tobytes() + valid.tobytes(), level)
+
+  header = {
+    "numberOfFrames": numberOfFrames,
+    "frameShape": list(metafile.frameShape) if hasImageData else None,
+    "elementType": elementType.str,
+    "spacing": metafile.spacing,
+    "origin": metafile.origin,
+    "ijkToRasDirections": metafile.ijkToRasDirections,
+    "compression": compression,
+    "framesPerChunk": framesPerChunk,
+    "indexValues": transforms.indexValues,
+    "transformNames": transformNames,
+    "transformsSize": len(transformsBlock),
+    }
+  headerBytes = json.dumps(header).encode("utf-8")
+  offsets = numpy.zeros(numberOfChunks + 1, dtype=OFFSET_DTYPE)
+
+  def compressChunk(chunkIndex):
+    startFrameIndex = chunkIndex * framesPerChunk
+    frames = metafile.getPixelData()[startFrameIndex:startFrameIndex + framesPerChunk]
+    return compress(numpy.ascontiguousarray(frames, dtype=elementType).tobytes(), level)
+
+  with open(outputFileName, "wb") as outputFile:
+    outputFile.write(MAGIC + struct.pack(HEADER_SIZE_FORMAT, len(headerBytes)) + headerBytes)
+    indexOffset = outputFile.tell()
+    # The index is written once the sizes of the chunks are known
+    outputFile.write(offsets.tobytes())
+    outputFile.write(transformsBlock)
+    with ThreadPoolExecutor(max_workers=numberOfThreads) as executor:
+      for startChunkIndex in range(0, numberOfChunks, CHUNKS_PER_BATCH):
+        chunkIndices = range(startChunkIndex, min(startChunkIndex + CHUNKS_PER_BATCH, numberOfChunks))
+        for chunkIndex, chunkBytes in zip(chunkIndices, executor.map(compressChunk, chunkIndices)):
+          offsets[chunkIndex] = outputFile.tell()
+          outputFile.write(chunkBytes)
+    offsets[numberOfChunks] = outputFile.tell()
+    outputFile.seek(indexOffset)
+    outputFile.write(offsets.tobytes())
+  return outputFileName
+
+
+class ChunkedPixelData(object):
+  """(N, slices, rows, columns[, components]) array-like view of all frames of a chunked recording.
+  Frames are decompressed when they are accessed, e.g. by ImagePyramid.
+  """
+
+  def __init__(self, recording):
+    self.recording = recording
+    self.shape = (recording.numberOfFrames,) + recording.frameShape
+    self.dtype = recording.elementType
+
+  def __len__(self):
+    return self.shape[0]
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      frameIndices = range(*index.indices(len(self)))
+      if not frameIndices:
+        return numpy.zeros((0,) + self.shape[1:], dtype=self.dtype.newbyteorder("="))
+      return numpy.stack([self.recording.getFrame(frameIndex) for frameIndex in frameIndices])
+    return self.recording.getFrame(index)
+
+
+class ChunkedRecording(object):
+  """Header, transforms and on-demand image frames of a chunked recording.
+
+  Provides the same interface as SequenceMetafile for loading recordings with images on demand. Decompressed
+  chunks are kept in a cache of about maximumNumberOfCachedFrames frames. Frames returned by getFrame are read-only.
+  """
+
+  def __init__(self, fileName, maximumNumberOfCachedFrames=32, numberOfThreads=2):
+    self.fileName = fileName
+    self.numberOfThreads = numberOfThreads
+    self._file = open(fileName, "rb")
+    # Reads of the worker threads and the main thread must not interleave seek and read
+    self._fileLock = threading.Lock()
+    magic = self._file.read(len(MAGIC))
+    if magic != MAGIC:
+      self._file.close()
+      raise ValueError("Not a chunked recording: " + fileName)
+    headerSize = struct.unpack(HEADER_SIZE_FORMAT, self._file.read(struct.calcsize(HEADER_SIZE_FORMAT)))[0]
+    self.header = json.loads(self._file.read(headerSize).decode("utf-8"))
+    self.framesPerChunk = self.header["framesPerChunk"]
+    self.decompress = COMPRESSORS[self.header["compression"]][1]
+    numberOfChunks = (self.numberOfFrames + self.framesPerChunk - 1) // self.framesPerChunk if self.hasImageData else 0
+    self.offsets = numpy.frombuffer(self._file.read((numberOfChunks + 1) * OFFSET_DTYPE.itemsize), dtype=OFFSET_DTYPE).astype(numpy.int64)
+    self.transformsOffset = self._file.tell()
+    self.maximumNumberOfCachedChunks = max(maximumNumberOfCachedFrames // self.framesPerChunk, 1)
+    self._chunkCache = collections.OrderedDict()
+    self._pendingChunks = {}
+    self._executor = None
+    # Counters for checking how many chunks are decompressed on the calling thread and in the background
+    self.numberOfDecompressedChunks = 0
+    self.numberOfPrefetchedChunks = 0
+
+  @property
+  def numberOfFrames(self):
+    return self.header["numberOfFrames"]
+
+  @property
+  def numberOfChunks(self):
+    return len(self.offsets) - 1
+
+  @property
+  def frameShape(self):
+    """Shape of one frame as a numpy array: (slices, rows, columns[, components])
+    """
+    frameShape = self.header["frameShape"]
+    return tuple(frameShape) if frameShape else None
+
+  @property
+  def spacing(self):
+    return self.header["spacing"]
+
+  @property
+  def origin(self):
+    # Recordings converted before the geometry was stored have the default geometry
+    return self.header.get("origin", [0.0, 0.0, 0.0])
+
+  @property
+  def ijkToRasDirections(self):
+    return self.header.get("ijkToRasDirections", [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]])
+
+  @property
+  def elementType(self):
+    return numpy.dtype(self.header["elementType"])
+
+  @property
+  def hasImageData(self):
+    shape = self.frameShape
+    return shape is not None and numpy.prod(shape) > 0
+
+  def getTimestampStrings(self):
+    return list(self.header["indexValues"])
+
+  def getTransforms(self):
+    transformNames = self.header["transformNames"]
+    numberOfFrames = self.numberOfFrames
+    data = self.decompress(self.readBytes(self.transformsOffset, self.header["transformsSize"]))
+    matricesSize = len(transformNames) * numberOfFrames * 16 * 8
+    allMatrices = numpy.frombuffer(data[:matricesSize], dtype="<f8").reshape(len(transformNames), numberOfFrames, 4, 4)
+    allValid = numpy.frombuffer(data[matricesSize:], dtype=numpy.uint8).reshape(len(transformNames), numberOfFrames)
+    matrices = collections.OrderedDict()
+    valid = {}
+    for transformIndex, transformName in enumerate(transformNames):
+      matrices[transformName] = allMatrices[transformIndex].astype(numpy.float64)
+      valid[transformName] = allValid[transformIndex].astype(bool)
+    return MetafileTransforms(self.getTimestampStrings(), matrices, valid)
+
+  def readBytes(self, offset, size):
+    with self._fileLock:
+      self._file.seek(offset)
+      return self._file.read(size)
+
+  def decompressChunk(self, chunkIndex):
+    """Returns the frames of a chunk as an (n, slices, rows, columns[, components]) array. Thread safe.
+    """
+    data = self.decompress(self.readBytes(self.offsets[chunkIndex], self.offsets[chunkIndex + 1] - self.offsets[chunkIndex]))
+    frames = numpy.frombuffer(data, dtype=self.elementType).reshape((-1,) + self.frameShape)
+    return frames.astype(self.elementType.newbyteorder("="), copy=False)
+
+  def getChunk(self, chunkIndex):
+    chunk = self._chunkCache.get(chunkIndex)
+    if chunk is not None:
+      self._chunkCache.move_to_end(chunkIndex)
+      return chunk
+    future = self._pendingChunks.pop(chunkIndex, None)
+    if future is not None and not future.cancel():
+      chunk = future.result()
+      self.numberOfPrefetchedChunks += 1
+    else:
+      chunk = self.decompressChunk(chunkIndex)
+      self.numberOfDecompressedChunks += 1
+    self._chunkCache[chunkIndex] = chunk
+    while len(self._chunkCache) > self.maximumNumberOfCachedChunks:
+      self._chunkCache.popitem(last=False)
+    return chunk
+
+  def getFrame(self, frameIndex):
+    return self.getChunk(frameIndex // self.framesPerChunk)[frameIndex % self.framesPerChunk]
+
+  def prefetchFrames(self, startFrameIndex, numberOfFrames):
+    """Starts decompressing the chunks of the frames from startFrameIndex on the thread pool.
+    Pending chunks outside of this range are cancelled, as they are not needed any more after a seek.
+    """
+    if not self.hasImageData:
+      return
+    stopFrameIndex = min(max(startFrameIndex, 0) + numberOfFrames, self.numberOfFrames)
+    chunkIndices = range(max(startFrameIndex, 0) // self.framesPerChunk, (stopFrameIndex + self.framesPerChunk - 1) // self.framesPerChunk)
+    for chunkIndex in list(self._pendingChunks.keys()):
+      if chunkIndex not in chunkIndices and self._pendingChunks[chunkIndex].cancel():
+        del self._pendingChunks[chunkIndex]
+    if self._executor is None:
+      self._executor = ThreadPoolExecutor(max_workers=self.numberOfThreads)
+    for chunkIndex in chunkIndices:
+      if chunkIndex in self._chunkCache or chunkIndex in self._pendingChunks:
+        continue
+      self._pendingChunks[chunkIndex] = self._executor.submit(self.decompressChunk, chunkIndex)
+
+  def getPixelData(self):
+    return ChunkedPixelData(self)
+
+  def clearFrameCache(self):
+    self._chunkCache.clear()
+
+  def close(self):
+    if self._executor is not None:
+      for future in self._pendingChunks.values():
+        future.cancel()
+      self._executor.shutdown(wait=True)
+      self._executor = None
+    self._pendingChunks = {}
+    self._file.close()
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description="Convert a recording sequence metafile to a chunked, compressed recording.")
+  parser.add_argument("input", help="Input sequence metafile (.mha)")
+  parser.add_argument("output", nargs="?", help="Output file, by default the input file with the " + CHUNKED_RECORDING_EXTENSION + " extension")
+  parser.add_argument("--compression", choices=sorted(COMPRESSORS.keys()), default=DEFAULT_COMPRESSION, help="Compression of the chunks")
+  parser.add_argument("--level", type=int, help="Compression level (zlib) or preset (lzma)")
+  parser.add_argument("--frames-per-chunk", dest="framesPerChunk", type=int, default=1, help="Number of frames compressed together")
+  parser.add_argument("--threads", type=int, help="Number of compression threads")
+  arguments = parser.parse_args(argv)
+  startTime = time.perf_counter()
+  outputFileName = convertMetafile(arguments.input, arguments.output, arguments.compression, arguments.framesPerChunk, arguments.level, arguments.threads)
+  inputSize = os.path.getsize(arguments.input)
+  outputSize = os.path.getsize(outputFileName)
+  print("{0}: {1:.1f} MB -> {2:.1f} MB ({3:.0f}%) in {4:.1f}s".format(outputFileName, inputSize / 1e6, outputSize / 1e6,
+    100.0 * outputSize / max(inputSize, 1), time.perf_counter() - startTime))
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
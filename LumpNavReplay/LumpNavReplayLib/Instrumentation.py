@@ -0,0 +1,214 @@
+"""Wall time and memory measurement of loading stages and of rendering during playback.
+
+Stages are measured with
+
+  with instrumentation.measureStage("loadScene"):
+    ...
+
+Each stage is recorded with its wall time, the resident set size (RSS) after the stage and how much the
+peak RSS of the process increased during the stage. Stages can be nested, the depth of a stage is recorded
+with it. Render times are recorded per view and per sequence item with recordFrame.
+
+The increase of the process peak is zero for a stage that stays below an earlier peak. The peak RSS of each
+stage is measured if the instrumentation is created with measureStagePeakMemory=True. This is only available
+on Linux, where the peak of the process (VmHWM) is reset at the start of each stage by writing 5 to
+/proc/self/clear_refs. The peaks of the enclosing stages are kept up to date before each reset. As the reset
+affects the whole process, e.g. other tools that read VmHWM, it is off by default and PeakRssBytes is None.
+
+When the instrumentation is disabled measureStage returns a shared no-op context manager and nothing is
+recorded, so the instrumented code runs at the same speed as without instrumentation.
+"""
+
+import csv
+import json
+import os
+import sys
+import time
+
+STAGE_COLUMNS = ["Name", "Depth", "StartTimeSeconds", "WallTimeSeconds", "RssBytes", "PeakRssBytes", "PeakRssIncreaseBytes"]
+FRAME_COLUMNS = ["ViewNodeID", "ItemNumber", "RenderTimeSeconds"]
+CSV_COLUMNS = ["Type"] + STAGE_COLUMNS + FRAME_COLUMNS
+
+
+def getMemoryUsageBytes():
+  """Returns the current and the peak resident set size of the process in bytes, None if not available.
+  The peak is since the process started or since the last resetPeakMemoryUsage.
+  """
+  try:
+    # Linux: VmHWM is the peak resident set size
+    memoryFields = {}
+    with open("/proc/self/status") as statusFile:
+      for line in statusFile:
+        name, _, value = line.partition(":")
+        if name in ("VmRSS", "VmHWM"):
+          memoryFields[name] = int(value.split()[0]) * 1024
+    return memoryFields.get("VmRSS"), memoryFields.get("VmHWM")
+  except (IOError, OSError, ValueError):
+    pass
+  try:
+    import psutil
+    memoryInfo = psutil.Process().memory_info()
+    return memoryInfo.rss, getattr(memoryInfo, "peak_wset", None)
+  except ImportError:
+    pass
+  try:
+    import resource
+    peakRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in kilobytes elsewhere
+    return None, peakRss if sys.platform == "darwin" else peakRss * 1024
+  except ImportError:
+    return None, None
+
+
+def resetPeakMemoryUsage():
+  """Resets the peak resident set size of the process to the current one. Returns False if that is not possible.
+  """
+  try:
+    with open("/proc/self/clear_refs", "w") as clearRefsFile:
+      clearRefsFile.write("5")
+    return True
+  except (IOError, OSError):
+    return False
+
+
+class NullStage(object):
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exceptionType, exceptionValue, traceback):
+    return False
+
+
+NULL_STAGE = NullStage()
+
+
+class Stage(object):
+
+  def __init__(self, instrumentation, name):
+    self.instrumentation = instrumentation
+    self.name = name
+
+  def __enter__(self):
+    self.depth = self.instrumentation.currentDepth
+    self.instrumentation.currentDepth += 1
+    self.peakRssBytes = self.instrumentation.startPeakMeasurement()
+    self.startPeakRssBytes = self.peakRssBytes
+    self.instrumentation.openStages.append(self)
+    self.startTime = time.perf_counter()
+    return self
+
+  def __exit__(self, exceptionType, exceptionValue, traceback):
+    wallTimeSeconds = time.perf_counter() - self.startTime
+    self.instrumentation.currentDepth -= 1
+    rssBytes = self.instrumentation.updatePeaks()
+    self.instrumentation.openStages.remove(self)
+    measureStagePeakMemory = self.instrumentation.measureStagePeakMemory
+    peakRssIncreaseBytes = None
+    if not measureStagePeakMemory and self.peakRssBytes is not None:
+      peakRssIncreaseBytes = self.peakRssBytes - self.startPeakRssBytes
+    self.instrumentation.stages.append({
+      "Name": self.name,
+      "Depth": self.depth,
+      "StartTimeSeconds": self.startTime - self.instrumentation.originTime,
+      "WallTimeSeconds": wallTimeSeconds,
+      "RssBytes": rssBytes,
+      "PeakRssBytes": self.peakRssBytes if measureStagePeakMemory else None,
+      "PeakRssIncreaseBytes": peakRssIncreaseBytes,
+      })
+    return False
+
+
+class Instrumentation(object):
+
+  def __init__(self, enabled=False, measureStagePeakMemory=False):
+    """If measureStagePeakMemory is True, the peak RSS of the process is reset at the start of each stage
+    """
+    self.enabled = enabled
+    self.measureStagePeakMemory = measureStagePeakMemory
+    self.clear()
+
+  def clear(self):
+    self.stages = []
+    self.frames = []
+    self.currentDepth = 0
+    self.openStages = []
+    self.originTime = time.perf_counter()
+
+  def updatePeaks(self):
+    """Adds the peak RSS since the last reset (or of the process) to the peaks of the open stages. Returns the current RSS.
+    """
+    rssBytes, peakRssBytes = getMemoryUsageBytes()
+    if peakRssBytes is not None:
+      for stage in self.openStages:
+        if stage.peakRssBytes is not None:
+          stage.peakRssBytes = max(stage.peakRssBytes, peakRssBytes)
+    return rssBytes
+
+  def startPeakMeasurement(self):
+    """Returns the initial peak of a new stage. If stage peaks are measured, the peak RSS is reset first and
+    None is returned if it cannot be reset. Otherwise it is the current peak of the process.
+    """
+    self.updatePeaks()
+    if self.measureStagePeakMemory and not resetPeakMemoryUsage():
+      return None
+    rssBytes, peakRssBytes = getMemoryUsageBytes()
+    return peakRssBytes
+
+  def measureStage(self, name):
+    if not self.enabled:
+      return NULL_STAGE
+    return Stage(self, name)
+
+  def recordFrame(self, viewNodeID, itemNumber, renderTimeSeconds):
+    if not self.enabled:
+      return
+    self.frames.append({"ViewNodeID": viewNodeID, "ItemNumber": itemNumber, "RenderTimeSeconds": renderTimeSeconds})
+
+  def getStageWallTimes(self):
+    """Returns the total wall time of each stage name, in the order the stages first finished
+    """
+    wallTimes = {}
+    for stage in self.stages:
+      wallTimes[stage["Name"]] = wallTimes.get(stage["Name"], 0.0) + stage["WallTimeSeconds"]
+    return wallTimes
+
+  def getFrameSummary(self):
+    """Returns the number of rendered frames and the mean and maximum render time in seconds
+    """
+    renderTimes = [frame["RenderTimeSeconds"] for frame in self.frames]
+    if not renderTimes:
+      return {"NumberOfFrames": 0, "MeanRenderTimeSeconds": None, "MaximumRenderTimeSeconds": None}
+    return {
+      "NumberOfFrames": len(renderTimes),
+      "MeanRenderTimeSeconds": sum(renderTimes) / len(renderTimes),
+      "MaximumRenderTimeSeconds": max(renderTimes),
+      }
+
+  def toDict(self):
+    return {"stages": self.stages, "frames": self.frames, "frameSummary": self.getFrameSummary()}
+
+  def writeLog(self, fileName):
+    """Writes the stages and frames to a .json file, or to a .csv file with one row per stage or frame
+    """
+    if os.path.splitext(fileName)[1].lower() == ".csv":
+      self.writeCsv(fileName)
+    else:
+      self.writeJson(fileName)
+
+  def writeJson(self, fileName):
+    with open(fileName, "w") as logFile:
+      json.dump(self.toDict(), logFile, indent=2)
+
+  def writeCsv(self, fileName):
+    with open(fileName, "w", newline="") as logFile:
+      writer = csv.DictWriter(logFile, CSV_COLUMNS)
+      writer.writeheader()
+      for stage in self.stages:
+        row = {"Type": "Stage"}
+        row.update(stage)
+        writer.writerow(row)
+      for frame in self.frames:
+        row = {"Type": "Frame"}
+        row.update(frame)
+        writer.writerow(row)
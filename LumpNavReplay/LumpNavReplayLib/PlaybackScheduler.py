@@ -0,0 +1,130 @@
+"""Sequence playback that follows the recorded timestamps in real time.
+
+The playback of the sequence browser shows every item at a fixed rate, so when rendering is slower than the
+recording rate the replay falls behind wall-clock time. The scheduler selects items itself: before each frame
+it predicts when rendering will finish (from the average render time of the previous frames) and shows the
+latest item whose timestamp has been reached at that time. Items that are passed over are counted as dropped.
+
+In renderEveryFrame mode no item is dropped and items are shown as fast as they can be rendered, which is
+needed for analysis runs that sample every frame.
+"""
+
+import time
+
+import numpy
+import qt
+import slicer
+
+# Weight of the latest frame in the running average of the render time
+RENDER_TIME_SMOOTHING = 0.2
+
+
+class PlaybackScheduler(object):
+
+  def __init__(self, browserNode, renderEveryFrame=False, speed=1.0, startItemNumber=None, endItemNumber=None,
+               frameCallback=None, finishedCallback=None):
+    """frameCallback(itemNumber) is called after each rendered frame and finishedCallback() when the end item is shown
+    """
+    self.browserNode = browserNode
+    self.renderEveryFrame = renderEveryFrame
+    self.speed = speed
+    masterSequenceNode = browserNode.GetMasterSequenceNode()
+    self.timestamps = numpy.array([float(masterSequenceNode.GetNthIndexValue(itemNumber))
+      for itemNumber in range(masterSequenceNode.GetNumberOfDataNodes())])
+    self.startItemNumber = startItemNumber
+    self.endItemNumber = len(self.timestamps) - 1 if endItemNumber is None else min(endItemNumber, len(self.timestamps) - 1)
+    self.frameCallback = frameCallback
+    self.finishedCallback = finishedCallback
+    self.timer = qt.QTimer()
+    self.timer.setSingleShot(True)
+    self.timer.connect('timeout()', self.onTimeout)
+    self.playing = False
+    self.resetStatistics()
+
+  def resetStatistics(self):
+    self.numberOfRenderedFrames = 0
+    self.numberOfDroppedFrames = 0
+    self.averageRenderSeconds = 0.0
+    self.maximumRenderSeconds = 0.0
+    # Largest difference between the wall time and the timestamp of a shown frame (scaled to recording time)
+    self.maximumLagSeconds = 0.0
+
+  def getStatistics(self):
+    return {
+      "NumberOfRenderedFrames": self.numberOfRenderedFrames,
+      "NumberOfDroppedFrames": self.numberOfDroppedFrames,
+      "AverageRenderSeconds": self.averageRenderSeconds,
+      "MaximumRenderSeconds": self.maximumRenderSeconds,
+      "MaximumLagSeconds": self.maximumLagSeconds,
+      }
+
+  def start(self):
+    self.stop()
+    if len(self.timestamps) == 0:
+      return
+    # The browser must not advance the items itself
+    self.browserNode.SetPlaybackActive(False)
+    self.resetStatistics()
+    startItemNumber = self.startItemNumber
+    if startItemNumber is None:
+      startItemNumber = max(self.browserNode.GetSelectedItemNumber(), 0)
+    self.currentItemNumber = startItemNumber - 1
+    self.startTimestamp = self.timestamps[startItemNumber]
+    self.startWallTime = time.perf_counter()
+    self.playing = True
+    self.timer.start(0)
+
+  def stop(self):
+    self.timer.stop()
+    self.playing = False
+
+  def getRecordingTime(self, wallTime):
+    return self.startTimestamp + (wallTime - self.startWallTime) * self.speed
+
+  def getNextItemNumber(self):
+    """Returns the item to show next, the latest item whose timestamp is reached when it is rendered
+    """
+    if self.renderEveryFrame:
+      return self.currentItemNumber + 1
+    renderFinishedTime = self.getRecordingTime(time.perf_counter() + self.averageRenderSeconds)
+    itemNumber = int(numpy.searchsorted(self.timestamps, renderFinishedTime, side="right")) - 1
+    return min(max(itemNumber, self.currentItemNumber + 1), self.endItemNumber)
+
+  def onTimeout(self):
+    if not self.playing:
+      return
+    itemNumber = self.getNextItemNumber()
+    # Before the first frame currentItemNumber is the item before the start item, so frames skipped at the start are counted too
+    self.numberOfDroppedFrames += max(itemNumber - self.currentItemNumber - 1, 0)
+    self.currentItemNumber = itemNumber
+
+    renderStartTime = time.perf_counter()
+    self.browserNode.SetSelectedItemNumber(itemNumber)
+    slicer.util.forceRenderAllViews()
+    renderEndTime = time.perf_counter()
+    renderSeconds = renderEndTime - renderStartTime
+    if self.numberOfRenderedFrames == 0:
+      self.averageRenderSeconds = renderSeconds
+    else:
+      self.averageRenderSeconds += RENDER_TIME_SMOOTHING * (renderSeconds - self.averageRenderSeconds)
+    self.maximumRenderSeconds = max(self.maximumRenderSeconds, renderSeconds)
+    self.numberOfRenderedFrames += 1
+    if not self.renderEveryFrame:
+      self.maximumLagSeconds = max(self.maximumLagSeconds, self.getRecordingTime(renderEndTime) - self.timestamps[itemNumber])
+
+    if self.frameCallback:
+      self.frameCallback(itemNumber)
+    if itemNumber >= self.endItemNumber:
+      self.stop()
+      if self.finishedCallback:
+        self.finishedCallback()
+      return
+    if not self.playing:
+      # Stopped by the frame callback
+      return
+    if self.renderEveryFrame:
+      self.timer.start(0)
+      return
+    # Wake up when the next item is due, early enough to render it in time
+    secondsToNextItem = (self.timestamps[itemNumber + 1] - self.getRecordingTime(time.perf_counter())) / self.speed - self.averageRenderSeconds
+    self.timer.start(max(int(1000 * secondsToNextItem), 0))
@@ -0,0 +1,215 @@
+"""Reduced resolution preview of the ultrasound image while the recording is scrubbed or played fast.
+
+Every frame change makes the slice views reslice the full resolution image and upload it for display,
+which stalls when the sequence slider is dragged. While frames change faster than the stable interval
+the slice views show a preview volume instead, which is updated from an image pyramid: level L of the pyramid
+holds every frame downsampled by 2^L with block averaging. Only the level that is shown is kept in memory.
+It is computed a chunk of frames at a time, when a frame of the chunk is shown for the first time, so the preview
+is available right after loading and only the scrubbed parts of the recording are read. When the selected frame
+has not changed for the stable interval, the full resolution image is updated and shown again.
+"""
+
+import time
+
+import numpy
+import qt
+import slicer
+import vtk
+
+# Number of frames that are downsampled at once, when the first of them is shown. Small enough that computing
+# a chunk does not delay scrubbing and does not evict the frames cached for playback from a chunked recording.
+PYRAMID_FRAMES_PER_CHUNK = 8
+
+
+def downsampleFrames(frames, factor):
+  """Returns (N, slices, rows, columns[, components]) frames with rows and columns reduced by factor (block average).
+  Rows and columns that do not fill a whole block are dropped.
+  """
+  numberOfRows = frames.shape[2] // factor
+  numberOfColumns = frames.shape[3] // factor
+  blocks = frames[:, :, :numberOfRows * factor, :numberOfColumns * factor]
+  blocks = blocks.reshape(frames.shape[:2] + (numberOfRows, factor, numberOfColumns, factor) + frames.shape[4:])
+  return blocks.mean(axis=(3, 5))
+
+
+class SequenceNodeFrames(object):
+  """(N, slices, rows, columns[, components]) array-like view of the image volumes of a sequence node,
+  for the pyramid of a recording that is loaded with all images
+  """
+
+  def __init__(self, sequenceNode):
+    self.sequenceNode = sequenceNode
+    firstFrame = slicer.util.arrayFromVolume(sequenceNode.GetNthDataNode(0))
+    self.shape = (sequenceNode.GetNumberOfDataNodes(),) + firstFrame.shape
+    self.dtype = firstFrame.dtype
+
+  def __len__(self):
+    return self.shape[0]
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      frameIndices = range(*index.indices(len(self)))
+      frames = numpy.zeros((len(frameIndices),) + self.shape[1:], dtype=self.dtype)
+      for frameNumber, frameIndex in enumerate(frameIndices):
+        frames[frameNumber] = self[frameIndex]
+      return frames
+    return slicer.util.arrayFromVolume(self.sequenceNode.GetNthDataNode(index))
+
+
+class ImagePyramid(object):
+
+  def __init__(self, sourceFrames, level=2, framesPerChunk=PYRAMID_FRAMES_PER_CHUNK):
+    """sourceFrames is an (N, slices, rows, columns[, components]) array or array-like (e.g. a memory-mapped file),
+    it is read a chunk at a time when a frame of the chunk is requested for the first time.
+    Only the frames of the given level are stored, level 0 is the full resolution image.
+    """
+    self.sourceFrames = sourceFrames
+    self.level = level
+    self.framesPerChunk = framesPerChunk
+    self.dtype = numpy.dtype(sourceFrames.dtype).newbyteorder("=")
+    # Each level halves the size of the previous one, rows and columns that do not fill a block are dropped at each level
+    frameShape = tuple(sourceFrames.shape[1:])
+    levelShape = frameShape[:3]
+    for _ in range(level):
+      levelShape = (levelShape[0], levelShape[1] // 2, levelShape[2] // 2)
+    numberOfFrames = len(sourceFrames)
+    self.frames = numpy.zeros((numberOfFrames,) + levelShape + frameShape[3:], dtype=self.dtype)
+    self.computedChunks = numpy.zeros((numberOfFrames + framesPerChunk - 1) // framesPerChunk, dtype=bool)
+    # Counter for checking how many chunks are downsampled
+    self.numberOfComputedChunks = 0
+
+  def computeChunk(self, chunkIndex):
+    """Computes the stored level of the frames of a chunk. Each level is computed from the previous one,
+    the levels between are only kept for these frames.
+    """
+    startFrameIndex = chunkIndex * self.framesPerChunk
+    levelFrames = numpy.asarray(self.sourceFrames[startFrameIndex:startFrameIndex + self.framesPerChunk], dtype=numpy.float32)
+    for _ in range(self.level):
+      levelFrames = downsampleFrames(levelFrames, 2)
+    if numpy.issubdtype(self.dtype, numpy.integer):
+      levelFrames = numpy.rint(levelFrames)
+    self.frames[startFrameIndex:startFrameIndex + len(levelFrames)] = levelFrames
+    self.computedChunks[chunkIndex] = True
+    self.numberOfComputedChunks += 1
+
+  def getFrame(self, frameIndex, level):
+    if level != self.level:
+      raise ValueError("Image pyramid stores level {0}, level {1} was requested".format(self.level, level))
+    chunkIndex = frameIndex // self.framesPerChunk
+    if not self.computedChunks[chunkIndex]:
+      self.computeChunk(chunkIndex)
+    return self.frames[frameIndex]
+
+  def getLevelIJKToRASMatrix(self, ijkToRasMatrix, level):
+    """Returns the IJK to RAS matrix of a level from the IJK to RAS matrix of the full resolution image.
+    The center of each block of full resolution voxels is the center of the preview voxel.
+    """
+    factor = 2 ** level
+    levelToFullIjk = numpy.diag([factor, factor, 1.0, 1.0])
+    levelToFullIjk[:2, 3] = (factor - 1) / 2.0
+    return numpy.dot(ijkToRasMatrix, levelToFullIjk)
+
+
+class ResliceScrubPreview(object):
+
+  def __init__(self, browserNode, imageNode, pyramid, level=2, stableSeconds=0.25, updateFullResolutionImage=None):
+    """updateFullResolutionImage(frameIndex) is called when the selected frame becomes stable, if the full
+    resolution image is not updated by the browser itself
+    """
+    self.browserNode = browserNode
+    self.imageNode = imageNode
+    self.pyramid = pyramid
+    self.level = level
+    self.stableSeconds = stableSeconds
+    self.updateFullResolutionImage = updateFullResolutionImage
+    self.previewNode = None
+    self.previewShown = False
+    self.replacedCompositeNodes = []
+    self.lastFrameIndex = None
+    self.lastFrameChangeTime = None
+    self.browserObservation = None
+    # Counters for checking how many frames are shown in preview and full resolution
+    self.numberOfPreviewFrames = 0
+    self.numberOfFullResolutionFrames = 0
+    self.stableTimer = qt.QTimer()
+    self.stableTimer.setSingleShot(True)
+    self.stableTimer.connect('timeout()', self.onFrameStable)
+
+  def start(self):
+    self.stop()
+    volumeClassName = "vtkMRMLVectorVolumeNode" if self.pyramid.frames.ndim > 4 else "vtkMRMLScalarVolumeNode"
+    self.previewNode = slicer.mrmlScene.AddNewNodeByClass(volumeClassName, self.imageNode.GetName() + "-Preview")
+    self.previewNode.SetHideFromEditors(True)
+    self.previewNode.SetSaveWithScene(False)
+    imageIjkToRas = vtk.vtkMatrix4x4()
+    self.imageNode.GetIJKToRASMatrix(imageIjkToRas)
+    previewIjkToRas = self.pyramid.getLevelIJKToRASMatrix(slicer.util.arrayFromVTKMatrix(imageIjkToRas), self.level)
+    self.previewNode.SetIJKToRASMatrix(slicer.util.vtkMatrixFromArray(previewIjkToRas))
+    slicer.util.updateVolumeFromArray(self.previewNode, self.pyramid.getFrame(max(self.browserNode.GetSelectedItemNumber(), 0), self.level))
+    self.previewNode.CreateDefaultDisplayNodes()
+    imageDisplayNode = self.imageNode.GetDisplayNode()
+    previewDisplayNode = self.previewNode.GetDisplayNode()
+    if imageDisplayNode and previewDisplayNode:
+      # Same color and window/level as the full resolution image
+      previewDisplayNode.CopyContent(imageDisplayNode)
+    self.lastFrameIndex = self.browserNode.GetSelectedItemNumber()
+    self.lastFrameChangeTime = None
+    self.browserObservation = self.browserNode.AddObserver(vtk.vtkCommand.ModifiedEvent, self.onBrowserModified)
+
+  def stop(self):
+    self.stableTimer.stop()
+    if self.browserObservation is not None:
+      self.browserNode.RemoveObserver(self.browserObservation)
+      self.browserObservation = None
+    self.showFullResolution()
+    if self.previewNode and self.previewNode.GetScene():
+      slicer.mrmlScene.RemoveNode(self.previewNode)
+    self.previewNode = None
+
+  def onBrowserModified(self, browserNode=None, event=None):
+    self.update()
+
+  def update(self):
+    """Shows the preview if the selected frame changed within the stable interval since the previous change.
+    Returns True if the preview is shown, i.e. the full resolution image does not need to be updated.
+    """
+    frameIndex = self.browserNode.GetSelectedItemNumber()
+    if frameIndex < 0 or frameIndex == self.lastFrameIndex:
+      return self.previewShown
+    currentTime = time.time()
+    scrubbing = self.lastFrameChangeTime is not None and currentTime - self.lastFrameChangeTime < self.stableSeconds
+    self.lastFrameIndex = frameIndex
+    self.lastFrameChangeTime = currentTime
+    if scrubbing:
+      self.showPreview(frameIndex)
+    if self.previewShown:
+      self.stableTimer.start(int(1000 * self.stableSeconds))
+    return self.previewShown
+
+  def showPreview(self, frameIndex):
+    slicer.util.updateVolumeFromArray(self.previewNode, self.pyramid.getFrame(frameIndex, self.level))
+    self.numberOfPreviewFrames += 1
+    if self.previewShown:
+      return
+    # The preview is at the same place as the image, also if the image transform is changed meanwhile
+    self.previewNode.SetAndObserveTransformNodeID(self.imageNode.GetTransformNodeID())
+    imageNodeID = self.imageNode.GetID()
+    for compositeNode in slicer.util.getNodesByClass("vtkMRMLSliceCompositeNode"):
+      if compositeNode.GetBackgroundVolumeID() == imageNodeID:
+        compositeNode.SetBackgroundVolumeID(self.previewNode.GetID())
+        self.replacedCompositeNodes.append(compositeNode)
+    self.previewShown = True
+
+  def showFullResolution(self):
+    if not self.previewShown:
+      return
+    for compositeNode in self.replacedCompositeNodes:
+      compositeNode.SetBackgroundVolumeID(self.imageNode.GetID())
+    self.replacedCompositeNodes = []
+    self.previewShown = False
+
+  def onFrameStable(self):
+    if self.updateFullResolutionImage:
+      self.updateFullResolutionImage(self.lastFrameIndex)
+    self.numberOfFullResolutionFrames += 1
+    self.showFullResolution()
@@ -0,0 +1,304 @@
+"""Reading of Plus sequence metafiles (.mha/.mhd) without loading the image data.
+
+SequenceMetafile parses only the text header when the file is opened. Image frames are read on demand
+from a memory-mapped view of the pixel data and the most recently used frames are kept in a small cache.
+
+readMetafileTransforms reads only the timestamps and transforms from the header and stops before the
+pixel data, so its run time depends on the number of frames and not on the size of the images.
+"""
+
+import collections
+import os
+import re
+
+import numpy
+
+FRAME_FIELD_PATTERN = re.compile(r"^Seq_Frame(\d+)_([^\s=]+)\s*=\s*(.*)$")
+TIMESTAMP_FIELD = "Timestamp"
+TRANSFORM_SUFFIX = "Transform"
+TRANSFORM_STATUS_SUFFIX = "TransformStatus"
+
+METAIO_ELEMENT_TYPES = {
+  "MET_CHAR": numpy.int8,
+  "MET_UCHAR": numpy.uint8,
+  "MET_SHORT": numpy.int16,
+  "MET_USHORT": numpy.uint16,
+  "MET_INT": numpy.int32,
+  "MET_UINT": numpy.uint32,
+  "MET_LONG": numpy.int32,
+  "MET_ULONG": numpy.uint32,
+  "MET_LONG_LONG": numpy.int64,
+  "MET_ULONG_LONG": numpy.uint64,
+  "MET_FLOAT": numpy.float32,
+  "MET_DOUBLE": numpy.float64,
+  }
+
+
+class MetafileTransforms(object):
+  """Timestamps and transforms of all frames of a sequence metafile.
+
+  indexValues contains the timestamp string of each frame. matrices and valid map a transform name
+  (e.g. ProbeToTracker) to an (N,4,4) float64 array and an (N,) boolean array that is False for frames
+  where the transform status is not OK.
+  """
+
+  def __init__(self, indexValues, matrices, valid):
+    self.indexValues = indexValues
+    self.matrices = matrices
+    self.valid = valid
+
+  @property
+  def numberOfFrames(self):
+    return len(self.indexValues)
+
+  @property
+  def transformNames(self):
+    return list(self.matrices.keys())
+
+
+def parseMatrices(numberOfFrames, frameIndices, matrixStrings):
+  """Converts the matrix strings of the listed frames to an (N,4,4) array in one pass. Unlisted frames are identity.
+  """
+  matrices = numpy.tile(numpy.eye(4), (numberOfFrames, 1, 1))
+  if matrixStrings:
+    values = numpy.array(" ".join(matrixStrings).split(), dtype=numpy.float64)
+    matrices[numpy.asarray(frameIndices)] = values.reshape(-1, 4, 4)
+  return matrices
+
+
+def readMetafileTransforms(fileName, transformNames=None):
+  """Reads the timestamps and the transforms (all, or only the listed names) from the header of a sequence metafile.
+  Other per-frame fields are skipped and the pixel data is never read.
+  """
+  timestamps = {}
+  matrixStrings = collections.OrderedDict()
+  statusStrings = {}
+  numberOfFrames = 0
+  wantedFieldNames = None
+  if transformNames is not None:
+    wantedFieldNames = set()
+    for transformName in transformNames:
+      wantedFieldNames.add((transformName + TRANSFORM_SUFFIX).encode())
+      wantedFieldNames.add((transformName + TRANSFORM_STATUS_SUFFIX).encode())
+  timestampFieldName = TIMESTAMP_FIELD.encode()
+  transformSuffix = TRANSFORM_SUFFIX.encode()
+  transformStatusSuffix = TRANSFORM_STATUS_SUFFIX.encode()
+
+  with open(fileName, "rb") as metafile:
+    for line in metafile:
+      if not line.startswith(b"Seq_Frame"):
+        if line.startswith(b"ElementDataFile"):
+          break
+        continue
+      key, separator, value = line.partition(b"=")
+      frameIndexString, _, fieldName = key[len(b"Seq_Frame"):].partition(b"_")
+      fieldName = fieldName.strip()
+      frameIndex = int(frameIndexString)
+      numberOfFrames = max(numberOfFrames, frameIndex + 1)
+      if fieldName == timestampFieldName:
+        timestamps[frameIndex] = value.strip().decode()
+      elif wantedFieldNames is not None and fieldName not in wantedFieldNames:
+        continue
+      elif fieldName.endswith(transformSuffix):
+        transformName = fieldName[:-len(transformSuffix)].decode()
+        frameIndices, strings = matrixStrings.setdefault(transformName, ([], []))
+        frameIndices.append(frameIndex)
+        strings.append(value.decode())
+      elif fieldName.endswith(transformStatusSuffix):
+        transformName = fieldName[:-len(transformStatusSuffix)].decode()
+        statusStrings.setdefault(transformName, {})[frameIndex] = value.strip()
+
+  indexValues = [timestamps.get(frameIndex, str(frameIndex)) for frameIndex in range(numberOfFrames)]
+  matrices = collections.OrderedDict()
+  valid = {}
+  for transformName, (frameIndices, strings) in matrixStrings.items():
+    matrices[transformName] = parseMatrices(numberOfFrames, frameIndices, strings)
+    transformValid = numpy.zeros(numberOfFrames, dtype=bool)
+    transformValid[numpy.asarray(frameIndices, dtype=int)] = True
+    for frameIndex, status in statusStrings.get(transformName, {}).items():
+      transformValid[frameIndex] = (status == b"OK")
+    valid[transformName] = transformValid
+  return MetafileTransforms(indexValues, matrices, valid)
+
+
+class SequenceMetafile(object):
+  """Header and on-demand image frames of a sequence metafile.
+
+  fields contains the general header fields (e.g. DimSize, ElementType), frameFields contains one
+  dictionary of per-frame fields (e.g. Timestamp, ProbeToTrackerTransform) for each frame.
+  If readFrameFields is False then per-frame fields are skipped (use readMetafileTransforms to get them).
+  """
+
+  def __init__(self, fileName, maximumNumberOfCachedFrames=32, readFrameFields=True):
+    self.fileName = fileName
+    self.fields = collections.OrderedDict()
+    self.frameFields = []
+    self.dataOffset = 0
+    self.maximumNumberOfCachedFrames = maximumNumberOfCachedFrames
+    self._frameCache = collections.OrderedDict()
+    self._pixelData = None
+    self.readHeader(readFrameFields)
+
+  def readHeader(self, readFrameFields=True):
+    with open(self.fileName, "rb") as metafile:
+      for line in metafile:
+        if not readFrameFields and line.startswith(b"Seq_Frame"):
+          continue
+        line = line.decode("latin-1").strip()
+        if not line:
+          continue
+        frameFieldMatch = FRAME_FIELD_PATTERN.match(line)
+        if frameFieldMatch:
+          frameIndex = int(frameFieldMatch.group(1))
+          while len(self.frameFields) <= frameIndex:
+            self.frameFields.append({})
+          self.frameFields[frameIndex][frameFieldMatch.group(2)] = frameFieldMatch.group(3).strip()
+          continue
+        name, separator, value = line.partition("=")
+        if not separator:
+          continue
+        self.fields[name.strip()] = value.strip()
+        if name.strip() == "ElementDataFile":
+          # ElementDataFile is always the last header field, pixel data follows
+          self.dataOffset = metafile.tell()
+          break
+
+  @property
+  def numberOfFrames(self):
+    if self.frameFields:
+      return len(self.frameFields)
+    dimensions = self.dimensions
+    return dimensions[-1] if dimensions else 0
+
+  @property
+  def dimensions(self):
+    return [int(value) for value in self.fields.get("DimSize", "").split()]
+
+  @property
+  def frameShape(self):
+    """Shape of one frame as a numpy array: (slices, rows, columns[, components])
+    """
+    dimensions = self.dimensions
+    if len(dimensions) < 3:
+      return None
+    frameDimensions = dimensions[:-1]
+    shape = [1] * (3 - len(frameDimensions)) + list(reversed(frameDimensions))
+    numberOfComponents = int(self.fields.get("ElementNumberOfChannels", "1"))
+    if numberOfComponents > 1:
+      shape.append(numberOfComponents)
+    return tuple(shape)
+
+  @property
+  def spacing(self):
+    spacing = [float(value) for value in self.fields.get("ElementSpacing", "1 1 1").split()]
+    return (spacing + [1.0, 1.0, 1.0])[:3]
+
+  @property
+  def origin(self):
+    """Origin of the frames in RAS. Metafile geometry is stored in LPS.
+    """
+    offset = [float(value) for value in self.fields.get("Offset", self.fields.get("Position", "0 0 0")).split()]
+    offset = (offset + [0.0, 0.0, 0.0])[:3]
+    return [-offset[0], -offset[1], offset[2]]
+
+  @property
+  def ijkToRasDirections(self):
+    """3x3 list, column i is the direction of image axis i in RAS. The TransformMatrix of the metafile lists
+    the LPS directions of the axes one after the other, including the axis of the frames.
+    """
+    values = [float(value) for value in self.fields.get("TransformMatrix", self.fields.get("Orientation", "")).split()]
+    numberOfDimensions = int(round(len(values) ** 0.5))
+    directions = numpy.eye(3)
+    if numberOfDimensions > 0 and numberOfDimensions * numberOfDimensions == len(values):
+      axisDirections = numpy.array(values).reshape(numberOfDimensions, numberOfDimensions)
+      size = min(numberOfDimensions, 3)
+      directions[:size, :size] = axisDirections[:size, :size].T
+    directions[:2] *= -1.0
+    return directions.tolist()
+
+  @property
+  def elementType(self):
+    elementType = numpy.dtype(METAIO_ELEMENT_TYPES[self.fields.get("ElementType", "MET_UCHAR")])
+    byteOrderMsb = self.fields.get("BinaryDataByteOrderMSB", self.fields.get("ElementByteOrderMSB", "False"))
+    return elementType.newbyteorder(">" if byteOrderMsb.lower() == "true" else "<")
+
+  @property
+  def hasCompressedData(self):
+    """Compressed pixel data can only be read as a whole, frames cannot be read on demand
+    """
+    return self.fields.get("CompressedData", "False").lower() == "true"
+
+  @property
+  def hasImageData(self):
+    shape = self.frameShape
+    return shape is not None and numpy.prod(shape) > 0 and self.fields.get("ElementDataFile", "LOCAL") != ""
+
+  def getFrameFieldNames(self):
+    names = []
+    for frameFields in self.frameFields[:1]:
+      names = list(frameFields.keys())
+    return names
+
+  def getTimestampStrings(self):
+    return [frameFields.get(TIMESTAMP_FIELD, str(frameIndex)) for frameIndex, frameFields in enumerate(self.frameFields)]
+
+  def getTransformNames(self):
+    """Returns the names of all transforms stored in the file, e.g. ProbeToTracker for ProbeToTrackerTransform
+    """
+    return [name[:-len(TRANSFORM_SUFFIX)] for name in self.getFrameFieldNames() if name.endswith(TRANSFORM_SUFFIX)]
+
+  def getTransformMatrices(self, transformName):
+    """Returns an (N,4,4) array of matrices and an (N,) boolean array that is False for frames where the
+    transform status is not OK
+    """
+    frameIndices = []
+    matrixStrings = []
+    valid = numpy.zeros(self.numberOfFrames, dtype=bool)
+    for frameIndex, frameFields in enumerate(self.frameFields):
+      matrixString = frameFields.get(transformName + TRANSFORM_SUFFIX)
+      if not matrixString:
+        continue
+      frameIndices.append(frameIndex)
+      matrixStrings.append(matrixString)
+      valid[frameIndex] = (frameFields.get(transformName + TRANSFORM_STATUS_SUFFIX, "OK") == "OK")
+    return parseMatrices(self.numberOfFrames, frameIndices, matrixStrings), valid
+
+  def getTransforms(self):
+    matrices = collections.OrderedDict()
+    valid = {}
+    for transformName in self.getTransformNames():
+      matrices[transformName], valid[transformName] = self.getTransformMatrices(transformName)
+    return MetafileTransforms(self.getTimestampStrings(), matrices, valid)
+
+  def getPixelData(self):
+    """Memory-mapped (N, slices, rows, columns[, components]) view of all frames. Nothing is read until it is accessed.
+    """
+    if self._pixelData is None:
+      if self.hasCompressedData:
+        raise ValueError("Compressed image data cannot be memory-mapped: " + self.fileName)
+      dataFileName = self.fields.get("ElementDataFile", "LOCAL")
+      if dataFileName == "LOCAL":
+        dataFileName = self.fileName
+        offset = self.dataOffset
+      else:
+        dataFileName = os.path.join(os.path.dirname(self.fileName), dataFileName)
+        offset = int(self.fields.get("HeaderSize", "0"))
+      shape = (self.numberOfFrames,) + self.frameShape
+      self._pixelData = numpy.memmap(dataFileName, dtype=self.elementType, mode="r", offset=offset, shape=shape)
+    return self._pixelData
+
+  def getFrame(self, frameIndex):
+    """Returns a decoded (native byte order, contiguous) copy of a frame, using the cache of recently used frames
+    """
+    frame = self._frameCache.get(frameIndex)
+    if frame is not None:
+      self._frameCache.move_to_end(frameIndex)
+      return frame
+    frame = numpy.ascontiguousarray(self.getPixelData()[frameIndex], dtype=self.elementType.newbyteorder("="))
+    self._frameCache[frameIndex] = frame
+    while len(self._frameCache) > self.maximumNumberOfCachedFrames:
+      self._frameCache.popitem(last=False)
+    return frame
+
+  def clearFrameCache(self):
+    self._frameCache.clear()
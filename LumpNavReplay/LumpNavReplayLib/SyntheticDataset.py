@@ -0,0 +1,373 @@
+"""Generation of synthetic LumpNav cases for tests and benchmarks.
+
+A case consists of the same files as a recorded surgery:
+
+- TransducerToProbe.tfm: calibration transform (ITK text format)
+- <case>-Scene.mrml: scene with the ReferenceToRas, CauteryTipToCautery, CauteryModelToCauteryTip, NeedleTipToNeedle
+  and NeedleModelToNeedleTip transforms, the TumorModel, CauteryModel and NeedleModel models (legacy .vtk files) and
+  three 3D views with cameras looking at the tumor
+- <case>-Recording.mha: ultrasound frames with the TrackerToReference, NeedleToTracker, CauteryToTracker,
+  ProbeToTracker and ImageToTransducer transforms
+- <case>-Tracking.mha: the tracker transforms at a higher rate, without images
+
+Only numpy is needed, so cases can be generated outside of Slicer:
+
+  python -m LumpNavReplayLib.SyntheticDataset --output cases --frames 300 --image-size 256 192 --cases 4
+
+This also writes cases/manifest.csv, which can be used with BatchReplay.
+"""
+
+import argparse
+import csv
+import math
+import os
+import sys
+import zlib
+
+import numpy
+
+from LumpNavReplayLib.BatchReplay import MANIFEST_COLUMNS
+
+START_TIME_SECONDS = 1000.0
+TUMOR_RADIUS_MM = 12.0
+NEEDLE_TIP_OFFSET_MM = 80.0
+CAUTERY_TIP_OFFSET_MM = 160.0
+IMAGE_SPACING_MM = 0.2
+# Number of frames generated and written at once
+FRAMES_PER_CHUNK = 64
+
+
+def translationMatrix(x, y, z):
+  matrix = numpy.eye(4)
+  matrix[:3, 3] = [x, y, z]
+  return matrix
+
+
+def rotationMatrices(axis, anglesRadians):
+  """Returns an (N,4,4) array of rotations about the x, y or z axis
+  """
+  anglesRadians = numpy.asarray(anglesRadians, dtype=numpy.float64)
+  cosines = numpy.cos(anglesRadians)
+  sines = numpy.sin(anglesRadians)
+  first, second = {"x": (1, 2), "y": (2, 0), "z": (0, 1)}[axis]
+  matrices = numpy.tile(numpy.eye(4), (len(anglesRadians), 1, 1))
+  matrices[:, first, first] = cosines
+  matrices[:, first, second] = -sines
+  matrices[:, second, first] = sines
+  matrices[:, second, second] = cosines
+  return matrices
+
+
+def generateTransforms(timesSeconds):
+  """Returns the tracker transforms at the given times (seconds from the start of the case) as (N,4,4) arrays.
+  The needle (with the tumor at its tip) drifts slowly, the cautery circles around the tumor and the probe
+  sweeps over it.
+  """
+  timesSeconds = numpy.asarray(timesSeconds, dtype=numpy.float64)
+  numberOfFrames = len(timesSeconds)
+  transforms = {}
+
+  # Reference is fixed to the patient, it moves a little with breathing
+  trackerToReference = numpy.tile(numpy.eye(4), (numberOfFrames, 1, 1))
+  trackerToReference[:, 2, 3] = 1.5 * numpy.sin(2 * math.pi * 0.25 * timesSeconds)
+  transforms["TrackerToReference"] = trackerToReference
+
+  needleToTracker = numpy.matmul(translationMatrix(0.0, 0.0, -200.0), rotationMatrices("x", numpy.full(numberOfFrames, math.radians(30.0))))
+  needleToTracker[:, 0, 3] += 3.0 * numpy.sin(2 * math.pi * 0.02 * timesSeconds)
+  needleToTracker[:, 1, 3] += 2.0 * numpy.sin(2 * math.pi * 0.03 * timesSeconds)
+  transforms["NeedleToTracker"] = needleToTracker
+
+  # Tumor center in tracker coordinates
+  needleTipToTracker = numpy.matmul(needleToTracker, translationMatrix(0.0, 0.0, NEEDLE_TIP_OFFSET_MM))
+  tumorCenters = needleTipToTracker[:, :3, 3]
+
+  cauteryAngles = 2 * math.pi * 0.1 * timesSeconds
+  cauteryDistances = TUMOR_RADIUS_MM + 5.0 + 10.0 * (1.0 + numpy.sin(2 * math.pi * 0.05 * timesSeconds))
+  cauteryTipPositions = tumorCenters + numpy.stack([cauteryDistances * numpy.cos(cauteryAngles),
+    cauteryDistances * numpy.sin(cauteryAngles), numpy.zeros(numberOfFrames)], axis=1)
+  cauteryToTracker = numpy.matmul(rotationMatrices("z", cauteryAngles), rotationMatrices("x", numpy.full(numberOfFrames, math.radians(160.0))))
+  cauteryToTracker[:, :3, 3] = cauteryTipPositions - numpy.matmul(cauteryToTracker[:, :3, :3], [0.0, 0.0, CAUTERY_TIP_OFFSET_MM])
+  transforms["CauteryToTracker"] = cauteryToTracker
+
+  probeToTracker = numpy.matmul(rotationMatrices("y", 0.2 * numpy.sin(2 * math.pi * 0.07 * timesSeconds)),
+    rotationMatrices("x", numpy.full(numberOfFrames, math.radians(180.0))))
+  probeToTracker[:, :3, 3] = tumorCenters + [0.0, 0.0, 40.0]
+  probeToTracker[:, 0, 3] += 20.0 * numpy.sin(2 * math.pi * 0.05 * timesSeconds)
+  transforms["ProbeToTracker"] = probeToTracker
+  return transforms
+
+
+def getImageToTransducer(imageSize):
+  imageToTransducer = numpy.diag([IMAGE_SPACING_MM, IMAGE_SPACING_MM, IMAGE_SPACING_MM, 1.0])
+  imageToTransducer[0, 3] = -0.5 * imageSize[0] * IMAGE_SPACING_MM
+  return imageToTransducer
+
+
+def generateImages(frameIndices, imageSize, randomState):
+  """Returns (N, rows, columns) uint8 B-mode like frames: speckle with a dark lesion that moves across the image
+  """
+  columns, rows = imageSize
+  images = randomState.rayleigh(40.0, size=(len(frameIndices), rows, columns))
+  rowCoordinates, columnCoordinates = numpy.mgrid[0:rows, 0:columns]
+  lesionRadius = 0.15 * min(rows, columns)
+  for imageIndex, frameIndex in enumerate(frameIndices):
+    lesionColumn = columns * (0.5 + 0.25 * math.sin(0.05 * frameIndex))
+    lesion = (rowCoordinates - 0.5 * rows) ** 2 + (columnCoordinates - lesionColumn) ** 2 < lesionRadius ** 2
+    images[imageIndex][lesion] *= 0.3
+  # Attenuation with depth
+  images *= numpy.linspace(1.2, 0.4, rows)[:, numpy.newaxis]
+  return numpy.clip(images, 0, 255).astype(numpy.uint8)
+
+
+def formatMatrix(matrix):
+  return " ".join("{0:.6f}".format(value) for value in matrix.ravel())
+
+
+def writeSequenceMetafile(fileName, timestampsSeconds, transforms, imageSize=None, randomState=None, compressed=False,
+                          imageOffset=(0.0, 0.0, 0.0), imageDirections=None):
+  """Writes a Plus sequence metafile with the given (N,4,4) transforms and, if imageSize (columns, rows)
+  is specified, N synthetic ultrasound frames. Compressed image data is generated in memory.
+  imageOffset and imageDirections (3x3, column i is the direction of image axis i) are in LPS, as in the metafile.
+  """
+  numberOfFrames = len(timestampsSeconds)
+  columns, rows = imageSize if imageSize else (0, 0)
+  header = [
+    "ObjectType = Image",
+    "NDims = 3",
+    "AnatomicalOrientation = RAI",
+    "BinaryData = True",
+    "BinaryDataByteOrderMSB = False",
+    "CenterOfRotation = 0 0 0",
+    "CompressedData = {0}".format(compressed),
+    "DimSize = {0} {1} {2}".format(columns, rows, numberOfFrames),
+    "ElementNumberOfChannels = 1",
+    "ElementSpacing = 1 1 1",
+    "Offset = {0}".format(formatMatrix(numpy.asarray(imageOffset, dtype=float))),
+    "TransformMatrix = {0}".format(formatMatrix(numpy.eye(3) if imageDirections is None else numpy.asarray(imageDirections, dtype=float).T)),
+    "ElementType = MET_UCHAR",
+    "Kinds = domain domain list",
+    "UltrasoundImageOrientation = MF",
+    "UltrasoundImageType = BRIGHTNESS",
+    ]
+  for frameIndex in range(numberOfFrames):
+    prefix = "Seq_Frame{0:04d}_".format(frameIndex)
+    header.append(prefix + "FrameNumber = {0}".format(frameIndex))
+    header.append(prefix + "Timestamp = {0:.6f}".format(timestampsSeconds[frameIndex]))
+    if imageSize:
+      header.append(prefix + "ImageStatus = OK")
+    for transformName, matrices in transforms.items():
+      header.append(prefix + "{0}Transform = {1}".format(transformName, formatMatrix(matrices[frameIndex])))
+      header.append(prefix + "{0}TransformStatus = OK".format(transformName))
+  if randomState is None:
+    randomState = numpy.random.RandomState(0)
+  compressedData = None
+  if imageSize and compressed:
+    compressor = zlib.compressobj()
+    compressedChunks = []
+    for chunkStart in range(0, numberOfFrames, FRAMES_PER_CHUNK):
+      frameIndices = range(chunkStart, min(chunkStart + FRAMES_PER_CHUNK, numberOfFrames))
+      compressedChunks.append(compressor.compress(generateImages(frameIndices, imageSize, randomState).tobytes()))
+    compressedChunks.append(compressor.flush())
+    compressedData = b"".join(compressedChunks)
+    header.append("CompressedDataSize = {0}".format(len(compressedData)))
+  header.append("ElementDataFile = LOCAL")
+
+  with open(fileName, "wb") as metafile:
+    metafile.write(("\n".join(header) + "\n").encode("latin-1"))
+    if not imageSize:
+      return
+    if compressedData is not None:
+      metafile.write(compressedData)
+      return
+    for chunkStart in range(0, numberOfFrames, FRAMES_PER_CHUNK):
+      frameIndices = range(chunkStart, min(chunkStart + FRAMES_PER_CHUNK, numberOfFrames))
+      metafile.write(generateImages(frameIndices, imageSize, randomState).tobytes())
+
+
+def writeItkTransform(fileName, matrix):
+  """Writes a linear transform in ITK text format. ITK stores the transform from the fixed (LPS) to the moving space,
+  i.e. the inverse of the RAS transform to parent.
+  """
+  rasToLps = numpy.diag([-1.0, -1.0, 1.0, 1.0])
+  itkMatrix = rasToLps.dot(numpy.linalg.inv(matrix)).dot(rasToLps)
+  parameters = list(itkMatrix[:3, :3].ravel()) + list(itkMatrix[:3, 3])
+  with open(fileName, "w") as transformFile:
+    transformFile.write("#Insight Transform File V1.0\n")
+    transformFile.write("#Transform 0\n")
+    transformFile.write("Transform: AffineTransform_double_3_3\n")
+    transformFile.write("Parameters: {0}\n".format(" ".join("{0:.10g}".format(value) for value in parameters)))
+    transformFile.write("FixedParameters: 0 0 0\n")
+
+
+def createSphere(radius, center=(0.0, 0.0, 0.0), resolution=24):
+  """Returns the points (N,3) and triangles (M,3) of a UV sphere
+  """
+  polarAngles = numpy.linspace(0.0, math.pi, resolution + 1)[1:-1]
+  azimuthAngles = numpy.linspace(0.0, 2 * math.pi, 2 * resolution, endpoint=False)
+  polar, azimuth = numpy.meshgrid(polarAngles, azimuthAngles, indexing="ij")
+  ringPoints = numpy.stack([numpy.sin(polar) * numpy.cos(azimuth), numpy.sin(polar) * numpy.sin(azimuth), numpy.cos(polar)], axis=-1).reshape(-1, 3)
+  points = numpy.vstack([[0.0, 0.0, 1.0], ringPoints, [0.0, 0.0, -1.0]]) * radius + center
+  numberOfRings, pointsPerRing = polar.shape
+  triangles = []
+  for column in range(pointsPerRing):
+    nextColumn = (column + 1) % pointsPerRing
+    triangles.append([0, 1 + column, 1 + nextColumn])
+    for ring in range(numberOfRings - 1):
+      current = 1 + ring * pointsPerRing
+      below = current + pointsPerRing
+      triangles.append([current + column, below + column, below + nextColumn])
+      triangles.append([current + column, below + nextColumn, current + nextColumn])
+    last = 1 + (numberOfRings - 1) * pointsPerRing
+    triangles.append([last + column, len(points) - 1, last + nextColumn])
+  return points, numpy.array(triangles)
+
+
+def createCylinder(radius, length, resolution=16):
+  """Returns the points and triangles of a closed cylinder along the z axis from z=0 to z=length
+  """
+  angles = numpy.linspace(0.0, 2 * math.pi, resolution, endpoint=False)
+  ring = numpy.stack([radius * numpy.cos(angles), radius * numpy.sin(angles)], axis=1)
+  points = numpy.vstack([numpy.hstack([ring, numpy.zeros((resolution, 1))]), numpy.hstack([ring, numpy.full((resolution, 1), length)]),
+    [[0.0, 0.0, 0.0], [0.0, 0.0, length]]])
+  triangles = []
+  for index in range(resolution):
+    nextIndex = (index + 1) % resolution
+    triangles.append([index, nextIndex, resolution + nextIndex])
+    triangles.append([index, resolution + nextIndex, resolution + index])
+    triangles.append([2 * resolution, nextIndex, index])
+    triangles.append([2 * resolution + 1, resolution + index, resolution + nextIndex])
+  return points, numpy.array(triangles)
+
+
+def writeVtkPolyData(fileName, points, triangles):
+  with open(fileName, "w") as vtkFile:
+    vtkFile.write("# vtk DataFile Version 3.0\n")
+    vtkFile.write("SPACE=RAS\n")
+    vtkFile.write("ASCII\n")
+    vtkFile.write("DATASET POLYDATA\n")
+    vtkFile.write("POINTS {0} float\n".format(len(points)))
+    for point in points:
+      vtkFile.write("{0:.6f} {1:.6f} {2:.6f}\n".format(*point))
+    vtkFile.write("POLYGONS {0} {1}\n".format(len(triangles), 4 * len(triangles)))
+    for triangle in triangles:
+      vtkFile.write("3 {0} {1} {2}\n".format(*triangle))
+
+
+def writeScene(fileName, viewFocalPoint):
+  """Writes the MRML scene that LumpNavReplayLogic.loadScene expects, with models stored next to it
+  """
+  sceneDirectory = os.path.dirname(os.path.abspath(fileName))
+  # The tumor is attached to the needle (its points are in needle coordinates), the tools are drawn from their tip
+  models = [
+    ("TumorModel", createSphere(TUMOR_RADIUS_MM, (0.0, 0.0, NEEDLE_TIP_OFFSET_MM)), "", "1 1 0"),
+    ("CauteryModel", createCylinder(2.0, CAUTERY_TIP_OFFSET_MM), "vtkMRMLLinearTransformNode_CauteryModelToCauteryTip", "1 0 0"),
+    ("NeedleModel", createCylinder(0.6, NEEDLE_TIP_OFFSET_MM), "vtkMRMLLinearTransformNode_NeedleModelToNeedleTip", "0 1 1"),
+    ]
+  transforms = [
+    ("ReferenceToRas", numpy.eye(4), ""),
+    ("CauteryTipToCautery", translationMatrix(0.0, 0.0, CAUTERY_TIP_OFFSET_MM), ""),
+    ("CauteryModelToCauteryTip", translationMatrix(0.0, 0.0, -CAUTERY_TIP_OFFSET_MM), "vtkMRMLLinearTransformNode_CauteryTipToCautery"),
+    ("NeedleTipToNeedle", translationMatrix(0.0, 0.0, NEEDLE_TIP_OFFSET_MM), ""),
+    ("NeedleModelToNeedleTip", translationMatrix(0.0, 0.0, -NEEDLE_TIP_OFFSET_MM), "vtkMRMLLinearTransformNode_NeedleTipToNeedle"),
+    ]
+  # Left, right and bottom views of the triple 3D layout, looking at the tumor from different directions
+  cameraDirections = [(-1.0, 0.0, 1.0), (1.0, 0.0, 1.0), (0.0, -1.0, 0.0)]
+
+  lines = ['<MRML version="Slicer4.4.0" userTags="">']
+  for name, matrix, parentId in transforms:
+    lines.append(' <LinearTransform id="vtkMRMLLinearTransformNode_{0}" name="{0}" hideFromEditors="false" selectable="true" selected="false"'
+      ' references="{1}" matrixTransformToParent="{2}"></LinearTransform>'.format(name, "transform:" + parentId + ";" if parentId else "", formatMatrix(matrix)))
+  for name, (points, triangles), parentId, color in models:
+    modelFileName = name + ".vtk"
+    writeVtkPolyData(os.path.join(sceneDirectory, modelFileName), points, triangles)
+    lines.append(' <ModelDisplay id="vtkMRMLModelDisplayNode_{0}" name="{0}Display" hideFromEditors="true" selectable="true" selected="false"'
+      ' color="{1}" visibility="true" opacity="1"></ModelDisplay>'.format(name, color))
+    lines.append(' <ModelStorage id="vtkMRMLModelStorageNode_{0}" name="{0}Storage" hideFromEditors="true" selectable="true" selected="false"'
+      ' fileName="{1}" useCompression="1"></ModelStorage>'.format(name, modelFileName))
+    references = "display:vtkMRMLModelDisplayNode_{0};storage:vtkMRMLModelStorageNode_{0};".format(name)
+    if parentId:
+      references += "transform:" + parentId + ";"
+    lines.append(' <Model id="vtkMRMLModelNode_{0}" name="{0}" hideFromEditors="false" selectable="true" selected="false"'
+      ' references="{1}"></Model>'.format(name, references))
+  for viewIndex, direction in enumerate(cameraDirections):
+    viewNumber = viewIndex + 1
+    position = numpy.asarray(viewFocalPoint) + 300.0 * numpy.asarray(direction) / numpy.linalg.norm(direction)
+    viewUp = (0.0, 0.0, 1.0) if direction[2] == 0.0 else (0.0, 1.0, 0.0)
+    lines.append(' <View id="vtkMRMLViewNode{0}" name="View{0}" hideFromEditors="false" selectable="true" selected="false"'
+      ' singletonTag="{0}" layoutName="{0}" visibility="true"></View>'.format(viewNumber))
+    lines.append(' <Camera id="vtkMRMLCameraNode{0}" name="Camera{0}" hideFromEditors="false" selectable="true" selected="false"'
+      ' singletonTag="{0}" layoutName="{0}" activetag="vtkMRMLViewNode{0}" position="{1}" focalPoint="{2}" viewUp="{3}" parallelProjection="false"'
+      ' parallelScale="1" viewAngle="30"></Camera>'.format(viewNumber, " ".join(str(value) for value in position),
+        " ".join(str(value) for value in viewFocalPoint), " ".join(str(value) for value in viewUp)))
+  lines.append('</MRML>')
+  with open(fileName, "w") as sceneFile:
+    sceneFile.write("\n".join(lines) + "\n")
+
+
+def generateCase(outputDirectory, caseName="SyntheticCase", numberOfRecordingFrames=100, imageSize=(128, 96),
+                 recordingFrameRate=15.0, trackingFrameRate=30.0, seed=0, compressRecording=False,
+                 imageOffset=(0.0, 0.0, 0.0), imageDirections=None):
+  """Writes all files of a synthetic case to outputDirectory and returns the case as a dictionary keyed by
+  BatchReplay.MANIFEST_COLUMNS (with absolute file names). imageSize is (columns, rows).
+  If compressRecording is True, the images of the recording are written with CompressedData = True.
+  imageOffset and imageDirections set the geometry of the recorded images, see writeSequenceMetafile.
+  """
+  if not os.path.isdir(outputDirectory):
+    os.makedirs(outputDirectory)
+  case = {"Case": caseName}
+  case["TransducerToProbeFile"] = os.path.abspath(os.path.join(outputDirectory, "TransducerToProbe.tfm"))
+  case["SceneFile"] = os.path.abspath(os.path.join(outputDirectory, caseName + "-Scene.mrml"))
+  case["RecordingFile"] = os.path.abspath(os.path.join(outputDirectory, caseName + "-Recording.mha"))
+  case["TrackingFile"] = os.path.abspath(os.path.join(outputDirectory, caseName + "-Tracking.mha"))
+
+  writeItkTransform(case["TransducerToProbeFile"], numpy.eye(4))
+
+  durationSeconds = numberOfRecordingFrames / recordingFrameRate
+  recordingTimes = numpy.arange(numberOfRecordingFrames) / recordingFrameRate
+  recordingTransforms = generateTransforms(recordingTimes)
+  recordingTransforms["ImageToTransducer"] = numpy.tile(getImageToTransducer(imageSize), (numberOfRecordingFrames, 1, 1))
+  writeSequenceMetafile(case["RecordingFile"], START_TIME_SECONDS + recordingTimes, recordingTransforms, imageSize,
+    numpy.random.RandomState(seed), compressRecording, imageOffset, imageDirections)
+
+  trackingTimes = numpy.arange(int(round(durationSeconds * trackingFrameRate))) / trackingFrameRate
+  writeSequenceMetafile(case["TrackingFile"], START_TIME_SECONDS + trackingTimes, generateTransforms(trackingTimes))
+
+  tumorCenter = numpy.matmul(recordingTransforms["NeedleToTracker"][0], [0.0, 0.0, NEEDLE_TIP_OFFSET_MM, 1.0])[:3]
+  writeScene(case["SceneFile"], tumorCenter)
+  return case
+
+
+def writeManifest(fileName, cases):
+  """Writes the cases to a manifest for BatchReplay, with file names relative to the manifest
+  """
+  manifestDirectory = os.path.dirname(os.path.abspath(fileName))
+  with open(fileName, "w") as manifestFile:
+    writer = csv.DictWriter(manifestFile, MANIFEST_COLUMNS, lineterminator="\n")
+    writer.writeheader()
+    for case in cases:
+      row = {"Case": case["Case"]}
+      for column in MANIFEST_COLUMNS[1:]:
+        row[column] = os.path.relpath(case[column], manifestDirectory)
+      writer.writerow(row)
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description="Generate synthetic LumpNav cases and a manifest for BatchReplay.")
+  parser.add_argument("--output", required=True, help="Output folder")
+  parser.add_argument("--cases", type=int, default=1, help="Number of cases")
+  parser.add_argument("--frames", type=int, default=100, help="Number of ultrasound frames per case")
+  parser.add_argument("--image-size", dest="imageSize", type=int, nargs=2, default=[128, 96], metavar=("COLUMNS", "ROWS"), help="Ultrasound image size")
+  parser.add_argument("--recording-rate", dest="recordingFrameRate", type=float, default=15.0, help="Ultrasound frames per second")
+  parser.add_argument("--tracking-rate", dest="trackingFrameRate", type=float, default=30.0, help="Tracking frames per second")
+  arguments = parser.parse_args(argv)
+  cases = []
+  for caseIndex in range(arguments.cases):
+    caseName = "Case{0:03d}".format(caseIndex + 1)
+    cases.append(generateCase(os.path.join(arguments.output, caseName), caseName, arguments.frames, tuple(arguments.imageSize),
+      arguments.recordingFrameRate, arguments.trackingFrameRate, seed=caseIndex))
+  writeManifest(os.path.join(arguments.output, "manifest.csv"), cases)
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
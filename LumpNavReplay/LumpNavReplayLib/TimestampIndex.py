@@ -0,0 +1,61 @@
+"""Lookup of sequence items by acquisition time.
+
+The index values of a sequence are stored once in a sorted array, so finding the item that is closest
+in time to a timestamp is a binary search instead of a scan over all items.
+"""
+
+import numpy
+
+
+def getSynchronizedItemNumbers(browserNode, sequenceNode):
+  """Returns the item number of sequenceNode that the browser shows for each item of its master sequence.
+  Master items before the first item of sequenceNode get its first item.
+  """
+  masterSequenceNode = browserNode.GetMasterSequenceNode()
+  numberOfItems = masterSequenceNode.GetNumberOfDataNodes()
+  if sequenceNode == masterSequenceNode:
+    return numpy.arange(numberOfItems)
+  itemNumbers = numpy.array([sequenceNode.GetItemNumberFromIndexValue(masterSequenceNode.GetNthIndexValue(itemNumber), False)
+    for itemNumber in range(numberOfItems)], dtype=int)
+  # Not found is -1, which would index the last item
+  return numpy.maximum(itemNumbers, 0)
+
+
+class TimestampIndex(object):
+
+  def __init__(self, timestamps):
+    timestamps = numpy.asarray(timestamps, dtype=numpy.float64)
+    self.itemNumbers = numpy.argsort(timestamps, kind="stable")
+    self.timestamps = timestamps[self.itemNumbers]
+
+  @classmethod
+  def fromSequenceNode(cls, sequenceNode):
+    return cls([float(sequenceNode.GetNthIndexValue(itemNumber)) for itemNumber in range(sequenceNode.GetNumberOfDataNodes())])
+
+  def __len__(self):
+    return len(self.timestamps)
+
+  def getItemNumber(self, timestamp):
+    """Returns the number of the item that is closest in time to timestamp, or -1 if the index is empty
+    """
+    numberOfItems = len(self.timestamps)
+    if numberOfItems == 0:
+      return -1
+    position = int(numpy.searchsorted(self.timestamps, timestamp))
+    if position >= numberOfItems:
+      position = numberOfItems - 1
+    elif position > 0 and (timestamp - self.timestamps[position - 1]) <= (self.timestamps[position] - timestamp):
+      position -= 1
+    return int(self.itemNumbers[position])
+
+  def getItemNumbers(self, timestamps):
+    """Vectorized getItemNumber for an array of timestamps
+    """
+    timestamps = numpy.asarray(timestamps, dtype=numpy.float64)
+    if len(self.timestamps) < 2:
+      return numpy.full(timestamps.shape, self.itemNumbers[0] if len(self.timestamps) else -1, dtype=int)
+    positions = numpy.clip(numpy.searchsorted(self.timestamps, timestamps), 1, len(self.timestamps) - 1)
+    previousPositions = positions - 1
+    usePrevious = numpy.abs(timestamps - self.timestamps[previousPositions]) <= numpy.abs(self.timestamps[positions] - timestamps)
+    positions = numpy.where(usePrevious, previousPositions, positions)
+    return self.itemNumbers[positions]
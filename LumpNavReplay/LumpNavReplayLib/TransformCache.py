@@ -0,0 +1,164 @@
+"""On-disk cache of the timestamps and transforms read from sequence metafile headers.
+
+Each cache entry is an uncompressed numpy .npz file with the timestamp strings and, for each transform,
+the (N,4,4) float64 matrices and the (N,) validity flags. An entry written for a subset of the transforms
+also stores the requested names, so that it can serve any request for a subset of them. Entries are identified by a key computed from
+the size, modification time and a content hash of the input file, so an edited or replaced file is
+never served from the cache. The content hash covers only the beginning and end of the file to keep
+warm loads of large recordings fast.
+
+Without a cache directory the entry is stored next to the input file (<input file>.transforms.npz).
+With a cache directory all entries are stored there and the least recently used entries are removed
+when the total size exceeds the limit.
+"""
+
+import collections
+import hashlib
+import logging
+import os
+import tempfile
+
+import numpy
+
+from LumpNavReplayLib.SequenceMetafile import MetafileTransforms, readMetafileTransforms
+
+CACHE_FORMAT_VERSION = 1
+CACHE_FILE_SUFFIX = ".transforms.npz"
+HASHED_BYTES_AT_EACH_END = 1024 * 1024
+
+
+def computeCacheKey(fileName):
+  """Returns a hex digest of the size, modification time and content (first and last MB) of a file
+  """
+  fileStat = os.stat(fileName)
+  keyHash = hashlib.sha1()
+  keyHash.update("{0} {1} {2}".format(CACHE_FORMAT_VERSION, fileStat.st_size, fileStat.st_mtime_ns).encode())
+  with open(fileName, "rb") as inputFile:
+    keyHash.update(inputFile.read(HASHED_BYTES_AT_EACH_END))
+    if fileStat.st_size > 2 * HASHED_BYTES_AT_EACH_END:
+      inputFile.seek(-HASHED_BYTES_AT_EACH_END, os.SEEK_END)
+      keyHash.update(inputFile.read(HASHED_BYTES_AT_EACH_END))
+  return keyHash.hexdigest()
+
+
+class TransformCache(object):
+
+  def __init__(self, cacheDirectory=None, maximumSizeBytes=1024 * 1024 * 1024):
+    self.cacheDirectory = cacheDirectory
+    self.maximumSizeBytes = maximumSizeBytes
+
+  def getCacheFileName(self, fileName, cacheKey):
+    if self.cacheDirectory:
+      return os.path.join(self.cacheDirectory, cacheKey + CACHE_FILE_SUFFIX)
+    return fileName + CACHE_FILE_SUFFIX
+
+  def load(self, fileName, transformNames=None, cacheKey=None):
+    """Returns the cached MetafileTransforms of the file, or None if the cache has no up-to-date entry
+    that was written for all the requested transforms. As in readMetafileTransforms, the transforms are in the
+    order of the file and requested transforms that are not in the file are left out.
+    """
+    if cacheKey is None:
+      cacheKey = computeCacheKey(fileName)
+    cacheFileName = self.getCacheFileName(fileName, cacheKey)
+    if not os.path.exists(cacheFileName):
+      return None
+    try:
+      with numpy.load(cacheFileName) as cacheEntry:
+        if str(cacheEntry["cacheKey"]) != cacheKey:
+          return None
+        cachedTransformNames = [str(name) for name in cacheEntry["transformNames"]]
+        if not bool(cacheEntry["allTransforms"]):
+          # Entry was written for a subset of the transforms
+          if transformNames is None:
+            return None
+          requestedTransformNames = [str(name) for name in cacheEntry["requestedTransformNames"]]
+          if not set(transformNames).issubset(requestedTransformNames):
+            return None
+        if transformNames is not None:
+          wantedTransformNames = set(transformNames)
+          cachedTransformNames = [name for name in cachedTransformNames if name in wantedTransformNames]
+        indexValues = [str(indexValue) for indexValue in cacheEntry["indexValues"]]
+        matrices = collections.OrderedDict()
+        valid = {}
+        for transformName in cachedTransformNames:
+          matrices[transformName] = cacheEntry["matrices_" + transformName]
+          valid[transformName] = cacheEntry["valid_" + transformName]
+    except Exception as e:
+      logging.warning("Ignoring unreadable transform cache file {0}: {1}".format(cacheFileName, e))
+      return None
+    # Mark as recently used for eviction
+    os.utime(cacheFileName, None)
+    return MetafileTransforms(indexValues, matrices, valid)
+
+  def save(self, fileName, metafileTransforms, cacheKey=None, requestedTransformNames=None):
+    """Stores the transforms read for requestedTransformNames (None if all transforms were read)
+    """
+    if cacheKey is None:
+      cacheKey = computeCacheKey(fileName)
+    cacheFileName = self.getCacheFileName(fileName, cacheKey)
+    arrays = {
+      "cacheKey": numpy.array(cacheKey),
+      "transformNames": numpy.array(metafileTransforms.transformNames, dtype=str),
+      "indexValues": numpy.array(metafileTransforms.indexValues, dtype=str),
+      "allTransforms": numpy.array(requestedTransformNames is None),
+      "requestedTransformNames": numpy.array(requestedTransformNames or [], dtype=str),
+      }
+    for transformName in metafileTransforms.transformNames:
+      arrays["matrices_" + transformName] = numpy.ascontiguousarray(metafileTransforms.matrices[transformName], dtype=numpy.float64)
+      arrays["valid_" + transformName] = metafileTransforms.valid[transformName]
+    try:
+      if self.cacheDirectory and not os.path.isdir(self.cacheDirectory):
+        os.makedirs(self.cacheDirectory)
+      # Write to a temporary file first so that a partially written entry is never read. The name is unique,
+      # as several processes (e.g. BatchReplay workers) may write the entry of the same file at the same time.
+      temporaryFileHandle, temporaryFileName = tempfile.mkstemp(suffix=".tmp",
+        prefix=os.path.basename(cacheFileName) + ".", dir=os.path.dirname(os.path.abspath(cacheFileName)))
+      try:
+        with os.fdopen(temporaryFileHandle, "wb") as temporaryFile:
+          numpy.savez(temporaryFile, **arrays)
+        os.replace(temporaryFileName, cacheFileName)
+      except Exception:
+        os.remove(temporaryFileName)
+        raise
+    except (IOError, OSError) as e:
+      logging.warning("Could not write transform cache file {0}: {1}".format(cacheFileName, e))
+      return
+    self.evict()
+
+  def evict(self):
+    """Removes the least recently used entries of the cache directory until it is within maximumSizeBytes
+    """
+    if not self.cacheDirectory or not os.path.isdir(self.cacheDirectory):
+      return
+    entries = []
+    for entryName in os.listdir(self.cacheDirectory):
+      if not entryName.endswith(CACHE_FILE_SUFFIX):
+        continue
+      entryFileName = os.path.join(self.cacheDirectory, entryName)
+      try:
+        entryStat = os.stat(entryFileName)
+      except OSError:
+        # Removed by another loader in the meantime
+        continue
+      entries.append((entryStat.st_mtime, entryStat.st_size, entryFileName))
+    totalSizeBytes = sum(entry[1] for entry in entries)
+    for _, sizeBytes, entryFileName in sorted(entries):
+      if totalSizeBytes <= self.maximumSizeBytes:
+        break
+      try:
+        os.remove(entryFileName)
+        totalSizeBytes -= sizeBytes
+      except OSError:
+        pass
+
+  def readMetafileTransforms(self, fileName, transformNames=None):
+    """Same as SequenceMetafile.readMetafileTransforms, but served from the cache when possible
+    """
+    cacheKey = computeCacheKey(fileName)
+    metafileTransforms = self.load(fileName, transformNames, cacheKey)
+    if metafileTransforms is not None:
+      logging.debug("Transforms of {0} loaded from cache".format(fileName))
+      return metafileTransforms
+    metafileTransforms = readMetafileTransforms(fileName, transformNames)
+    self.save(fileName, metafileTransforms, cacheKey, transformNames)
+    return metafileTransforms
@@ -0,0 +1,125 @@
+"""Lookup of the 3D view widget, renderer and camera node of view nodes.
+
+Finding the widget of a view node requires a scan over all 3D widgets of the layout manager, which is
+too slow to do for every point or every frame. The registry does the scan once and keeps the result
+until the layout is changed or view or camera nodes are added to or removed from the scene.
+
+Use getViewRegistry() to get the instance that is shared by all modules.
+"""
+
+import slicer
+import vtk
+
+
+class ViewRegistryEntry(object):
+
+  def __init__(self, viewNode, threeDWidgetIndex, threeDView, renderer, cameraNode):
+    self.viewNode = viewNode
+    self.threeDWidgetIndex = threeDWidgetIndex
+    self.threeDView = threeDView
+    self.renderer = renderer
+    self.cameraNode = cameraNode
+
+
+class ViewRegistry(object):
+
+  def __init__(self):
+    self.entries = None
+    self.viewNodeIds = []
+    self.layoutManager = None
+    self.sceneObservations = []
+    self.observeScene()
+
+  def observeScene(self):
+    for event in [slicer.mrmlScene.NodeAddedEvent, slicer.mrmlScene.NodeRemovedEvent]:
+      self.sceneObservations.append(slicer.mrmlScene.AddObserver(event, self.onNodeAddedOrRemoved))
+    for event in [slicer.mrmlScene.EndCloseEvent, slicer.mrmlScene.EndImportEvent]:
+      self.sceneObservations.append(slicer.mrmlScene.AddObserver(event, self.onSceneModified))
+
+  def observeLayoutManager(self):
+    layoutManager = slicer.app.layoutManager()
+    if layoutManager is None or layoutManager is self.layoutManager:
+      return
+    self.layoutManager = layoutManager
+    # Widgets are created and reassigned to view nodes when the layout is changed
+    layoutManager.connect('layoutChanged(int)', self.onLayoutChanged)
+
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onNodeAddedOrRemoved(self, caller, event, node):
+    # Markups, transforms and sequence items are added during replay, only view and camera nodes change the views
+    if node is not None and (node.IsA("vtkMRMLViewNode") or node.IsA("vtkMRMLCameraNode")):
+      self.invalidate()
+
+  def onSceneModified(self, caller, event):
+    self.invalidate()
+
+  def onLayoutChanged(self, layout):
+    self.invalidate()
+
+  def invalidate(self):
+    self.entries = None
+
+  def update(self):
+    self.observeLayoutManager()
+    self.entries = {}
+    self.viewNodeIds = []
+    if self.layoutManager is None:
+      # No main window, there are no views to render into
+      return
+    camerasLogic = slicer.modules.cameras.logic()
+    for threeDWidgetIndex in range(self.layoutManager.threeDViewCount):
+      threeDView = self.layoutManager.threeDWidget(threeDWidgetIndex).threeDView()
+      viewNode = threeDView.mrmlViewNode()
+      if viewNode is None or viewNode.GetID() in self.entries:
+        continue
+      renderer = threeDView.renderWindow().GetRenderers().GetItemAsObject(0)
+      cameraNode = camerasLogic.GetViewActiveCameraNode(viewNode)
+      self.entries[viewNode.GetID()] = ViewRegistryEntry(viewNode, threeDWidgetIndex, threeDView, renderer, cameraNode)
+      self.viewNodeIds.append(viewNode.GetID())
+
+  def getEntry(self, viewNode):
+    """Returns the ViewRegistryEntry of a view node, or None if the view node is not shown in any 3D widget
+    """
+    if viewNode is None:
+      return None
+    if self.entries is None:
+      self.update()
+    return self.entries.get(viewNode.GetID())
+
+  def getViewNodes(self):
+    """Returns the view nodes of all 3D widgets, in the order of the widgets
+    """
+    if self.entries is None:
+      self.update()
+    return [self.entries[viewNodeId].viewNode for viewNodeId in self.viewNodeIds]
+
+  def getThreeDWidgetIndex(self, viewNode):
+    entry = self.getEntry(viewNode)
+    return entry.threeDWidgetIndex if entry else None
+
+  def getThreeDView(self, viewNode):
+    entry = self.getEntry(viewNode)
+    return entry.threeDView if entry else None
+
+  def getRenderer(self, viewNode):
+    entry = self.getEntry(viewNode)
+    return entry.renderer if entry else None
+
+  def getCameraNode(self, viewNode):
+    entry = self.getEntry(viewNode)
+    if entry is None:
+      # Camera nodes exist also for view nodes that are not shown
+      return slicer.modules.cameras.logic().GetViewActiveCameraNode(viewNode) if viewNode else None
+    return entry.cameraNode
+
+
+viewRegistry = None
+
+
+def getViewRegistry():
+  """Returns the view registry that is shared by all modules, creates it on first use
+  """
+  global viewRegistry
+  if viewRegistry is None:
+    viewRegistry = ViewRegistry()
+  return viewRegistry
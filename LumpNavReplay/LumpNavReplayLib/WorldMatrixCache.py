@@ -0,0 +1,217 @@
+"""Precomputed world matrices of displayed nodes for every item of a sequence browser.
+
+Without the cache every frame change updates the proxy transforms of the browser, and VTK then walks the
+whole parent transform chain of every model (e.g. CauteryModel, CauteryModelToCauteryTip, CauteryTipToCautery,
+CauteryToTracker, TrackerToReference, ReferenceToRas) to find its world matrix.
+
+The cache composes these chains for all items at once as (N,4,4) matrix products. While the cache is started
+each displayed node is moved under its own transform node that has no parent, and on every frame change that
+transform is set to the precomputed world matrix of the selected item in one assignment. The matrices of the
+sequences are read once; when a static (calibration) transform of a chain changes the chains are composed again.
+
+Proxy transforms of another browser node that is kept synchronized with the cache's browser (e.g. the recording
+proxies while the tracking data set is played) change on every frame change too. They are not static: their
+matrices are read from their sequences and mapped to the items of the cache's browser with the item numbers the
+synchronization selects.
+"""
+
+import numpy
+import slicer
+import vtk
+
+from LumpNavReplayLib.TimestampIndex import getSynchronizedItemNumbers
+
+
+def getMatrixToParent(transformNode):
+  matrix = vtk.vtkMatrix4x4()
+  transformNode.GetMatrixTransformToParent(matrix)
+  return slicer.util.arrayFromVTKMatrix(matrix)
+
+
+def getTransformMatrices(browserNode, transformNode):
+  """Returns the matrix to parent of a transform node for every item of the browser node as an (N,4,4) array.
+  Proxy nodes are read from their sequence without changing the selected item, other transforms are constant.
+  """
+  masterSequenceNode = browserNode.GetMasterSequenceNode()
+  numberOfItems = masterSequenceNode.GetNumberOfDataNodes()
+  sequenceNode = browserNode.GetSequenceNode(transformNode)
+  if not sequenceNode:
+    return numpy.tile(getMatrixToParent(transformNode), (numberOfItems, 1, 1))
+  matrices = numpy.zeros((sequenceNode.GetNumberOfDataNodes(), 4, 4))
+  for itemNumber in range(sequenceNode.GetNumberOfDataNodes()):
+    matrices[itemNumber] = getMatrixToParent(sequenceNode.GetNthDataNode(itemNumber))
+  if sequenceNode == masterSequenceNode:
+    return matrices
+  # Synchronized sequences may have different items, use the item the browser would show
+  return matrices[getSynchronizedItemNumbers(browserNode, sequenceNode)]
+
+
+class WorldMatrixCache(object):
+
+  def __init__(self, browserNode):
+    self.browserNode = browserNode
+    # Matrices of the proxy transforms of the browser and of synchronized browsers, keyed by node ID, read once
+    self.sequenceMatrices = {}
+    # Item number of each synchronized browser for every item of the browser, keyed by browser node ID
+    self.synchronizedItemNumbers = {}
+    self.started = False
+    self.displayedNodes = []
+    self.originalParentNodeIDs = {}
+    self.cacheTransformNodes = {}
+    self.chains = {}
+    self.worldMatrices = {}
+    self.staticMatrices = {}
+    self.observations = []
+    self.appliedItemNumber = None
+    self.needsCompose = True
+    # Counters for checking that the cache is used and not rebuilt more than needed
+    self.numberOfComposes = 0
+    self.numberOfAppliedItems = 0
+
+  def getSequenceBrowserNode(self, transformNode):
+    """Returns the browser node whose items drive transformNode, if it is the cache's browser or a synchronized one
+    """
+    if self.browserNode.GetSequenceNode(transformNode) is not None:
+      return self.browserNode
+    browserNode = slicer.modules.sequencebrowser.logic().GetFirstBrowserNodeForProxyNode(transformNode)
+    if browserNode and browserNode.GetID() in self.synchronizedItemNumbers:
+      return browserNode
+    return None
+
+  def isSequenceTransform(self, transformNode):
+    return self.getSequenceBrowserNode(transformNode) is not None
+
+  def getChain(self, displayedNode):
+    """Returns the transform nodes from the parent of displayedNode up to the root, or None if the chain
+    has a non-linear transform
+    """
+    chain = []
+    transformNode = displayedNode.GetParentTransformNode()
+    while transformNode:
+      if not transformNode.IsLinear():
+        return None
+      chain.append(transformNode)
+      transformNode = transformNode.GetParentTransformNode()
+    return chain
+
+  def start(self, displayedNodes, synchronizedItemNumbers=None):
+    """Moves the displayed nodes under cache transforms. Nodes that have no parent transform or a
+    non-linear transform in their chain are left unchanged.
+    :param synchronizedItemNumbers: item numbers of each browser node (keyed by ID) that is kept synchronized
+      with the browser, for every item of the browser
+    """
+    self.stop()
+    self.synchronizedItemNumbers = synchronizedItemNumbers or {}
+    for displayedNode in displayedNodes:
+      if not displayedNode:
+        continue
+      chain = self.getChain(displayedNode)
+      if not chain:
+        continue
+      self.displayedNodes.append(displayedNode)
+      self.chains[displayedNode.GetID()] = chain
+    for transformNode in self.getStaticTransformNodes():
+      self.staticMatrices[transformNode.GetID()] = getMatrixToParent(transformNode)
+      self.observations.append((transformNode, transformNode.AddObserver(
+        slicer.vtkMRMLTransformableNode.TransformModifiedEvent, self.onStaticTransformModified)))
+    self.needsCompose = True
+    self.compose()
+
+    for displayedNode in self.displayedNodes:
+      cacheTransformNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode", displayedNode.GetName() + "-WorldMatrix")
+      cacheTransformNode.SetHideFromEditors(True)
+      cacheTransformNode.SetSaveWithScene(False)
+      self.cacheTransformNodes[displayedNode.GetID()] = cacheTransformNode
+      self.originalParentNodeIDs[displayedNode.GetID()] = displayedNode.GetTransformNodeID()
+    self.appliedItemNumber = None
+    self.applySelectedItem()
+    for displayedNode in self.displayedNodes:
+      displayedNode.SetAndObserveTransformNodeID(self.cacheTransformNodes[displayedNode.GetID()].GetID())
+    self.observations.append((self.browserNode, self.browserNode.AddObserver(vtk.vtkCommand.ModifiedEvent, self.onBrowserModified)))
+    self.started = True
+
+  def stop(self):
+    """Moves the displayed nodes back to their original parent transforms
+    """
+    for observedNode, observerTag in self.observations:
+      observedNode.RemoveObserver(observerTag)
+    self.observations = []
+    for displayedNode in self.displayedNodes:
+      displayedNode.SetAndObserveTransformNodeID(self.originalParentNodeIDs.get(displayedNode.GetID()))
+      cacheTransformNode = self.cacheTransformNodes.get(displayedNode.GetID())
+      if cacheTransformNode and cacheTransformNode.GetScene():
+        slicer.mrmlScene.RemoveNode(cacheTransformNode)
+    self.displayedNodes = []
+    self.originalParentNodeIDs = {}
+    self.cacheTransformNodes = {}
+    self.chains = {}
+    self.worldMatrices = {}
+    self.staticMatrices = {}
+    self.started = False
+
+  def getStaticTransformNodes(self):
+    staticTransformNodes = {}
+    for chain in self.chains.values():
+      for transformNode in chain:
+        if not self.isSequenceTransform(transformNode):
+          staticTransformNodes[transformNode.GetID()] = transformNode
+    return list(staticTransformNodes.values())
+
+  def getSequenceMatrices(self, transformNode):
+    browserNode = self.getSequenceBrowserNode(transformNode)
+    matrices = self.sequenceMatrices.get(transformNode.GetID())
+    if matrices is None:
+      matrices = getTransformMatrices(browserNode, transformNode)
+      self.sequenceMatrices[transformNode.GetID()] = matrices
+    if browserNode != self.browserNode:
+      matrices = matrices[self.synchronizedItemNumbers[browserNode.GetID()]]
+    return matrices
+
+  def compose(self):
+    """Computes the world matrix of each displayed node for every item
+    """
+    for displayedNodeID, chain in self.chains.items():
+      # Consecutive static transforms are multiplied once, not once per item
+      worldMatrices = numpy.eye(4)
+      staticMatrix = numpy.eye(4)
+      for transformNode in reversed(chain):
+        if self.isSequenceTransform(transformNode):
+          worldMatrices = numpy.matmul(numpy.matmul(worldMatrices, staticMatrix), self.getSequenceMatrices(transformNode))
+          staticMatrix = numpy.eye(4)
+        else:
+          staticMatrix = staticMatrix.dot(self.staticMatrices[transformNode.GetID()])
+      worldMatrices = numpy.matmul(worldMatrices, staticMatrix)
+      if worldMatrices.ndim == 2:
+        # No sequence transform in the chain
+        worldMatrices = numpy.tile(worldMatrices, (self.browserNode.GetNumberOfItems(), 1, 1))
+      self.worldMatrices[displayedNodeID] = worldMatrices
+    self.needsCompose = False
+    self.numberOfComposes += 1
+
+  def onStaticTransformModified(self, transformNode, event):
+    # The event is also invoked when a parent transform changes, e.g. for every frame change of a sequence
+    # transform above, so the matrix is compared with the one the cache was composed with
+    matrix = getMatrixToParent(transformNode)
+    if numpy.array_equal(matrix, self.staticMatrices.get(transformNode.GetID())):
+      return
+    self.staticMatrices[transformNode.GetID()] = matrix
+    self.needsCompose = True
+    self.appliedItemNumber = None
+    self.applySelectedItem()
+
+  def onBrowserModified(self, browserNode, event):
+    self.applySelectedItem()
+
+  def applySelectedItem(self):
+    itemNumber = self.browserNode.GetSelectedItemNumber()
+    if itemNumber < 0 or itemNumber == self.appliedItemNumber:
+      return
+    if self.needsCompose:
+      self.compose()
+    self.appliedItemNumber = itemNumber
+    matrix = vtk.vtkMatrix4x4()
+    for displayedNode in self.displayedNodes:
+      worldMatrices = self.worldMatrices[displayedNode.GetID()]
+      matrix.DeepCopy(worldMatrices[min(itemNumber, len(worldMatrices) - 1)].ravel().tolist())
+      self.cacheTransformNodes[displayedNode.GetID()].SetMatrixTransformToParent(matrix)
+    self.numberOfAppliedItems += 1
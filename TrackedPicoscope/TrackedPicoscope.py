@@ -1,9 +1,11 @@
 import os
 import unittest
 import logging
+import numpy
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
+from LumpNavReplayLib.TimestampIndex import getSynchronizedItemNumbers
 
 #
 # TrackedPicoscope
@@ -18,7 +20,7 @@ class TrackedPicoscope(ScriptedLoadableModule):
     ScriptedLoadableModule.__init__(self, parent)
     self.parent.title = "TrackedPicoscope"  # TODO: make this more human readable by adding spaces
     self.parent.categories = ["IGT"]  # TODO: set categories (folders where the module shows up in the module selector)
-    self.parent.dependencies = []  # TODO: add here list of module names that this module requires
+    self.parent.dependencies = ["LumpNavReplay"]
     self.parent.contributors = ["John Doe (AnyWare Corp.)"]  # TODO: replace with "Firstname Lastname (Organization)"
     # TODO: update with short description of the module and a link to online module documentation
     self.parent.helpText = """
@@ -101,6 +103,13 @@ class TrackedPicoscopeWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.logic = None
     self._parameterNode = None
     self._updatingGUIFromParameterNode = False
+    # Parameter node changes are collected and the GUI is updated once, when control returns to the event loop
+    self._guiUpdateTimer = qt.QTimer()
+    self._guiUpdateTimer.setSingleShot(True)
+    self._guiUpdateTimer.setInterval(0)
+    self._guiUpdateTimer.connect('timeout()', self.updateGUIFromParameterNode)
+    # Number of GUI updates, for testing
+    self.guiUpdateCount = 0
 
   def setup(self):
     """
@@ -138,11 +147,17 @@ class TrackedPicoscopeWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     # These connections ensure that whenever user changes some settings on the GUI, that is saved in the MRML scene
     # (in the selected parameter node).
 
-    self.ui.unclassifiedSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
-    self.ui.cutTissueSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
-    self.ui.coagTissueSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
-    self.ui.cutAirSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
-    self.ui.coagAirSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
+    # Node selectors and the parameter node references they are stored in
+    self.nodeSelectors = [
+      (self.ui.inputSelector, self.logic.INPUT_VOLUME),
+      (self.ui.unclassifiedSelector, self.logic.UNCLASSIFIED_FIDUCIALS),
+      (self.ui.cutTissueSelector, self.logic.CUT_TISSUE_FIDUCIALS),
+      (self.ui.coagTissueSelector, self.logic.COAG_TISSUE_FIDUCIALS),
+      (self.ui.cutAirSelector, self.logic.CUT_AIR_FIDUCIALS),
+      (self.ui.coagAirSelector, self.logic.COAG_AIR_FIDUCIALS),
+      ]
+    for nodeSelector, referenceRole in self.nodeSelectors:
+      nodeSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.updateParameterNodeFromGUI)
 
     # self.ui.imageThresholdSliderWidget.connect("valueChanged(double)", self.updateParameterNodeFromGUI)
     # self.ui.invertOutputCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
@@ -150,18 +165,21 @@ class TrackedPicoscopeWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     # Buttons
     self.ui.applyButton.connect('clicked(bool)', self.onApplyButton)
+    self.ui.classifyButton.connect('clicked(bool)', self.onClassifyButton)
 
     # Make sure parameter node is initialized (needed for module reload)
     self.initializeParameterNode()
 
   def onSceneImportEnd(self, caller=None, event=None):
-    self.updateGUIFromParameterNode()
+    self.requestGUIUpdate()
 
   def cleanup(self):
     """
     Called when the application closes and the module widget is destroyed.
     """
+    self._guiUpdateTimer.stop()
     self.removeObservers()
+    self.logic.cleanup()
 
   def enter(self):
     """
@@ -175,7 +193,7 @@ class TrackedPicoscopeWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     Called each time the user opens a different module.
     """
     # Do not react to parameter node changes (GUI wlil be updated when the user enters into the module)
-    self.removeObserver(self._parameterNode, vtk.vtkCommand.ModifiedEvent, self.updateGUIFromParameterNode)
+    self.removeObserver(self._parameterNode, vtk.vtkCommand.ModifiedEvent, self.requestGUIUpdate)
 
   def onSceneStartClose(self, caller, event):
     """
@@ -220,33 +238,41 @@ class TrackedPicoscopeWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     # Changes of parameter node are observed so that whenever parameters are changed by a script or any other module
     # those are reflected immediately in the GUI.
     if self._parameterNode is not None:
-      self.removeObserver(self._parameterNode, vtk.vtkCommand.ModifiedEvent, self.updateGUIFromParameterNode)
+      self.removeObserver(self._parameterNode, vtk.vtkCommand.ModifiedEvent, self.requestGUIUpdate)
     self._parameterNode = inputParameterNode
     if self._parameterNode is not None:
-      self.addObserver(self._parameterNode, vtk.vtkCommand.ModifiedEvent, self.updateGUIFromParameterNode)
+      self.addObserver(self._parameterNode, vtk.vtkCommand.ModifiedEvent, self.requestGUIUpdate)
 
     # Initial GUI update
-    self.updateGUIFromParameterNode()
+    self.requestGUIUpdate()
 
-  def updateGUIFromParameterNode(self, caller=None, event=None):
+  def requestGUIUpdate(self, caller=None, event=None):
     """
     This method is called whenever parameter node is changed.
+    The GUI is updated when control returns to the event loop, so a burst of changes (e.g. scene import or a script
+    setting several parameters) results in a single update.
+    """
+    if not self._guiUpdateTimer.isActive():
+      self._guiUpdateTimer.start()
+
+  def updateGUIFromParameterNode(self, caller=None, event=None):
+    """
     The module GUI is updated to show the current state of the parameter node.
     """
 
+    self._guiUpdateTimer.stop()
     if self._parameterNode is None or self._updatingGUIFromParameterNode:
       return
 
     # Make sure GUI changes do not call updateParameterNodeFromGUI (it could cause infinite loop)
     self._updatingGUIFromParameterNode = True
+    self.guiUpdateCount += 1
 
-    # Update node selectors and sliders
-    self.ui.inputSelector.setCurrentNode(self._parameterNode.GetNodeReference(self.logic.INPUT_VOLUME))
-    self.ui.unclassifiedSelector.setCurrentNode(self._parameterNode.GetNodeReference(self.logic.UNCLASSIFIED_FIDUCIALS))
-    self.ui.cutTissueSelector.setCurrentNode(self._parameterNode.GetNodeReference(self.logic.CUT_TISSUE_FIDUCIALS))
-    self.ui.coagTissueSelector.setCurrentNode(self._parameterNode.GetNodeReference(self.logic.COAG_TISSUE_FIDUCIALS))
-    self.ui.cutAirSelector.setCurrentNode(self._parameterNode.GetNodeReference(self.logic.CUT_AIR_FIDUCIALS))
-    self.ui.coagAirSelector.setCurrentNode(self._parameterNode.GetNodeReference(self.logic.COAG_AIR_FIDUCIALS))
+    # Update node selectors and sliders, only if the selected node is changed
+    for nodeSelector, referenceRole in self.nodeSelectors:
+      referencedNodeID = self._parameterNode.GetNodeReferenceID(referenceRole)
+      if (nodeSelector.currentNodeID or "") != (referencedNodeID or ""):
+        nodeSelector.setCurrentNode(self._parameterNode.GetNodeReference(referenceRole))
 
     # self.ui.invertedOutputSelector.setCurrentNode(self._parameterNode.GetNodeReference("OutputVolumeInverse"))
     # self.ui.imageThresholdSliderWidget.value = float(self._parameterNode.GetParameter("Threshold"))
@@ -259,6 +285,9 @@ class TrackedPicoscopeWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     else:
       self.ui.applyButton.toolTip = "Select input and output volume nodes"
       self.ui.applyButton.enabled = False
+    # The input reference may be a volume (selected by default for thresholding), only a sequence browser can be classified
+    inputNode = self._parameterNode.GetNodeReference(self.logic.INPUT_VOLUME)
+    self.ui.classifyButton.enabled = inputNode is not None and inputNode.IsA("vtkMRMLSequenceBrowserNode")
 
     # All the GUI updates are done
     self._updatingGUIFromParameterNode = False
@@ -274,12 +303,8 @@ class TrackedPicoscopeWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
     wasModified = self._parameterNode.StartModify()  # Modify all properties in a single batch
 
-    self._parameterNode.SetNodeReferenceID(self.logic.INPUT_VOLUME, self.ui.inputSelector.currentNodeID)
-    self._parameterNode.SetNodeReferenceID(self.logic.UNCLASSIFIED_FIDUCIALS, self.ui.unclassifiedSelector.currentNodeID)
-    self._parameterNode.SetNodeReferenceID(self.logic.CUT_TISSUE_FIDUCIALS, self.ui.cutTissueSelector.currentNodeID)
-    self._parameterNode.SetNodeReferenceID(self.logic.COAG_TISSUE_FIDUCIALS, self.ui.coagTissueSelector.currentNodeID)
-    self._parameterNode.SetNodeReferenceID(self.logic.CUT_AIR_FIDUCIALS, self.ui.cutAirSelector.currentNodeID)
-    self._parameterNode.SetNodeReferenceID(self.logic.COAG_AIR_FIDUCIALS, self.ui.coagAirSelector.currentNodeID)
+    for nodeSelector, referenceRole in self.nodeSelectors:
+      self._parameterNode.SetNodeReferenceID(referenceRole, nodeSelector.currentNodeID)
 
     # self._parameterNode.SetParameter("Threshold", str(self.ui.imageThresholdSliderWidget.value))
     # self._parameterNode.SetParameter("Invert", "true" if self.ui.invertOutputCheckBox.checked else "false")
@@ -293,15 +318,10 @@ class TrackedPicoscopeWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     """
     try:
 
-      # Compute output
+      # Compute output, and the result with inverted threshold in the same pass if an additional output volume is selected
       self.logic.process(self.ui.inputSelector.currentNode(), self.ui.outputSelector.currentNode(),
-        self.ui.imageThresholdSliderWidget.value, self.ui.invertOutputCheckBox.checked)
-
-      # Compute inverted output (if needed)
-      if self.ui.invertedOutputSelector.currentNode():
-        # If additional output volume is selected then result with inverted threshold is written there
-        self.logic.process(self.ui.inputSelector.currentNode(), self.ui.invertedOutputSelector.currentNode(),
-          self.ui.imageThresholdSliderWidget.value, not self.ui.invertOutputCheckBox.checked, showResult=False)
+        self.ui.imageThresholdSliderWidget.value, self.ui.invertOutputCheckBox.checked,
+        invertedOutputVolume=self.ui.invertedOutputSelector.currentNode())
 
     except Exception as e:
       slicer.util.errorDisplay("Failed to compute results: "+str(e))
@@ -309,6 +329,26 @@ class TrackedPicoscopeWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
       traceback.print_exc()
 
 
+  def onClassifyButton(self):
+    """
+    Classify all frames of the input sequence when user clicks "Classify sequence" button.
+    """
+    try:
+      fiducialNodes = {
+        self.logic.UNCLASSIFIED_FIDUCIALS: self.ui.unclassifiedSelector.currentNode(),
+        self.logic.CUT_TISSUE_FIDUCIALS: self.ui.cutTissueSelector.currentNode(),
+        self.logic.COAG_TISSUE_FIDUCIALS: self.ui.coagTissueSelector.currentNode(),
+        self.logic.CUT_AIR_FIDUCIALS: self.ui.cutAirSelector.currentNode(),
+        self.logic.COAG_AIR_FIDUCIALS: self.ui.coagAirSelector.currentNode(),
+        }
+      self.logic.classifySequence(self.ui.inputSelector.currentNode(), fiducialNodes)
+
+    except Exception as e:
+      slicer.util.errorDisplay("Failed to classify sequence: "+str(e))
+      import traceback
+      traceback.print_exc()
+
+
 #
 # TrackedPicoscopeLogic
 #
@@ -330,11 +370,46 @@ class TrackedPicoscopeLogic(ScriptedLoadableModuleLogic):
   CUT_AIR_FIDUCIALS = "CutAirFiducials"
   COAG_AIR_FIDUCIALS = "CoagAirFiducials"
 
+  # Fiducial list of each class returned by classifySignals, in the order of the class numbers.
+  # Frames where the cautery is not active are not classified (class NOT_ACTIVE).
+  CLASS_FIDUCIALS = [UNCLASSIFIED_FIDUCIALS, CUT_TISSUE_FIDUCIALS, COAG_TISSUE_FIDUCIALS, CUT_AIR_FIDUCIALS, COAG_AIR_FIDUCIALS]
+  NOT_ACTIVE = -1
+
+  # Picoscope signal thresholds for classification. Cautery is active if the RMS of the signal exceeds ACTIVATION_RMS.
+  # Only the power in the bands above the first SIGNAL_BANDS band counts: slow drift and cable motion are not activation.
+  # The peak voltage is lower when the tip touches tissue (loaded) than in air, and coagulation waveforms are interrupted
+  # so they have a higher crest factor (peak / RMS) than the continuous cut waveform. Frames within the relative
+  # AMBIGUITY_MARGIN of a threshold are unclassified.
+  ACTIVATION_RMS = 0.05
+  TISSUE_MAXIMUM_PEAK = 0.7
+  COAG_MINIMUM_CREST_FACTOR = 2.0
+  AMBIGUITY_MARGIN = 0.1
+
+  # Name of the tracked tool transform in the input sequence
+  CAUTERY_TRANSFORM_NAME = "CauteryToReference"
+
+  # Grid cell size of the spatial index of fiducial lists (mm)
+  SPATIAL_INDEX_CELL_SIZE = 5.0
+
+  # Streaming signal features: sampling rate of the picoscope signal (Hz), number of samples per analysis window,
+  # and the frequency bands (Hz) whose power is computed for each frame
+  SIGNAL_SAMPLE_RATE = 1000.0
+  SIGNAL_WINDOW_LENGTH = 1000
+  SIGNAL_BANDS = [(0.0, 25.0), (25.0, 100.0), (100.0, 500.0)]
+
   def __init__(self):
     """
     Called when the logic class is instantiated. Can be used for initializing member variables.
     """
     ScriptedLoadableModuleLogic.__init__(self)
+    # Spatial index and observer tags of each fiducial list, keyed by node ID
+    self.spatialIndices = {}
+    # Scene is only observed while there are spatial indices, so that a logic that does not use them is not kept alive
+    self.sceneObservations = []
+    self.signalFeatureStream = None
+    self.signalVolumeNode = None
+    self.signalVolumeObservation = None
+    self.signalImageDataMTime = None
 
   def setDefaultParameters(self, parameterNode):
     """
@@ -345,7 +420,10 @@ class TrackedPicoscopeLogic(ScriptedLoadableModuleLogic):
     if not parameterNode.GetParameter("Invert"):
       parameterNode.SetParameter("Invert", "false")
 
-  def process(self, inputVolume, outputVolume, imageThreshold, invert=False, showResult=True):
+  # Number of slices that are thresholded at once, small enough to keep the input slab in the CPU cache
+  THRESHOLD_SLICES_PER_CHUNK = 8
+
+  def process(self, inputVolume, outputVolume, imageThreshold, invert=False, showResult=True, invertedOutputVolume=None):
     """
     Run the processing algorithm.
     Can be used without GUI widget.
@@ -354,6 +432,7 @@ class TrackedPicoscopeLogic(ScriptedLoadableModuleLogic):
     :param imageThreshold: values above/below this threshold will be set to 0
     :param invert: if True then values above the threshold will be set to 0, otherwise values below are set to 0
     :param showResult: show output volume in slice viewers
+    :param invertedOutputVolume: if specified, the result with inverted threshold is computed in the same pass and written here
     """
 
     if not inputVolume or not outputVolume:
@@ -363,7 +442,58 @@ class TrackedPicoscopeLogic(ScriptedLoadableModuleLogic):
     startTime = time.time()
     logging.info('Processing started')
 
-    # Compute the thresholded output volume using the "Threshold Scalar Volume" CLI module
+    # Same result as the "Threshold Scalar Volume" CLI module, but computed in memory without writing the volumes to files
+    inputArray = slicer.util.arrayFromVolume(inputVolume)
+    outputArray = self.prepareOutputVolume(inputVolume, outputVolume)
+    invertedOutputArray = self.prepareOutputVolume(inputVolume, invertedOutputVolume) if invertedOutputVolume else None
+    for firstSlice in range(0, inputArray.shape[0], self.THRESHOLD_SLICES_PER_CHUNK):
+      sliceRange = slice(firstSlice, firstSlice + self.THRESHOLD_SLICES_PER_CHUNK)
+      inputSlab = inputArray[sliceRange]
+      # Values equal to the threshold are kept in both outputs
+      belowThreshold = inputSlab < imageThreshold
+      aboveThreshold = inputSlab > imageThreshold
+      # Both results are computed before anything is written, as an output volume may be the input volume
+      outputSlab = self.zeroWhere(inputSlab, aboveThreshold if invert else belowThreshold)
+      invertedOutputSlab = self.zeroWhere(inputSlab, belowThreshold if invert else aboveThreshold) if invertedOutputArray is not None else None
+      numpy.copyto(outputArray[sliceRange], outputSlab)
+      if invertedOutputSlab is not None:
+        numpy.copyto(invertedOutputArray[sliceRange], invertedOutputSlab)
+    for volumeNode in [outputVolume, invertedOutputVolume]:
+      if volumeNode:
+        slicer.util.arrayFromVolumeModified(volumeNode)
+    if showResult:
+      slicer.util.setSliceViewerLayers(background=outputVolume)
+
+    stopTime = time.time()
+    logging.info('Processing completed in {0:.2f} seconds'.format(stopTime-startTime))
+
+  def prepareOutputVolume(self, inputVolume, outputVolume):
+    """
+    Makes the output volume the same geometry and scalar type as the input (reusing its image buffer if it already matches)
+    and returns its voxels as a numpy array.
+    """
+    inputImageData = inputVolume.GetImageData()
+    outputImageData = outputVolume.GetImageData()
+    if (not outputImageData or outputImageData.GetDimensions() != inputImageData.GetDimensions()
+      or outputImageData.GetScalarType() != inputImageData.GetScalarType()
+      or outputImageData.GetNumberOfScalarComponents() != inputImageData.GetNumberOfScalarComponents()):
+      outputImageData = vtk.vtkImageData()
+      outputImageData.SetDimensions(inputImageData.GetDimensions())
+      outputImageData.AllocateScalars(inputImageData.GetScalarType(), inputImageData.GetNumberOfScalarComponents())
+      outputVolume.SetAndObserveImageData(outputImageData)
+    outputVolume.CopyOrientation(inputVolume)
+    return slicer.util.arrayFromVolume(outputVolume)
+
+  def zeroWhere(self, inputArray, mask):
+    """
+    Returns a new array with the values of inputArray, and zero where mask is set.
+    """
+    return numpy.where(mask, numpy.zeros(1, dtype=inputArray.dtype), inputArray)
+
+  def processWithCli(self, inputVolume, outputVolume, imageThreshold, invert=False, showResult=True):
+    """
+    Reference implementation of process that runs the "Threshold Scalar Volume" CLI module.
+    """
     cliParams = {
       'InputVolume': inputVolume.GetID(),
       'OutputVolume': outputVolume.GetID(),
@@ -374,8 +504,555 @@ class TrackedPicoscopeLogic(ScriptedLoadableModuleLogic):
     # We don't need the CLI module node anymore, remove it to not clutter the scene with it
     slicer.mrmlScene.RemoveNode(cliNode)
 
-    stopTime = time.time()
-    logging.info('Processing completed in {0:.2f} seconds'.format(stopTime-startTime))
+  def getInputSequences(self, browserNode):
+    """
+    Returns the sequence of the cautery transform and the sequence of the picoscope signal volume of a sequence browser.
+    """
+    sequenceNodes = vtk.vtkCollection()
+    browserNode.GetSynchronizedSequenceNodes(sequenceNodes, True)
+    transformSequenceNode = None
+    signalSequenceNode = None
+    for sequenceNode in [sequenceNodes.GetItemAsObject(index) for index in range(sequenceNodes.GetNumberOfItems())]:
+      dataNodeClassName = sequenceNode.GetDataNodeClassName()
+      if dataNodeClassName == "vtkMRMLLinearTransformNode":
+        proxyNode = browserNode.GetProxyNode(sequenceNode)
+        if not transformSequenceNode or (proxyNode and self.CAUTERY_TRANSFORM_NAME in proxyNode.GetName()):
+          transformSequenceNode = sequenceNode
+      elif dataNodeClassName == "vtkMRMLScalarVolumeNode" and not signalSequenceNode:
+        signalSequenceNode = sequenceNode
+    if not transformSequenceNode or not signalSequenceNode:
+      raise ValueError("Input sequence browser must contain a transform sequence and a picoscope signal volume sequence")
+    return transformSequenceNode, signalSequenceNode
+
+  def getTipPositions(self, browserNode, transformSequenceNode, tipToToolTransformNode=None):
+    """
+    Returns the world position of the cautery tip for each item of the browser as an Nx3 array.
+    The transform of every item is read once, then all tips are computed with one matrix product.
+    """
+    itemNumbers = getSynchronizedItemNumbers(browserNode, transformSequenceNode)
+    toolToParentMatrices = numpy.zeros((transformSequenceNode.GetNumberOfDataNodes(), 4, 4))
+    matrix = vtk.vtkMatrix4x4()
+    for itemNumber in range(transformSequenceNode.GetNumberOfDataNodes()):
+      transformSequenceNode.GetNthDataNode(itemNumber).GetMatrixTransformToParent(matrix)
+      toolToParentMatrices[itemNumber] = slicer.util.arrayFromVTKMatrix(matrix)
+    # The proxy node is placed in the transform hierarchy of the scene, tips are in its world coordinates
+    parentToWorld = numpy.eye(4)
+    proxyNode = browserNode.GetProxyNode(transformSequenceNode)
+    if proxyNode and proxyNode.GetParentTransformNode():
+      proxyNode.GetParentTransformNode().GetMatrixTransformToWorld(matrix)
+      parentToWorld = slicer.util.arrayFromVTKMatrix(matrix)
+    tipToTool = numpy.eye(4)
+    if tipToToolTransformNode:
+      tipToToolTransformNode.GetMatrixTransformToParent(matrix)
+      tipToTool = slicer.util.arrayFromVTKMatrix(matrix)
+    tipToWorld = numpy.matmul(numpy.matmul(parentToWorld, toolToParentMatrices[itemNumbers]), tipToTool)
+    return tipToWorld[:, :3, 3]
+
+  def getSignals(self, browserNode, signalSequenceNode):
+    """
+    Returns the picoscope signal of each item of the browser as an NxS array (S is the number of samples per frame).
+    """
+    itemNumbers = getSynchronizedItemNumbers(browserNode, signalSequenceNode)
+    signals = numpy.array([slicer.util.arrayFromVolume(signalSequenceNode.GetNthDataNode(itemNumber)).ravel()
+      for itemNumber in range(signalSequenceNode.GetNumberOfDataNodes())], dtype=numpy.float64)
+    return signals[itemNumbers]
+
+  def computeSignalFeatures(self, signals):
+    """
+    Returns the RMS, the peak and the crest factor (peak / RMS) of each row of an NxS array of signals.
+    """
+    signals = signals - signals.mean(axis=1, keepdims=True)
+    rms = numpy.sqrt(numpy.mean(signals * signals, axis=1))
+    peaks = numpy.abs(signals).max(axis=1)
+    crestFactors = numpy.divide(peaks, rms, out=numpy.zeros_like(peaks), where=rms > 0)
+    return rms, peaks, crestFactors
+
+  def computeSignalBandPowers(self, signals):
+    """
+    Returns the power of each row of an NxS array of signals in each of the SIGNAL_BANDS (NxB), computed like
+    the band powers of SignalFeatureStream with a window of S samples.
+    """
+    taper, bandMatrix = createBandMatrix(signals.shape[1], self.SIGNAL_SAMPLE_RATE, self.SIGNAL_BANDS)
+    spectra = numpy.fft.rfft((signals - signals.mean(axis=1, keepdims=True)) * taper, axis=1)
+    return (spectra.real ** 2 + spectra.imag ** 2).dot(bandMatrix)
+
+  def classifySignals(self, signals):
+    """
+    Returns the class of each row of an NxS array of signals: an index into CLASS_FIDUCIALS, or NOT_ACTIVE.
+    """
+    rms, peaks, crestFactors = self.computeSignalFeatures(signals)
+    return self.classifyFeatures(rms, peaks, crestFactors, self.computeSignalBandPowers(signals))
+
+  def classifyFeatures(self, rms, peaks, crestFactors, bandPowers):
+    """
+    Returns the class of each frame from its signal features, see classifySignals.
+    :param bandPowers: power of each frame in each of the SIGNAL_BANDS (NxB)
+    """
+    # RMS of the signal without the power in the lowest band
+    activeRms = numpy.sqrt(numpy.maximum(rms * rms - bandPowers[:, 0], 0.0))
+    inTissue = peaks <= self.TISSUE_MAXIMUM_PEAK
+    coag = crestFactors >= self.COAG_MINIMUM_CREST_FACTOR
+    classes = numpy.where(inTissue, numpy.where(coag, 2, 1), numpy.where(coag, 4, 3))
+    ambiguous = ((numpy.abs(peaks - self.TISSUE_MAXIMUM_PEAK) < self.AMBIGUITY_MARGIN * self.TISSUE_MAXIMUM_PEAK)
+      | (numpy.abs(crestFactors - self.COAG_MINIMUM_CREST_FACTOR) < self.AMBIGUITY_MARGIN * self.COAG_MINIMUM_CREST_FACTOR))
+    classes[ambiguous] = 0
+    classes[activeRms < self.ACTIVATION_RMS] = self.NOT_ACTIVE
+    return classes
+
+  def startSignalFeatureStream(self, signalVolumeNode):
+    """
+    Computes the features of the picoscope signal every time the signal volume is updated (e.g. by sequence replay
+    or live acquisition). The features of the latest frames are available from signalFeatureStream.
+    """
+    self.stopSignalFeatureStream()
+    self.signalFeatureStream = SignalFeatureStream(self.SIGNAL_WINDOW_LENGTH, self.SIGNAL_SAMPLE_RATE, self.SIGNAL_BANDS)
+    self.signalVolumeNode = signalVolumeNode
+    self.signalVolumeObservation = signalVolumeNode.AddObserver(slicer.vtkMRMLVolumeNode.ImageDataModifiedEvent, self.onSignalModified)
+    return self.signalFeatureStream
+
+  def stopSignalFeatureStream(self):
+    if self.signalVolumeObservation is not None:
+      self.signalVolumeNode.RemoveObserver(self.signalVolumeObservation)
+    self.signalVolumeNode = None
+    self.signalVolumeObservation = None
+    self.signalImageDataMTime = None
+
+  def onSignalModified(self, signalVolumeNode, event):
+    # One update of the volume may invoke several events
+    imageData = signalVolumeNode.GetImageData()
+    if imageData is None or imageData.GetMTime() == self.signalImageDataMTime:
+      return
+    self.signalImageDataMTime = imageData.GetMTime()
+    # Features are computed in batches, when they are requested or when the buffer of pending frames is full
+    self.signalFeatureStream.addFrame(slicer.util.arrayFromVolume(signalVolumeNode).ravel())
+
+  def classifyLatestFrames(self, numberOfFrames=1):
+    """
+    Returns the class of the latest frames of the signal feature stream, oldest first.
+    """
+    return self.classifyFeatures(*self.signalFeatureStream.getLatestFeatures(numberOfFrames))
+
+  def classifySequence(self, browserNode, fiducialNodes, tipToToolTransformNode=None):
+    """
+    Classifies the picoscope signal of every item of the sequence browser and adds the cautery tip position
+    of each classified item to the fiducial list of its class.
+    :param fiducialNodes: markups fiducial node for each name in CLASS_FIDUCIALS (None to skip a class)
+    :param tipToToolTransformNode: optional transform from the cautery tip to the tracked tool
+    :return: number of points added to each fiducial list
+    """
+    if not browserNode:
+      raise ValueError("Input sequence browser is invalid")
+
+    import time
+    startTime = time.time()
+    transformSequenceNode, signalSequenceNode = self.getInputSequences(browserNode)
+    tipPositions = self.getTipPositions(browserNode, transformSequenceNode, tipToToolTransformNode)
+    classes = self.classifySignals(self.getSignals(browserNode, signalSequenceNode))
+    numberOfPoints = {}
+    for classNumber, fiducialName in enumerate(self.CLASS_FIDUCIALS):
+      fiducialNode = fiducialNodes.get(fiducialName)
+      if not fiducialNode:
+        continue
+      classTipPositions = tipPositions[classes == classNumber]
+      self.appendControlPoints(fiducialNode, classTipPositions)
+      numberOfPoints[fiducialName] = len(classTipPositions)
+    logging.info('Classified {0} frames in {1:.2f} seconds'.format(len(classes), time.time()-startTime))
+    return numberOfPoints
+
+  def appendControlPoints(self, markupsNode, pointsWorld):
+    """
+    Adds all points to the markups node at once, so that observers are notified once instead of once per point.
+    Existing points are not modified, so e.g. the spatial index of the list only inserts the new points.
+    """
+    if len(pointsWorld) == 0:
+      return
+    wasModified = markupsNode.StartModify()
+    for pointWorld in pointsWorld:
+      markupsNode.AddControlPointWorld(vtk.vtkVector3d(pointWorld[0], pointWorld[1], pointWorld[2]))
+    markupsNode.EndModify(wasModified)
+
+  def getSpatialIndex(self, fiducialNode):
+    """
+    Returns the spatial index of the world positions of the control points of a fiducial list.
+    The index is created on first use and then kept up to date: added points are inserted into it,
+    other changes make it rebuild on the next query.
+    """
+    spatialIndex, observations = self.spatialIndices.get(fiducialNode.GetID(), (None, None))
+    if spatialIndex is None:
+      if not self.sceneObservations:
+        self.sceneObservations = [
+          slicer.mrmlScene.AddObserver(slicer.mrmlScene.NodeRemovedEvent, self.onNodeRemoved),
+          slicer.mrmlScene.AddObserver(slicer.mrmlScene.StartCloseEvent, self.onSceneStartClose),
+          ]
+      spatialIndex = FiducialSpatialIndex(self.SPATIAL_INDEX_CELL_SIZE)
+      observations = [fiducialNode.AddObserver(slicer.vtkMRMLMarkupsNode.PointAddedEvent, self.onFiducialPointsAdded)]
+      for event in [slicer.vtkMRMLMarkupsNode.PointModifiedEvent, slicer.vtkMRMLMarkupsNode.PointRemovedEvent,
+          slicer.vtkMRMLTransformableNode.TransformModifiedEvent]:
+        observations.append(fiducialNode.AddObserver(event, self.onFiducialPointsChanged))
+      self.spatialIndices[fiducialNode.GetID()] = (spatialIndex, observations)
+      spatialIndex.invalidate()
+    if not spatialIndex.isValid:
+      spatialIndex.setPoints(self.getControlPointPositionsWorld(fiducialNode))
+    return spatialIndex
+
+  def removeSpatialIndex(self, fiducialNode):
+    spatialIndex, observations = self.spatialIndices.pop(fiducialNode.GetID(), (None, []))
+    for observation in observations:
+      fiducialNode.RemoveObserver(observation)
+    if not self.spatialIndices:
+      self.removeSceneObservers()
+
+  def removeSceneObservers(self):
+    for observation in self.sceneObservations:
+      slicer.mrmlScene.RemoveObserver(observation)
+    self.sceneObservations = []
+
+  def removeAllSpatialIndices(self):
+    for nodeId in list(self.spatialIndices.keys()):
+      fiducialNode = slicer.mrmlScene.GetNodeByID(nodeId)
+      if fiducialNode is None:
+        # Node is already gone, its observers went with it
+        del self.spatialIndices[nodeId]
+        continue
+      self.removeSpatialIndex(fiducialNode)
+    self.removeSceneObservers()
+
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onNodeRemoved(self, caller, event, node):
+    if node is not None and node.GetID() in self.spatialIndices:
+      self.removeSpatialIndex(node)
+
+  def onSceneStartClose(self, caller, event):
+    self.removeAllSpatialIndices()
+
+  def cleanup(self):
+    """
+    Removes the scene, fiducial list and signal volume observers. Called when the module widget is destroyed,
+    and should be called by scripts that create a logic when they are done with it.
+    """
+    self.stopSignalFeatureStream()
+    self.removeAllSpatialIndices()
+
+  def getControlPointPositionsWorld(self, fiducialNode, firstPointIndex=0):
+    if firstPointIndex == 0:
+      return slicer.util.arrayFromMarkupsControlPoints(fiducialNode, world=True).reshape(-1, 3)
+    # Only the points from firstPointIndex on are read, e.g. the points that were just added
+    numberOfPoints = fiducialNode.GetNumberOfControlPoints()
+    pointsWorld = numpy.zeros((max(numberOfPoints - firstPointIndex, 0), 3))
+    for pointIndex in range(firstPointIndex, numberOfPoints):
+      fiducialNode.GetNthControlPointPositionWorld(pointIndex, pointsWorld[pointIndex - firstPointIndex])
+    return pointsWorld
+
+  def onFiducialPointsAdded(self, fiducialNode, event):
+    spatialIndex, _ = self.spatialIndices[fiducialNode.GetID()]
+    if not spatialIndex.isValid or spatialIndex.numberOfPoints > fiducialNode.GetNumberOfControlPoints():
+      spatialIndex.invalidate()
+      return
+    # Points are appended at the end of the list
+    spatialIndex.addPoints(self.getControlPointPositionsWorld(fiducialNode, spatialIndex.numberOfPoints))
+
+  def onFiducialPointsChanged(self, fiducialNode, event):
+    spatialIndex, _ = self.spatialIndices[fiducialNode.GetID()]
+    spatialIndex.invalidate()
+
+  def findNearestFiducialList(self, positionWorld, fiducialNodes, maximumDistance=None):
+    """
+    Returns the name (key of fiducialNodes) of the fiducial list that has the point closest to positionWorld, and the distance.
+    Returns (None, None) if no list has a point within maximumDistance.
+    """
+    nearestName = None
+    nearestDistance = None
+    for fiducialName, fiducialNode in fiducialNodes.items():
+      if not fiducialNode:
+        continue
+      distances, _ = self.getSpatialIndex(fiducialNode).findNearestPoints(positionWorld, 1)
+      if len(distances) == 0 or (maximumDistance is not None and distances[0] > maximumDistance):
+        continue
+      if nearestDistance is None or distances[0] < nearestDistance:
+        nearestName = fiducialName
+        nearestDistance = distances[0]
+    return nearestName, nearestDistance
+
+  def benchmarkSpatialIndex(self, numberOfPoints=10000, numberOfQueries=1000, k=5, radius=5.0):
+    """
+    Compares the query times of the spatial index with a brute force search over random points in a 100 mm cube.
+    Returns the average time per query (seconds) of each method.
+    """
+    import time
+    randomState = numpy.random.RandomState(0)
+    points = randomState.uniform(0.0, 100.0, (numberOfPoints, 3))
+    queries = randomState.uniform(0.0, 100.0, (numberOfQueries, 3))
+    spatialIndex = FiducialSpatialIndex(self.SPATIAL_INDEX_CELL_SIZE)
+    startTime = time.time()
+    spatialIndex.setPoints(points)
+    results = {"BuildSeconds": time.time() - startTime}
+    for name, findNearest, findWithinRadius in [
+        ("SpatialIndex", spatialIndex.findNearestPoints, spatialIndex.findPointsWithinRadius),
+        ("BruteForce", lambda query, k: findNearestPointsBruteForce(points, query, k),
+          lambda query, radius: findPointsWithinRadiusBruteForce(points, query, radius))]:
+      startTime = time.time()
+      for query in queries:
+        findNearest(query, k)
+      results[name + "NearestSeconds"] = (time.time() - startTime) / numberOfQueries
+      startTime = time.time()
+      for query in queries:
+        findWithinRadius(query, radius)
+      results[name + "RadiusSeconds"] = (time.time() - startTime) / numberOfQueries
+    return results
+
+#
+# SignalFeatureStream
+#
+
+def createBandMatrix(windowLength, sampleRate, bands):
+  """Returns the taper of a window of windowLength samples, and the matrix that computes the power in each band
+  from the power spectrum of a tapered window (power spectrum x band matrix).
+  One-sided spectrum bins (except DC and Nyquist) are counted twice, and the spectrum is normalized so that
+  the sum over all bins is the mean square of the signal.
+  """
+  taper = numpy.hanning(windowLength)
+  frequencies = numpy.fft.rfftfreq(windowLength, 1.0 / sampleRate)
+  binWeights = numpy.full(len(frequencies), 2.0)
+  binWeights[0] = 1.0
+  if windowLength % 2 == 0:
+    binWeights[-1] = 1.0
+  binWeights /= windowLength * numpy.sum(taper * taper)
+  bandMatrix = numpy.zeros((len(frequencies), len(bands)))
+  for bandIndex, (minimumFrequency, maximumFrequency) in enumerate(bands):
+    inBand = (frequencies >= minimumFrequency) & (frequencies < maximumFrequency)
+    bandMatrix[inBand, bandIndex] = binWeights[inBand]
+  return taper, bandMatrix
+
+class SignalFeatureStream(object):
+  """Computes features of a continuous signal that arrives in frames of samples.
+  Samples are copied into a preallocated ring buffer. The features of each frame are computed over the window of the
+  last windowLength samples up to the end of the frame: RMS, peak and crest factor (as in computeSignalFeatures),
+  and the power of the signal in each frequency band. Frames are processed in batches, so that one FFT call
+  computes the spectra of all pending frames. Features of the last maximumFrames frames are kept.
+  """
+
+  def __init__(self, windowLength, sampleRate, bands, maximumFrames=256):
+    self.windowLength = windowLength
+    self.maximumFrames = maximumFrames
+    self.bufferLength = 2 * windowLength
+    self.samples = numpy.zeros(self.bufferLength)
+    self.windowOffsets = numpy.arange(windowLength)
+    self.windows = numpy.zeros((maximumFrames, windowLength))
+    # Band power = power spectrum x bandMatrix
+    self.taper, self.bandMatrix = createBandMatrix(windowLength, sampleRate, bands)
+    self.frameEnds = numpy.zeros(maximumFrames, dtype=numpy.int64)
+    self.rms = numpy.zeros(maximumFrames)
+    self.peaks = numpy.zeros(maximumFrames)
+    self.crestFactors = numpy.zeros(maximumFrames)
+    self.bandPowers = numpy.zeros((maximumFrames, len(bands)))
+    self.reset()
+
+  def reset(self):
+    self.samples[:] = 0.0
+    self.numberOfSamples = 0
+    self.numberOfFrames = 0
+    self.numberOfComputedFrames = 0
+
+  def addFrame(self, frameSamples):
+    frameSamples = frameSamples[-self.bufferLength:]
+    numberOfPendingFrames = self.numberOfFrames - self.numberOfComputedFrames
+    if numberOfPendingFrames == self.maximumFrames or (numberOfPendingFrames > 0 and self.numberOfSamples + len(frameSamples)
+        - self.frameEnds[self.numberOfComputedFrames % self.maximumFrames] > self.bufferLength - self.windowLength):
+      # The new samples would overwrite the window of a pending frame
+      self.computeFeatures()
+    start = self.numberOfSamples % self.bufferLength
+    firstLength = min(len(frameSamples), self.bufferLength - start)
+    self.samples[start:start + firstLength] = frameSamples[:firstLength]
+    self.samples[:len(frameSamples) - firstLength] = frameSamples[firstLength:]
+    self.numberOfSamples += len(frameSamples)
+    self.frameEnds[self.numberOfFrames % self.maximumFrames] = self.numberOfSamples
+    self.numberOfFrames += 1
+
+  def computeFeatures(self):
+    """
+    Computes the features of all frames added since the last call.
+    """
+    numberOfPendingFrames = self.numberOfFrames - self.numberOfComputedFrames
+    if numberOfPendingFrames == 0:
+      return
+    frameIndices = numpy.arange(self.numberOfComputedFrames, self.numberOfFrames) % self.maximumFrames
+    sampleIndices = (self.frameEnds[frameIndices, numpy.newaxis] - self.windowLength + self.windowOffsets) % self.bufferLength
+    windows = self.windows[:numberOfPendingFrames]
+    numpy.take(self.samples, sampleIndices, out=windows)
+    windows -= windows.mean(axis=1, keepdims=True)
+    self.peaks[frameIndices] = numpy.abs(windows).max(axis=1)
+    rms = numpy.sqrt(numpy.mean(windows * windows, axis=1))
+    self.rms[frameIndices] = rms
+    self.crestFactors[frameIndices] = numpy.divide(self.peaks[frameIndices], rms, out=numpy.zeros_like(rms), where=rms > 0)
+    windows *= self.taper
+    spectra = numpy.fft.rfft(windows, axis=1)
+    self.bandPowers[frameIndices] = (spectra.real ** 2 + spectra.imag ** 2).dot(self.bandMatrix)
+    self.numberOfComputedFrames = self.numberOfFrames
+
+  def getLatestFeatures(self, numberOfFrames=1):
+    """
+    Returns the RMS, peak, crest factor and band powers (NxB) of the latest frames, oldest first.
+    """
+    self.computeFeatures()
+    numberOfFrames = min(numberOfFrames, self.numberOfFrames, self.maximumFrames)
+    frameIndices = numpy.arange(self.numberOfFrames - numberOfFrames, self.numberOfFrames) % self.maximumFrames
+    return self.rms[frameIndices], self.peaks[frameIndices], self.crestFactors[frameIndices], self.bandPowers[frameIndices]
+
+#
+# FiducialSpatialIndex
+#
+
+def findNearestPointsBruteForce(points, position, k):
+  distances = numpy.linalg.norm(points - position, axis=1)
+  order = numpy.argsort(distances, kind="stable")[:k]
+  return distances[order], order
+
+def findPointsWithinRadiusBruteForce(points, position, radius):
+  return numpy.nonzero(numpy.linalg.norm(points - position, axis=1) <= radius)[0]
+
+class FiducialSpatialIndex(object):
+  """Uniform grid over a set of 3D points for nearest neighbour and radius queries.
+  Points can be appended without rebuilding the grid. A query only looks at the cells near the query position,
+  so its time depends on the local point density and not on the total number of points.
+  """
+
+  def __init__(self, cellSize=5.0):
+    self.cellSize = float(cellSize)
+    self.setPoints(numpy.zeros((0, 3)))
+
+  @property
+  def numberOfPoints(self):
+    return self._numberOfPoints
+
+  @property
+  def points(self):
+    return self._pointBuffer[:self._numberOfPoints]
+
+  @property
+  def pointCellIndices(self):
+    return self._cellIndexBuffer[:self._numberOfPoints]
+
+  def invalidate(self):
+    self.isValid = False
+
+  def setPoints(self, points):
+    self._pointBuffer = numpy.zeros((0, 3))
+    self._cellIndexBuffer = numpy.zeros((0, 3), dtype=int)
+    self._numberOfPoints = 0
+    self.cells = {}
+    self.minimumCellIndex = None
+    self.maximumCellIndex = None
+    self.isValid = True
+    self.addPoints(points)
+
+  def addPoints(self, points):
+    """Appends points. The time depends on the number of added points, not on the number of points in the index.
+    """
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 3)
+    if len(points) == 0:
+      return
+    firstPointIndex = self._numberOfPoints
+    numberOfPoints = firstPointIndex + len(points)
+    if numberOfPoints > len(self._pointBuffer):
+      # Capacity is doubled, so that appending one point at a time copies each point a constant number of times on average
+      capacity = max(numberOfPoints, 2 * len(self._pointBuffer), 64)
+      self._pointBuffer = numpy.vstack([self.points, numpy.zeros((capacity - firstPointIndex, 3))])
+      self._cellIndexBuffer = numpy.vstack([self.pointCellIndices, numpy.zeros((capacity - firstPointIndex, 3), dtype=int)])
+    cellIndices = numpy.floor(points / self.cellSize).astype(int)
+    self._pointBuffer[firstPointIndex:numberOfPoints] = points
+    self._cellIndexBuffer[firstPointIndex:numberOfPoints] = cellIndices
+    self._numberOfPoints = numberOfPoints
+    for pointIndex, cellIndex in enumerate(map(tuple, cellIndices), firstPointIndex):
+      self.cells.setdefault(cellIndex, []).append(pointIndex)
+    # Bounds of occupied cells, nearest point search does not need to look further
+    if self.minimumCellIndex is None:
+      self.minimumCellIndex = cellIndices.min(axis=0)
+      self.maximumCellIndex = cellIndices.max(axis=0)
+    else:
+      self.minimumCellIndex = numpy.minimum(self.minimumCellIndex, cellIndices.min(axis=0))
+      self.maximumCellIndex = numpy.maximum(self.maximumCellIndex, cellIndices.max(axis=0))
+
+  def getPointIndicesInCells(self, minimumCellIndex, maximumCellIndex, excludedMinimumCellIndex=None, excludedMaximumCellIndex=None):
+    """Returns the indices of points in the block of cells [minimumCellIndex, maximumCellIndex], except the cells
+    in the excluded block (already visited).
+    """
+    minimumCellIndex = numpy.maximum(minimumCellIndex, self.minimumCellIndex)
+    maximumCellIndex = numpy.minimum(maximumCellIndex, self.maximumCellIndex)
+    if numpy.any(minimumCellIndex > maximumCellIndex):
+      return []
+    if numpy.prod(maximumCellIndex - minimumCellIndex + 1) > len(self.cells):
+      # Large block, most of its cells are empty. Checking the cell of each point is faster than visiting the cells.
+      inBlock = numpy.all((self.pointCellIndices >= minimumCellIndex) & (self.pointCellIndices <= maximumCellIndex), axis=1)
+      if excludedMinimumCellIndex is not None:
+        inBlock &= ~numpy.all((self.pointCellIndices >= excludedMinimumCellIndex)
+          & (self.pointCellIndices <= excludedMaximumCellIndex), axis=1)
+      return list(numpy.nonzero(inBlock)[0])
+    pointIndices = []
+    for i in range(minimumCellIndex[0], maximumCellIndex[0] + 1):
+      for j in range(minimumCellIndex[1], maximumCellIndex[1] + 1):
+        for k in range(minimumCellIndex[2], maximumCellIndex[2] + 1):
+          if (excludedMinimumCellIndex is not None and excludedMinimumCellIndex[0] <= i <= excludedMaximumCellIndex[0]
+            and excludedMinimumCellIndex[1] <= j <= excludedMaximumCellIndex[1] and excludedMinimumCellIndex[2] <= k <= excludedMaximumCellIndex[2]):
+            continue
+          cellPointIndices = self.cells.get((i, j, k))
+          if cellPointIndices:
+            pointIndices.extend(cellPointIndices)
+    return pointIndices
+
+  def findPointsWithinRadius(self, position, radius):
+    """Returns the indices of all points within radius of position.
+    """
+    if not self.cells:
+      return numpy.zeros(0, dtype=int)
+    position = numpy.asarray(position, dtype=numpy.float64)
+    pointIndices = numpy.array(self.getPointIndicesInCells(numpy.floor((position - radius) / self.cellSize).astype(int),
+      numpy.floor((position + radius) / self.cellSize).astype(int)), dtype=int)
+    if len(pointIndices) == 0:
+      return pointIndices
+    distances = numpy.linalg.norm(self.points[pointIndices] - position, axis=1)
+    return numpy.sort(pointIndices[distances <= radius])
+
+  def findNearestPoints(self, position, k=1):
+    """Returns the distances and indices of the k points nearest to position, nearest first.
+    """
+    if not self.cells:
+      return numpy.zeros(0), numpy.zeros(0, dtype=int)
+    position = numpy.asarray(position, dtype=numpy.float64)
+    k = min(k, len(self.points))
+    centerCellIndex = numpy.floor(position / self.cellSize).astype(int)
+    candidateIndices = []
+    visitedMinimumCellIndex = None
+    visitedMaximumCellIndex = None
+    # Smaller rings do not reach any occupied cell
+    ring = max(0, numpy.max(self.minimumCellIndex - centerCellIndex), numpy.max(centerCellIndex - self.maximumCellIndex))
+    while True:
+      minimumCellIndex = centerCellIndex - ring
+      maximumCellIndex = centerCellIndex + ring
+      searchedAllCells = numpy.all(minimumCellIndex <= self.minimumCellIndex) and numpy.all(maximumCellIndex >= self.maximumCellIndex)
+      if searchedAllCells:
+        # The ring covers all occupied cells, all points are candidates
+        candidateIndices = range(len(self.points))
+      else:
+        candidateIndices.extend(self.getPointIndicesInCells(minimumCellIndex, maximumCellIndex, visitedMinimumCellIndex, visitedMaximumCellIndex))
+      visitedMinimumCellIndex, visitedMaximumCellIndex = minimumCellIndex, maximumCellIndex
+      if len(candidateIndices) >= k or searchedAllCells:
+        candidates = numpy.array(candidateIndices, dtype=int)
+        distances = numpy.linalg.norm(self.points[candidates] - position, axis=1)
+        order = numpy.lexsort((candidates, distances))[:k]
+        # Points in cells outside of the visited block are farther than the distance from position to the block boundary.
+        # Only the faces of the block that have occupied cells beyond them count.
+        boundaryDistances = numpy.concatenate([
+          (position - minimumCellIndex * self.cellSize)[minimumCellIndex > self.minimumCellIndex],
+          ((maximumCellIndex + 1) * self.cellSize - position)[maximumCellIndex < self.maximumCellIndex]])
+        distanceToBoundary = numpy.min(boundaryDistances) if len(boundaryDistances) else numpy.inf
+        if searchedAllCells or distances[order[-1]] <= distanceToBoundary:
+          return distances[order], candidates[order]
+        # The k nearest points are within the current k-th distance, grow the ring until it contains that sphere
+        cellOffset = position / self.cellSize - centerCellIndex
+        requiredRing = int(numpy.ceil(numpy.max(distances[order[-1]] / self.cellSize - numpy.minimum(cellOffset, 1.0 - cellOffset))))
+        ring = max(ring + 1, requiredRing)
+      else:
+        ring += 1
 
 #
 # TrackedPicoscopeTest
@@ -398,6 +1075,14 @@ class TrackedPicoscopeTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_TrackedPicoscope1()
+    self.setUp()
+    self.test_TrackedPicoscopeClassifySequence()
+    self.setUp()
+    self.test_TrackedPicoscopeSpatialIndex()
+    self.setUp()
+    self.test_TrackedPicoscopeSignalFeatureStream()
+    self.setUp()
+    self.test_TrackedPicoscopeWidgetUpdates()
 
   def test_TrackedPicoscope1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -443,4 +1128,185 @@ class TrackedPicoscopeTest(ScriptedLoadableModuleTest):
     self.assertEqual(outputScalarRange[0], inputScalarRange[0])
     self.assertEqual(outputScalarRange[1], inputScalarRange[1])
 
+    # Test that both outputs computed in one pass are the same as the results of the CLI module
+    invertedOutputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    logic.process(inputVolume, outputVolume, threshold, False, invertedOutputVolume=invertedOutputVolume)
+    cliOutputArrays = {}
+    for volumeNode, invert in [(outputVolume, False), (invertedOutputVolume, True)]:
+      cliOutputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+      logic.processWithCli(inputVolume, cliOutputVolume, threshold, invert, showResult=False)
+      cliOutputArrays[invert] = slicer.util.arrayFromVolume(cliOutputVolume)
+      self.assertTrue(numpy.array_equal(slicer.util.arrayFromVolume(volumeNode), cliOutputArrays[invert]))
+
+    # Test processing in place, the output volume is the input volume
+    inPlaceVolume = slicer.modules.volumes.logic().CloneVolume(slicer.mrmlScene, inputVolume, "InPlace")
+    logic.process(inPlaceVolume, inPlaceVolume, threshold, False, showResult=False, invertedOutputVolume=invertedOutputVolume)
+    self.assertTrue(numpy.array_equal(slicer.util.arrayFromVolume(inPlaceVolume), cliOutputArrays[False]))
+    self.assertTrue(numpy.array_equal(slicer.util.arrayFromVolume(invertedOutputVolume), cliOutputArrays[True]))
+
+    logic.cleanup()
+    self.delayDisplay('Test passed')
+
+  def createTestSignals(self):
+    """Returns synthetic picoscope signals of one frame (1000 samples at 1 kHz) and their expected classes:
+    cut tissue, coag tissue, cut air, coag air, not active, ambiguous
+    """
+    sampleTimes = numpy.arange(1000) / 1000.0
+    def createSignal(amplitude, coag):
+      signal = amplitude * numpy.sin(2 * numpy.pi * 50 * sampleTimes)
+      if coag:
+        # Interrupted waveform, on for a quarter of the time
+        signal *= (sampleTimes * 10) % 1 < 0.25
+      return signal
+    # Slow drift (e.g. cable motion) has a large RMS, but no power in the bands of the cautery waveforms
+    drift = 0.3 * numpy.sin(2 * numpy.pi * 2 * sampleTimes)
+    signals = [createSignal(0.4, False), createSignal(0.4, True), createSignal(1.2, False), createSignal(1.2, True),
+      createSignal(0.01, False), createSignal(0.68, False), drift]
+    return signals, [1, 2, 3, 4, TrackedPicoscopeLogic.NOT_ACTIVE, 0, TrackedPicoscopeLogic.NOT_ACTIVE]
+
+  def test_TrackedPicoscopeClassifySequence(self):
+    """Classifies a sequence of synthetic cut/coag signals in tissue/air and checks the fiducial lists
+    """
+    self.delayDisplay("Starting the test")
+
+    logic = TrackedPicoscopeLogic()
+    signals, expectedClasses = self.createTestSignals()
+
+    transformSequenceNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceNode", "CauteryToReference")
+    signalSequenceNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceNode", "Signal")
+    transformNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode")
+    signalVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    numberOfRepetitions = 3
+    for itemNumber in range(numberOfRepetitions * len(signals)):
+      transformNode.SetMatrixTransformToParent(slicer.util.vtkMatrixFromArray(numpy.array(
+        [[1, 0, 0, itemNumber], [0, 1, 0, 0], [0, 0, 1, 0], [0, 0, 0, 1]], dtype=float)))
+      transformSequenceNode.SetDataNodeAtValue(transformNode, str(itemNumber))
+      slicer.util.updateVolumeFromArray(signalVolumeNode, signals[itemNumber % len(signals)].reshape(1, 1, -1))
+      signalSequenceNode.SetDataNodeAtValue(signalVolumeNode, str(itemNumber))
+    browserNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceBrowserNode")
+    browserNode.SetAndObserveMasterSequenceNodeID(transformSequenceNode.GetID())
+    browserNode.AddSynchronizedSequenceNodeID(signalSequenceNode.GetID())
+
+    fiducialNodes = {}
+    for fiducialName in logic.CLASS_FIDUCIALS:
+      fiducialNodes[fiducialName] = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", fiducialName)
+    numberOfPoints = logic.classifySequence(browserNode, fiducialNodes)
+
+    for classNumber, fiducialName in enumerate(logic.CLASS_FIDUCIALS):
+      self.assertEqual(numberOfPoints[fiducialName], numberOfRepetitions)
+      pointsWorld = slicer.util.arrayFromMarkupsControlPoints(fiducialNodes[fiducialName], world=True)
+      expectedItemNumbers = [itemNumber for itemNumber in range(numberOfRepetitions * len(signals))
+        if expectedClasses[itemNumber % len(signals)] == classNumber]
+      self.assertTrue(numpy.allclose(pointsWorld[:, 0], expectedItemNumbers))
+
+    # Classifying again appends the points without modifying the existing ones, the spatial index is not rebuilt
+    spatialIndex = logic.getSpatialIndex(fiducialNodes[logic.CUT_TISSUE_FIDUCIALS])
+    logic.classifySequence(browserNode, fiducialNodes)
+    self.assertTrue(spatialIndex.isValid)
+    self.assertEqual(spatialIndex.numberOfPoints, 2 * numberOfRepetitions)
+    self.assertEqual(fiducialNodes[logic.CUT_TISSUE_FIDUCIALS].GetNumberOfControlPoints(), 2 * numberOfRepetitions)
+
+    logic.cleanup()
+    self.delayDisplay('Test passed')
+
+  def test_TrackedPicoscopeSpatialIndex(self):
+    """Nearest point and radius queries of the fiducial spatial index match a brute force search,
+    also after points are added to the fiducial list.
+    """
+
+    self.delayDisplay("Starting the test")
+
+    logic = TrackedPicoscopeLogic()
+    randomState = numpy.random.RandomState(0)
+    points = randomState.uniform(-50.0, 50.0, (200, 3))
+    queries = randomState.uniform(-60.0, 60.0, (20, 3))
+    fiducialNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", logic.CUT_TISSUE_FIDUCIALS)
+    slicer.util.updateMarkupsControlPointsFromArray(fiducialNode, points[:100])
+    spatialIndex = logic.getSpatialIndex(fiducialNode)
+    self.assertEqual(spatialIndex.numberOfPoints, 100)
+    for point in points[100:]:
+      fiducialNode.AddControlPoint(point)
+    spatialIndex = logic.getSpatialIndex(fiducialNode)
+    self.assertEqual(spatialIndex.numberOfPoints, len(points))
+
+    for query in queries:
+      distances, pointIndices = spatialIndex.findNearestPoints(query, 3)
+      expectedDistances, expectedPointIndices = findNearestPointsBruteForce(points, query, 3)
+      self.assertTrue(numpy.allclose(distances, expectedDistances))
+      self.assertEqual(list(spatialIndex.findPointsWithinRadius(query, 10.0)), list(findPointsWithinRadiusBruteForce(points, query, 10.0)))
+
+    fiducialName, distance = logic.findNearestFiducialList(points[0], {logic.CUT_TISSUE_FIDUCIALS: fiducialNode})
+    self.assertEqual(fiducialName, logic.CUT_TISSUE_FIDUCIALS)
+    self.assertAlmostEqual(distance, 0.0)
+
+    slicer.mrmlScene.RemoveNode(fiducialNode)
+    self.assertEqual(logic.spatialIndices, {})
+    self.assertEqual(logic.sceneObservations, [])
+    logic.cleanup()
+
+    benchmarkResults = logic.benchmarkSpatialIndex(numberOfPoints=10000, numberOfQueries=100)
+    logging.info("Spatial index benchmark: {0}".format(benchmarkResults))
+
+    self.delayDisplay('Test passed')
+
+  def test_TrackedPicoscopeSignalFeatureStream(self):
+    """Streams synthetic signals through a volume node and checks the features and classes of the latest frames
+    """
+
+    self.delayDisplay("Starting the test")
+
+    logic = TrackedPicoscopeLogic()
+    signals, expectedClasses = self.createTestSignals()
+    signalVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    slicer.util.updateVolumeFromArray(signalVolumeNode, signals[0].reshape(1, 1, -1))
+    signalFeatureStream = logic.startSignalFeatureStream(signalVolumeNode)
+    for signal in signals:
+      slicer.util.updateVolumeFromArray(signalVolumeNode, signal.reshape(1, 1, -1))
+    logic.stopSignalFeatureStream()
+
+    self.assertEqual(signalFeatureStream.numberOfFrames, len(signals))
+    self.assertEqual(list(logic.classifyLatestFrames(len(signals))), expectedClasses)
+    rms, peaks, crestFactors, bandPowers = signalFeatureStream.getLatestFeatures(len(signals))
+    expectedRms, expectedPeaks, expectedCrestFactors = logic.computeSignalFeatures(numpy.array(signals))
+    self.assertTrue(numpy.allclose(rms, expectedRms))
+    self.assertTrue(numpy.allclose(peaks, expectedPeaks))
+    # The 50 Hz cut waveform has all its power in the second band, the total band power is the mean square
+    self.assertAlmostEqual(bandPowers[0, 1] / rms[0] ** 2, 1.0, places=3)
+    self.assertTrue(numpy.allclose(bandPowers.sum(axis=1), rms * rms, rtol=1e-3))
+
+    logic.cleanup()
+    self.delayDisplay('Test passed')
+
+  def test_TrackedPicoscopeWidgetUpdates(self):
+    """Changes several parameters in a burst and checks that the GUI is updated once
+    """
+
+    self.delayDisplay("Starting the test")
+
+    widget = slicer.modules.trackedpicoscope.widgetRepresentation().self()
+    widget.initializeParameterNode()
+    parameterNode = widget.logic.getParameterNode()
+    slicer.app.processEvents()
+
+    fiducialNodes = [slicer.mrmlScene.AddNewNodeByClass("vtkMRMLMarkupsFiducialNode", fiducialName)
+      for fiducialName in TrackedPicoscopeLogic.CLASS_FIDUCIALS]
+    slicer.app.processEvents()
+    guiUpdateCount = widget.guiUpdateCount
+    for repetition in range(10):
+      for fiducialName, fiducialNode in zip(TrackedPicoscopeLogic.CLASS_FIDUCIALS, fiducialNodes):
+        parameterNode.SetNodeReferenceID(fiducialName, fiducialNode.GetID())
+        parameterNode.Modified()
+    self.assertEqual(widget.guiUpdateCount, guiUpdateCount)
+    slicer.app.processEvents()
+    self.assertEqual(widget.guiUpdateCount, guiUpdateCount + 1)
+    self.assertEqual(widget.ui.cutTissueSelector.currentNodeID, parameterNode.GetNodeReferenceID(TrackedPicoscopeLogic.CUT_TISSUE_FIDUCIALS))
+
+    # Only a sequence browser input can be classified
+    parameterNode.SetNodeReferenceID(TrackedPicoscopeLogic.INPUT_VOLUME, slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode").GetID())
+    slicer.app.processEvents()
+    self.assertFalse(widget.ui.classifyButton.enabled)
+    parameterNode.SetNodeReferenceID(TrackedPicoscopeLogic.INPUT_VOLUME, slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSequenceBrowserNode").GetID())
+    slicer.app.processEvents()
+    self.assertTrue(widget.ui.classifyButton.enabled)
+
     self.delayDisplay('Test passed')
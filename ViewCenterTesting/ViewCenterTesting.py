@@ -1,8 +1,13 @@
+import csv
 import os
 import unittest
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
+import numpy
+from vtk.util import numpy_support
+from LumpNavReplayLib.PlaybackScheduler import PlaybackScheduler
+from LumpNavReplayLib.ViewRegistry import getViewRegistry
 
 #
 # ViewCenterTesting
@@ -17,7 +22,7 @@ class ViewCenterTesting(ScriptedLoadableModule):
     ScriptedLoadableModule.__init__(self, parent)
     self.parent.title = "ViewCenterTesting"
     self.parent.categories = ["IGT"]
-    self.parent.dependencies = []
+    self.parent.dependencies = ["LumpNavReplay"]
     self.parent.contributors = ["Thomas Vaughan (Queen's University)"]
     self.parent.helpText = """ """
     self.parent.helpText += self.getDefaultModuleDocumentationLink()
@@ -172,10 +177,35 @@ class ViewCenterTestingWidget(ScriptedLoadableModuleWidget):
     parametersFormLayout.addRow("Screen Coordinates Table: ", self.screenCoordinatesTableComboBox)
     self.screenCoordinatesTableComboBox.connect("currentNodeChanged(vtkMRMLNode*)", self.onNodeChanged)
 
+    self.outputFilePathLineEdit = ctk.ctkPathLineEdit()
+    self.outputFilePathLineEdit.filters = ctk.ctkPathLineEdit.Files
+    self.outputFilePathLineEdit.nameFilters = ["CSV file (*.csv)", "Parquet folder (*.parquet)"]
+    self.outputFilePathLineEdit.settingKey = "ViewCenterTestingOutputFile"
+    self.outputFilePathLineEdit.setToolTip( "Screen coordinates are written to this file while sampling (optional)." )
+    parametersFormLayout.addRow("Output File: ", self.outputFilePathLineEdit)
+    self.outputFilePathLineEdit.connect("currentPathChanged(QString)", self.onNodeChanged)
+
+    self.resumeCheckBox = qt.QCheckBox()
+    self.resumeCheckBox.setToolTip( "Continue after the last frame already written to the output file." )
+    parametersFormLayout.addRow("Resume: ", self.resumeCheckBox)
+
+    self.renderEveryFrameCheckBox = qt.QCheckBox()
+    self.renderEveryFrameCheckBox.setToolTip( "Sample every frame during replay. Otherwise frames are skipped when rendering is slower than the recording." )
+    parametersFormLayout.addRow("Render every frame: ", self.renderEveryFrameCheckBox)
+
     self.beginReplayButton = qt.QPushButton("Replay")
     parametersFormLayout.addRow(self.beginReplayButton)
     self.beginReplayButton.connect('clicked()', self.onBeginReplayButtonPressed)
 
+    self.stopReplayButton = qt.QPushButton("Stop")
+    parametersFormLayout.addRow(self.stopReplayButton)
+    self.stopReplayButton.connect('clicked()', self.onStopReplayButtonPressed)
+
+    self.analyzeOfflineButton = qt.QPushButton("Analyze without rendering")
+    self.analyzeOfflineButton.setToolTip( "Step through every frame from start to end index and compute extents from the saved camera parameters." )
+    parametersFormLayout.addRow(self.analyzeOfflineButton)
+    self.analyzeOfflineButton.connect('clicked()', self.onAnalyzeOfflineButtonPressed)
+
     self.layout.addStretch(1)
 
     self.onNodeChanged()
@@ -194,9 +224,10 @@ class ViewCenterTestingWidget(ScriptedLoadableModuleWidget):
     self.goToStartButton.enabled = self.lumpNavDataComboBox.currentNode()
     self.beginReplayButton.enabled = self.lumpNavDataComboBox.currentNode() and \
                                      self.targetModelComboBox.currentNode() and \
-                                     self.screenCoordinatesTableComboBox.currentNode() and \
+                                     (self.screenCoordinatesTableComboBox.currentNode() or self.outputFilePathLineEdit.currentPath) and \
                                      self.leftViewComboBox.currentNode() and \
                                      self.rightViewComboBox.currentNode()
+    self.analyzeOfflineButton.enabled = self.beginReplayButton.enabled
 
   def onLeftViewLoadButtonPressed(self):
     transformNode = self.leftTransformComboBox.currentNode()
@@ -256,7 +287,174 @@ class ViewCenterTestingWidget(ScriptedLoadableModuleWidget):
     leftViewNode = self.leftViewComboBox.currentNode()
     rightViewNode = self.rightViewComboBox.currentNode()
     tableNode = self.screenCoordinatesTableComboBox.currentNode()
-    self.logic.beginReplay(sequenceBrowserNode,endFrameIndex,tumorModelNode,leftViewNode,rightViewNode,tableNode)
+    self.logic.beginReplay(sequenceBrowserNode,endFrameIndex,tumorModelNode,leftViewNode,rightViewNode,tableNode,self.createResultSink(),
+      self.renderEveryFrameCheckBox.checked)
+
+  def onStopReplayButtonPressed(self):
+    self.logic.stopReplay()
+
+  def createResultSink(self):
+    outputFilePath = self.outputFilePathLineEdit.currentPath
+    if not outputFilePath:
+      return None
+    self.outputFilePathLineEdit.addCurrentPathToHistory()
+    return self.logic.createResultSink(outputFilePath, self.resumeCheckBox.checked)
+
+  def onAnalyzeOfflineButtonPressed(self):
+    sequenceBrowserNode = self.lumpNavDataComboBox.currentNode()
+    startFrameIndex = self.startIndexSpinBox.value
+    endFrameIndex = self.endIndexSpinBox.value
+    tumorModelNode = self.targetModelComboBox.currentNode()
+    leftViewNode = self.leftViewComboBox.currentNode()
+    rightViewNode = self.rightViewComboBox.currentNode()
+    tableNode = self.screenCoordinatesTableComboBox.currentNode()
+    qt.QApplication.setOverrideCursor(qt.Qt.WaitCursor)
+    try:
+      self.logic.computeExtentsOffline(sequenceBrowserNode,startFrameIndex,endFrameIndex,tumorModelNode,leftViewNode,rightViewNode,tableNode,
+                                       resultSink=self.createResultSink())
+    finally:
+      qt.QApplication.restoreOverrideCursor()
+
+#
+# Extents result sinks
+#
+
+class ExtentsResultSink(object):
+  """Receives extents rows while sampling and writes them to outputFile (CsvExtentsFile or ParquetExtentsFile)
+  every rowsPerChunk rows, so that a crashed or cancelled run keeps everything up to the last chunk.
+  The first value of each row is the frame index. If resume is True and the output already exists, rows are
+  appended after lastFlushedFrameIndex.
+  """
+
+  def __init__(self, outputFile, rowsPerChunk=100, resume=False):
+    self.outputFile = outputFile
+    self.rowsPerChunk = rowsPerChunk
+    self.pendingRows = []
+    self.lastFlushedFrameIndex = -1
+    if resume and outputFile.exists():
+      self.lastFlushedFrameIndex = outputFile.resume()
+    else:
+      outputFile.create()
+
+  def addRow(self, row):
+    self.pendingRows.append(row)
+    if len(self.pendingRows) >= self.rowsPerChunk:
+      self.flush()
+
+  def flush(self):
+    if not self.pendingRows:
+      return
+    self.outputFile.appendRows(self.pendingRows)
+    self.lastFlushedFrameIndex = self.pendingRows[-1][0]
+    self.pendingRows = []
+
+  def close(self):
+    self.flush()
+
+
+class CsvExtentsFile(object):
+
+  def __init__(self, fileName, columnNames):
+    self.fileName = fileName
+    self.columnNames = columnNames
+
+  def exists(self):
+    return os.path.exists(self.fileName)
+
+  def create(self):
+    with open(self.fileName, 'w') as outputFile:
+      csv.writer(outputFile, lineterminator='\n').writerow(self.columnNames)
+
+  def appendRows(self, rows):
+    with open(self.fileName, 'a') as outputFile:
+      csv.writer(outputFile, lineterminator='\n').writerows(rows)
+
+  def parseFrameIndex(self, line):
+    """Returns the frame index of a complete row, or None if the line is truncated (e.g. the run crashed while writing it)
+    """
+    if not line.endswith(b'\n'):
+      return None
+    values = line.decode('utf-8', 'replace').strip().split(',')
+    if len(values) != len(self.columnNames):
+      return None
+    try:
+      for value in values[1:]:
+        float(value)
+      return int(values[0])
+    except ValueError:
+      return None
+
+  def resume(self):
+    """Returns the frame index of the last complete row. A truncated last row is removed, so that appended rows
+    start on a new line.
+    """
+    lastFrameIndex = -1
+    completeSize = 0
+    with open(self.fileName, 'rb') as outputFile:
+      header = outputFile.readline()
+      if not header.endswith(b'\n'):
+        self.create()
+        return -1
+      completeSize = outputFile.tell()
+      for line in iter(outputFile.readline, b''):
+        frameIndex = self.parseFrameIndex(line)
+        if frameIndex is None:
+          if line.strip():
+            logging.warning("Ignoring incomplete row at the end of {0}: {1}".format(self.fileName, line[:200]))
+          break
+        lastFrameIndex = frameIndex
+        completeSize = outputFile.tell()
+    if completeSize < os.path.getsize(self.fileName):
+      with open(self.fileName, 'r+b') as outputFile:
+        outputFile.truncate(completeSize)
+    return lastFrameIndex
+
+
+class ParquetExtentsFile(object):
+  """Writes each chunk as a separate Parquet file in the fileName folder, which can be read as one
+  dataset (e.g. pandas.read_parquet(fileName)). Requires pyarrow.
+  """
+
+  def __init__(self, fileName, columnNames):
+    self.fileName = fileName
+    self.columnNames = columnNames
+
+  def exists(self):
+    return os.path.isdir(self.fileName)
+
+  def create(self):
+    if os.path.isdir(self.fileName):
+      for partFileName in self.getPartFileNames():
+        os.remove(partFileName)
+    else:
+      os.makedirs(self.fileName)
+
+  def getPartFileNames(self):
+    return sorted([os.path.join(self.fileName, name) for name in os.listdir(self.fileName) if name.endswith('.parquet')])
+
+  def appendRows(self, rows):
+    import pyarrow, pyarrow.parquet
+    columns = list(zip(*rows))
+    arrays = [pyarrow.array(column, type=pyarrow.int64() if columnIndex == 0 else pyarrow.float64()) for columnIndex, column in enumerate(columns)]
+    table = pyarrow.Table.from_arrays(arrays, names=self.columnNames)
+    partFileName = os.path.join(self.fileName, 'part-{0:06d}.parquet'.format(len(self.getPartFileNames())))
+    pyarrow.parquet.write_table(table, partFileName)
+
+  def resume(self):
+    """Returns the frame index of the last row. A last part file that cannot be read (e.g. the run crashed
+    while writing it) is removed.
+    """
+    import pyarrow.parquet
+    for partFileName in reversed(self.getPartFileNames()):
+      try:
+        frameIndices = pyarrow.parquet.read_table(partFileName, columns=[self.columnNames[0]]).column(0).to_pylist()
+      except Exception as e:
+        logging.warning("Removing incomplete part {0}: {1}".format(partFileName, e))
+        os.remove(partFileName)
+        continue
+      if frameIndices:
+        return frameIndices[-1]
+    return -1
 
 #
 # ViewCenterTestingLogic
@@ -272,6 +470,16 @@ class ViewCenterTestingLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  EXTENTS_COLUMN_NAMES = [ "Index", "Time (s)",
+                           "Left View Minimum X Extent", "Left View Maximum X Extent",
+                           "Left View Minimum Y Extent", "Left View Maximum Y Extent",
+                           "Right View Minimum X Extent", "Right View Maximum X Extent",
+                           "Right View Minimum Y Extent", "Right View Maximum Y Extent" ]
+
+  def __init__(self):
+    ScriptedLoadableModuleLogic.__init__(self)
+    self.convexHullPointsCache = {}
+
   def assignTransformDataToCameraNode(self, viewToRasTransformNode, viewNode, modelNode):
     camerasLogic = slicer.modules.cameras.logic()
     cameraNode = camerasLogic.GetViewActiveCameraNode(viewNode)
@@ -333,96 +541,164 @@ class ViewCenterTestingLogic(ScriptedLoadableModuleLogic):
   def goToStart(self,sequenceBrowserNode,startFrameIndex):
     sequenceBrowserNode.SetSelectedItemNumber(startFrameIndex)
 
-  def beginReplay(self,sequenceBrowserNode,endFrameIndex,tumorModelNode,leftViewNode,rightViewNode,tableNode):
+  def beginReplay(self,sequenceBrowserNode,endFrameIndex,tumorModelNode,leftViewNode,rightViewNode,tableNode=None,resultSink=None,renderEveryFrame=False):
+    """Plays the sequence in real time and samples the extents of the tumor model in the rendered views after each
+    rendered frame. Frames are skipped if rendering cannot keep up, unless renderEveryFrame is set.
+    Rows are written to resultSink (if provided) as sampling proceeds and shown in tableNode (if provided)
+    when the replay ends. If resultSink already contains rows then replay continues after the last one.
+    """
     self.endFrameIndex = endFrameIndex
     self.sequenceBrowserNode = sequenceBrowserNode
-    self.sequenceBrowserNode.SetPlaybackRateFps(9.5)
-    self.sequenceBrowserNode.SetPlaybackActive(True)
     self.leftViewNode = leftViewNode
     self.rightViewNode = rightViewNode
     self.tumorModelNode = tumorModelNode
     self.tableNode = tableNode
-    self.tableColumnIndices = vtk.vtkIntArray()
-    self.tableColumnIndices.SetName("Index")
-    self.tableColumnTime = vtk.vtkDoubleArray()
-    self.tableColumnTime.SetName("Time (s)")
-    self.tableColumnLeftMinimumX = vtk.vtkDoubleArray()
-    self.tableColumnLeftMinimumX.SetName("Left View Minimum X Extent")
-    self.tableColumnLeftMaximumX = vtk.vtkDoubleArray()
-    self.tableColumnLeftMaximumX.SetName("Left View Maximum X Extent")
-    self.tableColumnLeftMinimumY = vtk.vtkDoubleArray()
-    self.tableColumnLeftMinimumY.SetName("Left View Minimum Y Extent")
-    self.tableColumnLeftMaximumY = vtk.vtkDoubleArray()
-    self.tableColumnLeftMaximumY.SetName("Left View Maximum Y Extent")
-    self.tableColumnRightMinimumX = vtk.vtkDoubleArray()
-    self.tableColumnRightMinimumX.SetName("Right View Minimum X Extent")
-    self.tableColumnRightMaximumX = vtk.vtkDoubleArray()
-    self.tableColumnRightMaximumX.SetName("Right View Maximum X Extent")
-    self.tableColumnRightMinimumY = vtk.vtkDoubleArray()
-    self.tableColumnRightMinimumY.SetName("Right View Minimum Y Extent")
-    self.tableColumnRightMaximumY = vtk.vtkDoubleArray()
-    self.tableColumnRightMaximumY.SetName("Right View Maximum Y Extent")
-    self.timer = qt.QTimer()
-    self.timer.setSingleShot(False)
-    self.timer.setInterval(100) # Once every 10th of a second
-    self.timer.connect('timeout()', self.onTimeout)
-    self.timer.start()
-
-  def onTimeout(self):
-    if self.timer.isActive():
-      self.timer.stop()
-    currentIndex = self.sequenceBrowserNode.GetSelectedItemNumber()
-    self.tableColumnIndices.InsertNextTuple1(currentIndex)
-    timeSeconds = float(self.sequenceBrowserNode.GetMasterSequenceNode().GetNthIndexValue(currentIndex))
-    self.tableColumnTime.InsertNextTuple1(timeSeconds)
+    self.resultSink = resultSink
+    self.initializeTableColumns()
+    startFrameIndex = None
+    if self.resultSink and self.resultSink.lastFlushedFrameIndex >= 0:
+      startFrameIndex = self.resultSink.lastFlushedFrameIndex + 1
+    self.playbackScheduler = PlaybackScheduler(self.sequenceBrowserNode, renderEveryFrame, startItemNumber=startFrameIndex,
+      endItemNumber=endFrameIndex, frameCallback=self.onFrameRendered, finishedCallback=self.onReplayFinished)
+    self.playbackScheduler.start()
+
+  def initializeTableColumns(self):
+    self.tableColumns = []
+    if not self.tableNode:
+      return
+    for columnName in self.EXTENTS_COLUMN_NAMES:
+      column = vtk.vtkIntArray() if columnName == "Index" else vtk.vtkDoubleArray()
+      column.SetName(columnName)
+      self.tableColumns.append(column)
+
+  def onFrameRendered(self, currentIndex):
     leftViewExtents = self.computeExtentsOfModelInViewport(self.leftViewNode,self.tumorModelNode)
-    self.tableColumnLeftMinimumX.InsertNextTuple1(leftViewExtents[0])
-    self.tableColumnLeftMaximumX.InsertNextTuple1(leftViewExtents[1])
-    self.tableColumnLeftMinimumY.InsertNextTuple1(leftViewExtents[2])
-    self.tableColumnLeftMaximumY.InsertNextTuple1(leftViewExtents[3])
     rightViewExtents = self.computeExtentsOfModelInViewport(self.rightViewNode,self.tumorModelNode)
-    self.tableColumnRightMinimumX.InsertNextTuple1(rightViewExtents[0])
-    self.tableColumnRightMaximumX.InsertNextTuple1(rightViewExtents[1])
-    self.tableColumnRightMinimumY.InsertNextTuple1(rightViewExtents[2])
-    self.tableColumnRightMaximumY.InsertNextTuple1(rightViewExtents[3])
-    if (currentIndex >= self.endFrameIndex):
-      self.sequenceBrowserNode.SetPlaybackActive(False)
-      self.endReplay()
-    else:
-      self.timer.start()
+    self.recordRow(currentIndex,leftViewExtents,rightViewExtents)
+
+  def recordRow(self, currentIndex, leftViewExtents, rightViewExtents):
+    timeSeconds = float(self.sequenceBrowserNode.GetMasterSequenceNode().GetNthIndexValue(currentIndex))
+    row = [currentIndex, timeSeconds] + list(leftViewExtents[0:4]) + list(rightViewExtents[0:4])
+    for column, value in zip(self.tableColumns, row):
+      column.InsertNextTuple1(value)
+    if self.resultSink:
+      self.resultSink.addRow(row)
+    return row
+
+  def stopReplay(self):
+    """Stops a replay started by beginReplay, keeping the rows sampled so far
+    """
+    if not hasattr(self, 'playbackScheduler') or not self.playbackScheduler.playing:
+      return
+    self.playbackScheduler.stop()
+    self.onReplayFinished()
+
+  def onReplayFinished(self):
+    logging.info("Replay rendered {0} frames, dropped {1} frames to keep up with the recording".format(
+      self.playbackScheduler.numberOfRenderedFrames, self.playbackScheduler.numberOfDroppedFrames))
+    self.endReplay()
 
   def endReplay(self):
-    self.tableNode.RemoveAllColumns()
-    self.tableNode.AddColumn(self.tableColumnIndices)
-    self.tableNode.AddColumn(self.tableColumnTime)
-    self.tableNode.AddColumn(self.tableColumnLeftMinimumX)
-    self.tableNode.AddColumn(self.tableColumnLeftMaximumX)
-    self.tableNode.AddColumn(self.tableColumnLeftMinimumY)
-    self.tableNode.AddColumn(self.tableColumnLeftMaximumY)
-    self.tableNode.AddColumn(self.tableColumnRightMinimumX)
-    self.tableNode.AddColumn(self.tableColumnRightMaximumX)
-    self.tableNode.AddColumn(self.tableColumnRightMinimumY)
-    self.tableNode.AddColumn(self.tableColumnRightMaximumY)
+    if self.resultSink:
+      self.resultSink.close()
+    if self.tableNode:
+      self.tableNode.RemoveAllColumns()
+      for column in self.tableColumns:
+        self.tableNode.AddColumn(column)
+
+  def createResultSink(self, fileName, resume=False, rowsPerChunk=100):
+    """Creates a sink that writes extents rows to a CSV file, or to a folder of Parquet files if fileName ends with .parquet
+    """
+    if fileName.lower().endswith(".parquet"):
+      outputFile = ParquetExtentsFile(fileName, self.EXTENTS_COLUMN_NAMES)
+    else:
+      outputFile = CsvExtentsFile(fileName, self.EXTENTS_COLUMN_NAMES)
+    return ExtentsResultSink(outputFile, rowsPerChunk, resume)
+
+  def computeExtentsOffline(self,sequenceBrowserNode,startFrameIndex,endFrameIndex,tumorModelNode,leftViewNode,rightViewNode,tableNode=None,outputFileName=None,aspectRatio=None,resultSink=None):
+    """Steps through every frame in [startFrameIndex, endFrameIndex] and computes the extents of the tumor
+    model from the saved camera parameters of each view. Nothing is rendered, so this runs as fast as the
+    scene can be updated and works without a main window (e.g. Slicer --no-main-window).
+    One row per frame is written to resultSink (or a new CSV file named outputFileName) and stored in tableNode (if provided).
+    If resultSink already contains rows then sampling continues after the last one.
+    If aspectRatio is not specified then it is read from the views in the layout, or 1.0 without a layout.
+    """
+    self.sequenceBrowserNode = sequenceBrowserNode
+    self.sequenceBrowserNode.SetPlaybackActive(False)
+    self.leftViewNode = leftViewNode
+    self.rightViewNode = rightViewNode
+    self.tumorModelNode = tumorModelNode
+    self.tableNode = tableNode
+    if not resultSink and outputFileName:
+      resultSink = self.createResultSink(outputFileName)
+    self.resultSink = resultSink
+    self.initializeTableColumns()
+    leftViewAspectRatio = aspectRatio if aspectRatio else self.getViewAspectRatio(leftViewNode)
+    rightViewAspectRatio = aspectRatio if aspectRatio else self.getViewAspectRatio(rightViewNode)
+    if self.resultSink:
+      startFrameIndex = max(startFrameIndex, self.resultSink.lastFlushedFrameIndex + 1)
+
+    numberOfItems = self.sequenceBrowserNode.GetNumberOfItems()
+    endFrameIndex = min(endFrameIndex, numberOfItems - 1)
+    try:
+      for frameIndex in range(startFrameIndex, endFrameIndex + 1):
+        self.sequenceBrowserNode.SetSelectedItemNumber(frameIndex)
+        leftViewExtents = self.computeExtentsOfModelInCamera(leftViewNode,tumorModelNode,leftViewAspectRatio)
+        rightViewExtents = self.computeExtentsOfModelInCamera(rightViewNode,tumorModelNode,rightViewAspectRatio)
+        self.recordRow(frameIndex,leftViewExtents,rightViewExtents)
+    finally:
+      self.endReplay()
+
+  def computeExtentsOfModelInCamera(self, viewNode, modelNode, aspectRatio):
+    """Same as computeExtentsOfModelInViewport, but the projection is computed from the camera node
+    parameters (position, focal point, view up, view angle, clipping range) instead of the renderer.
+    """
+    pointsRas = self.getModelPointsRas(modelNode)
+    worldToViewMatrix = self.getCameraWorldToViewMatrix(viewNode, aspectRatio)
+    pointsViewport = self.convertRasPointsToViewport(worldToViewMatrix, pointsRas)
+    return self.computeExtentsOfPoints(pointsViewport)
+
+  def getCameraWorldToViewMatrix(self, viewNode, aspectRatio):
+    cameraNode = getViewRegistry().getCameraNode(viewNode)
+    camera = vtk.vtkCamera()
+    camera.SetPosition(cameraNode.GetPosition())
+    camera.SetFocalPoint(cameraNode.GetFocalPoint())
+    camera.SetViewUp(cameraNode.GetViewUp())
+    camera.SetViewAngle(cameraNode.GetViewAngle())
+    camera.SetParallelProjection(cameraNode.GetParallelProjection())
+    camera.SetParallelScale(cameraNode.GetParallelScale())
+    camera.SetClippingRange(cameraNode.GetCamera().GetClippingRange())
+    worldToViewVtkMatrix = camera.GetCompositeProjectionTransformMatrix(aspectRatio, 0, 1)
+    return slicer.util.arrayFromVTKMatrix(worldToViewVtkMatrix)
+
+  def getViewAspectRatio(self, viewNode):
+    renderer = getViewRegistry().getRenderer(viewNode)
+    if not renderer:
+      # No rendered view, e.g. when running without a main window
+      return 1.0
+    return renderer.GetTiledAspectRatio()
 
   def computeExtentsOfModelInViewport(self, viewNode, modelNode):
-    modelToRasTransform = vtk.vtkGeneralTransform()
-    modelToRasTransformNode = modelNode.GetParentTransformNode()
-    modelToRasTransformNode.GetTransformToWorld(modelToRasTransform)
-    transformFilter = vtk.vtkTransformFilter()
-    transformFilter.SetTransform(modelToRasTransform)
-    transformFilter.SetInputData(modelNode.GetPolyData())
-    transformFilter.Update()
-    pointsRas = transformFilter.GetOutput().GetPoints()
-    numberOfPoints = pointsRas.GetNumberOfPoints()
+    """Computes [minX,maxX,minY,maxY,minZ,maxZ] of the model in normalized view coordinates.
+    All points are projected at once with the renderer's composite world-to-view matrix.
+    """
+    pointsRas = self.getModelPointsRas(modelNode)
+    worldToViewMatrix = self.getWorldToViewMatrix(viewNode)
+    pointsViewport = self.convertRasPointsToViewport(worldToViewMatrix, pointsRas)
+    return self.computeExtentsOfPoints(pointsViewport)
+
+  def computeExtentsOfModelInViewportPerPoint(self, viewNode, modelNode):
+    """Reference implementation of computeExtentsOfModelInViewport that projects one point at a time
+    through the renderer. Much slower, kept for validating the vectorized computation.
+    """
+    pointsRas = self.getModelPointsRas(modelNode, useConvexHull=False)
     minimumXViewport = float('inf')
     maximumXViewport = float('-inf')
     minimumYViewport = float('inf')
     maximumYViewport = float('-inf')
     minimumZViewport = float('inf')
     maximumZViewport = float('-inf')
-    for pointIndex in xrange(0, numberOfPoints):
-      pointRas = [0,0,0]
-      pointsRas.GetPoint(pointIndex,pointRas)
+    for pointRas in pointsRas:
       pointViewport = self.convertRasToViewport(viewNode,pointRas)
       xViewport = pointViewport[0]
       if xViewport < minimumXViewport:
@@ -442,6 +718,86 @@ class ViewCenterTestingLogic(ScriptedLoadableModuleLogic):
     extentsViewport = [minimumXViewport,maximumXViewport,minimumYViewport,maximumYViewport,minimumZViewport,maximumZViewport]
     return extentsViewport
 
+  def getModelPointsRas(self, modelNode, useConvexHull=True):
+    """Returns the model points transformed to RAS as an Nx3 numpy array.
+    If useConvexHull is True and the model transform is linear then only the vertices of the convex hull of
+    the model are returned. They have the same extents as all points under any linear or perspective projection.
+    """
+    modelToRasTransformNode = modelNode.GetParentTransformNode()
+    if useConvexHull and (not modelToRasTransformNode or modelToRasTransformNode.IsTransformToWorldLinear()):
+      pointsModel = self.getModelConvexHullPoints(modelNode)
+      modelToRasMatrix = vtk.vtkMatrix4x4()
+      if modelToRasTransformNode:
+        modelToRasTransformNode.GetMatrixTransformToWorld(modelToRasMatrix)
+      modelToRas = slicer.util.arrayFromVTKMatrix(modelToRasMatrix)
+      return pointsModel.dot(modelToRas[:3,:3].T) + modelToRas[:3,3]
+    modelToRasTransform = vtk.vtkGeneralTransform()
+    if modelToRasTransformNode:
+      modelToRasTransformNode.GetTransformToWorld(modelToRasTransform)
+    transformFilter = vtk.vtkTransformFilter()
+    transformFilter.SetTransform(modelToRasTransform)
+    transformFilter.SetInputData(modelNode.GetPolyData())
+    transformFilter.Update()
+    pointsRas = transformFilter.GetOutput().GetPoints()
+    if not pointsRas or pointsRas.GetNumberOfPoints() == 0:
+      return numpy.zeros((0,3))
+    return numpy_support.vtk_to_numpy(pointsRas.GetData()).astype(numpy.float64)
+
+  def getModelConvexHullPoints(self, modelNode):
+    """Returns the vertices of the convex hull of the model in model coordinates as an Nx3 numpy array.
+    The result is cached until the polydata of the model is modified.
+    """
+    polyData = modelNode.GetPolyData()
+    if not polyData or polyData.GetNumberOfPoints() == 0:
+      return numpy.zeros((0,3))
+    cachedPolyData, cachedModifiedTime, hullPoints = self.convexHullPointsCache.get(modelNode.GetID(), (None, None, None))
+    if cachedPolyData is polyData and cachedModifiedTime == polyData.GetMTime():
+      return hullPoints
+    hullPoints = self.computeConvexHullPoints(polyData)
+    self.convexHullPointsCache[modelNode.GetID()] = (polyData, polyData.GetMTime(), hullPoints)
+    return hullPoints
+
+  def computeConvexHullPoints(self, polyData):
+    allPoints = numpy_support.vtk_to_numpy(polyData.GetPoints().GetData()).astype(numpy.float64)
+    delaunay = vtk.vtkDelaunay3D()
+    delaunay.SetInputData(polyData)
+    delaunay.SetTolerance(0.0)
+    surfaceFilter = vtk.vtkDataSetSurfaceFilter()
+    surfaceFilter.SetInputConnection(delaunay.GetOutputPort())
+    surfaceFilter.Update()
+    hullPoints = surfaceFilter.GetOutput().GetPoints()
+    if not hullPoints or hullPoints.GetNumberOfPoints() < 4:
+      # Degenerate (e.g. planar) model, there is no 3D hull
+      return allPoints
+    return numpy_support.vtk_to_numpy(hullPoints.GetData()).astype(numpy.float64)
+
+  def getWorldToViewMatrix(self, viewNode):
+    """Returns the 4x4 composite projection matrix that renderer.WorldToView applies for a view
+    """
+    renderer = self.getRenderer(viewNode)
+    camera = renderer.GetActiveCamera()
+    worldToViewVtkMatrix = camera.GetCompositeProjectionTransformMatrix(renderer.GetTiledAspectRatio(), 0, 1)
+    return slicer.util.arrayFromVTKMatrix(worldToViewVtkMatrix)
+
+  def convertRasPointsToViewport(self, worldToViewMatrix, pointsRas):
+    """Projects an Nx3 array of RAS points to normalized view coordinates (same convention as convertRasToViewport)
+    """
+    pointsRas = numpy.asarray(pointsRas, dtype=numpy.float64)
+    pointsView = pointsRas.dot(worldToViewMatrix[:3,:3].T) + worldToViewMatrix[:3,3]
+    w = pointsRas.dot(worldToViewMatrix[3,:3]) + worldToViewMatrix[3,3]
+    # renderer.WorldToView leaves the coordinates untouched when w is zero
+    validW = (w != 0.0)
+    pointsView[validW] /= w[validW,numpy.newaxis]
+    pointsView[~validW] = pointsRas[~validW]
+    return pointsView
+
+  def computeExtentsOfPoints(self, points):
+    if len(points) == 0:
+      return [float('inf'),float('-inf'),float('inf'),float('-inf'),float('inf'),float('-inf')]
+    minimum = points.min(axis=0)
+    maximum = points.max(axis=0)
+    return [float(minimum[0]),float(maximum[0]),float(minimum[1]),float(maximum[1]),float(minimum[2]),float(maximum[2])]
+
   def convertRasToViewport(self, viewNode, positionRas):
     """Computes normalized view coordinates from RAS coordinates for a particular view
     Normalized view coordinates origin is in bottom-left corner, range is [-1,+1]
@@ -449,8 +805,7 @@ class ViewCenterTestingLogic(ScriptedLoadableModuleLogic):
     x = vtk.mutable(positionRas[0])
     y = vtk.mutable(positionRas[1])
     z = vtk.mutable(positionRas[2])
-    view = slicer.app.layoutManager().threeDWidget(self.getThreeDWidgetIndex(viewNode)).threeDView()
-    renderer = view.renderWindow().GetRenderers().GetItemAsObject(0)
+    renderer = self.getRenderer(viewNode)
     renderer.WorldToView(x,y,z)
     return [x.get(), y.get(), z.get()]
 
@@ -458,17 +813,27 @@ class ViewCenterTestingLogic(ScriptedLoadableModuleLogic):
     if (not viewNode):
       logging.error("Error in getThreeDWidgetIndex: No View node selected. Returning 0.")
       return 0
+    threeDViewIndex = getViewRegistry().getThreeDWidgetIndex(viewNode)
+    if threeDViewIndex is None:
+      logging.error("Error in getThreeDWidgetIndex: Can't find the index. Selected View does not exist? Returning 0.")
+      return 0
+    return threeDViewIndex
+
+  def getRenderer(self, viewNode):
+    """Returns the renderer of a view. If the view is not shown in the layout, an error is logged and the
+    renderer of the first 3D widget is returned, as in getThreeDWidgetIndex.
+    """
+    renderer = getViewRegistry().getRenderer(viewNode)
+    if renderer:
+      return renderer
+    threeDViewIndex = self.getThreeDWidgetIndex(viewNode)
     layoutManager = slicer.app.layoutManager()
-    for threeDViewIndex in xrange(layoutManager.threeDViewCount):
-      threeDViewNode = layoutManager.threeDWidget(threeDViewIndex).threeDView().mrmlViewNode()
-      if (threeDViewNode == viewNode):
-        return threeDViewIndex
-    logging.error("Error in getThreeDWidgetIndex: Can't find the index. Selected View does not exist? Returning 0.")
-    return 0
+    if layoutManager is None or threeDViewIndex >= layoutManager.threeDViewCount:
+      raise ValueError("No 3D view is shown for view node {0}".format(viewNode.GetID() if viewNode else None))
+    return layoutManager.threeDWidget(threeDViewIndex).threeDView().renderWindow().GetRenderers().GetItemAsObject(0)
 
   def resetCameraClippingRange(self, viewNode):
-    view = slicer.app.layoutManager().threeDWidget(self.getThreeDWidgetIndex(viewNode)).threeDView()
-    renderer = view.renderWindow().GetRenderers().GetItemAsObject(0)
+    renderer = self.getRenderer(viewNode)
     renderer.ResetCameraClippingRange()
 
 
@@ -489,6 +854,10 @@ class ViewCenterTestingTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_ViewCenterTesting1()
+    self.setUp()
+    self.test_ViewCenterTestingVectorizedExtents()
+    self.setUp()
+    self.test_ViewCenterTestingResultSink()
 
   def test_ViewCenterTesting1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -503,25 +872,92 @@ class ViewCenterTestingTest(ScriptedLoadableModuleTest):
     """
 
     self.delayDisplay("Starting the test")
-    #
-    # first, get some data
-    #
-    import urllib
-    downloads = (
-        ('http://slicer.kitware.com/midas3/download?items=5767', 'FA.nrrd', slicer.util.loadVolume),
-        )
-
-    for url,name,loader in downloads:
-      filePath = slicer.app.temporaryPath + '/' + name
-      if not os.path.exists(filePath) or os.stat(filePath).st_size == 0:
-        logging.info('Requesting download %s from %s...\n' % (name, url))
-        urllib.urlretrieve(url, filePath)
-      if loader:
-        logging.info('Loading %s...' % (name,))
-        loader(filePath)
-    self.delayDisplay('Finished with download and loading')
-
-    volumeNode = slicer.util.getNode(pattern="FA")
+    import LumpNavReplay
+    from LumpNavReplayLib.SyntheticDataset import generateCase
+    case = generateCase(os.path.join(slicer.app.temporaryPath, "ViewCenterTestingTest"), "TestCase", numberOfRecordingFrames=20, imageSize=(32, 24))
+    lumpNavReplayLogic = LumpNavReplay.LumpNavReplayLogic()
+    lumpNavReplayLogic.loadAllData(case["TransducerToProbeFile"], case["SceneFile"], case["RecordingFile"], case["TrackingFile"], False,
+      loadImagesOnDemand=True)
+    self.delayDisplay('Finished loading synthetic case')
+
+    browserNode = lumpNavReplayLogic.getActiveBrowserNode()
+    tableNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLTableNode")
+    logic = ViewCenterTestingLogic()
+    logic.computeExtentsOffline(browserNode, 0, browserNode.GetNumberOfItems() - 1, lumpNavReplayLogic.tumorModelNode_Needle,
+      slicer.mrmlScene.GetNodeByID("vtkMRMLViewNode1"), slicer.mrmlScene.GetNodeByID("vtkMRMLViewNode2"), tableNode, aspectRatio=1.0)
+    self.assertEqual(tableNode.GetNumberOfRows(), 20)
+    # The cameras of the synthetic scene look at the tumor
+    table = tableNode.GetTable()
+    for columnName in ["Left View Minimum X Extent", "Right View Minimum X Extent"]:
+      self.assertGreater(table.GetColumnByName(columnName).GetValue(0), -1.0)
+    for columnName in ["Left View Maximum X Extent", "Right View Maximum X Extent"]:
+      self.assertLess(table.GetColumnByName(columnName).GetValue(0), 1.0)
+    self.delayDisplay('Test passed!')
+
+  def test_ViewCenterTestingVectorizedExtents(self):
+    """ Check that the vectorized extents computation agrees with the per-point reference.
+    """
+    self.delayDisplay("Starting the vectorized extents test")
+
+    sphereSource = vtk.vtkSphereSource()
+    sphereSource.SetRadius(15)
+    sphereSource.SetThetaResolution(40)
+    sphereSource.SetPhiResolution(40)
+    sphereSource.Update()
+    modelNode = slicer.modules.models.logic().AddModel(sphereSource.GetOutput())
+
+    modelToRasTransformNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode")
+    modelToRasTransform = vtk.vtkTransform()
+    modelToRasTransform.Translate(20, -10, 35)
+    modelToRasTransform.RotateX(30)
+    modelToRasTransformNode.SetMatrixTransformToParent(modelToRasTransform.GetMatrix())
+    modelNode.SetAndObserveTransformNodeID(modelToRasTransformNode.GetID())
+
+    threeDView = slicer.app.layoutManager().threeDWidget(0).threeDView()
+    viewNode = threeDView.mrmlViewNode()
+    cameraNode = slicer.modules.cameras.logic().GetViewActiveCameraNode(viewNode)
+    cameraNode.SetPosition(150, 80, 400)
+    cameraNode.SetFocalPoint(0, 0, 0)
+    cameraNode.SetViewUp(0, 1, 0)
+    logic = ViewCenterTestingLogic()
+    logic.resetCameraClippingRange(viewNode)
+    threeDView.forceRender()
+    self.assertEqual(getViewRegistry().getRenderer(viewNode), threeDView.renderWindow().GetRenderers().GetItemAsObject(0))
+
+    vectorizedExtents = logic.computeExtentsOfModelInViewport(viewNode, modelNode)
+    referenceExtents = logic.computeExtentsOfModelInViewportPerPoint(viewNode, modelNode)
+    self.assertEqual(len(vectorizedExtents), 6)
+    for vectorizedExtent, referenceExtent in zip(vectorizedExtents, referenceExtents):
+      self.assertAlmostEqual(vectorizedExtent, referenceExtent, places=6)
+
+    # Render-free computation from the camera parameters must give the same result
+    cameraExtents = logic.computeExtentsOfModelInCamera(viewNode, modelNode, logic.getViewAspectRatio(viewNode))
+    for cameraExtent, referenceExtent in zip(cameraExtents, referenceExtents):
+      self.assertAlmostEqual(cameraExtent, referenceExtent, places=6)
+
+    self.delayDisplay('Test passed!')
+
+  def test_ViewCenterTestingResultSink(self):
+    """ Check that a CSV result sink resumes after the last complete row if a run ended while writing a row.
+    """
+    self.delayDisplay("Starting the result sink test")
     logic = ViewCenterTestingLogic()
-    self.assertIsNotNone( logic.hasImageData(volumeNode) )
+    fileName = os.path.join(slicer.app.temporaryPath, "ViewCenterTestingResultSink.csv")
+    numberOfColumns = len(logic.EXTENTS_COLUMN_NAMES)
+    resultSink = logic.createResultSink(fileName, rowsPerChunk=2)
+    for frameIndex in range(4):
+      resultSink.addRow([frameIndex] + [0.5] * (numberOfColumns - 1))
+    resultSink.close()
+    with open(fileName, 'a') as outputFile:
+      outputFile.write("4,0.5,0.")
+
+    resultSink = logic.createResultSink(fileName, resume=True)
+    self.assertEqual(resultSink.lastFlushedFrameIndex, 3)
+    resultSink.addRow([4] + [1.0] * (numberOfColumns - 1))
+    resultSink.close()
+    with open(fileName) as outputFile:
+      rows = list(csv.reader(outputFile))
+    self.assertEqual(rows[0], logic.EXTENTS_COLUMN_NAMES)
+    self.assertEqual([int(row[0]) for row in rows[1:]], [0, 1, 2, 3, 4])
+    self.assertEqual(float(rows[-1][1]), 1.0)
     self.delayDisplay('Test passed!')